@@ -8,9 +8,8 @@ from .models import Session, Screenshot, DataLayerCapture, Report
 
 @admin.register(Session)
 class SessionAdmin(admin.ModelAdmin):
-    list_display = ('id', 'url', 'status', 'browser_type', 'created_at', 'view_link')
-    # Quitado 'headless' de list_filter:
-    list_filter = ('status', 'browser_type', 'created_at')
+    list_display = ('id', 'url', 'status', 'browser_type', 'headless', 'created_at', 'view_link')
+    list_filter = ('status', 'browser_type', 'headless', 'resource_policy', 'created_at')
     search_fields = ('url', 'description')
     readonly_fields = ('id', 'created_at', 'updated_at')
     fieldsets = (
@@ -18,8 +17,7 @@ class SessionAdmin(admin.ModelAdmin):
             'fields': ('id', 'url', 'status', 'description')
         }),
         ('Configuración', {
-            # Quitado 'headless' de fields:
-            'fields': ('json_file', 'browser_type')
+            'fields': ('json_file', 'browser_type', 'headless', 'resource_policy', 'resource_rules')
         }),
         ('Fechas', {
             'fields': ('created_at', 'updated_at')
@@ -70,10 +68,10 @@ class ScreenshotAdmin(admin.ModelAdmin):
 
 @admin.register(DataLayerCapture)
 class DataLayerCaptureAdmin(admin.ModelAdmin):
-    list_display = ('id', 'session_link', 'url', 'is_valid', 'created_at')
+    list_display = ('id', 'session_link', 'url', 'offset', 'is_valid', 'created_at')
     list_filter = ('is_valid', 'created_at')
     search_fields = ('url', 'session__url')
-    readonly_fields = ('id', 'created_at', 'session_link', 'formatted_data', 'formatted_errors')
+    readonly_fields = ('id', 'created_at', 'session_link', 'sequence', 'offset', 'formatted_data', 'formatted_snapshot', 'formatted_errors')
 
     def session_link(self, obj):
         try:
@@ -92,7 +90,16 @@ class DataLayerCaptureAdmin(admin.ModelAdmin):
             return format_html('<pre style="white-space: pre-wrap; word-wrap: break-word;">{}</pre>', escaped_str)
         except Exception as e:
             return f"Error al formatear JSON: {e}"
-    formatted_data.short_description = 'Datos Capturados'
+    formatted_data.short_description = 'Datos Capturados (entradas nuevas)'
+
+    def formatted_snapshot(self, obj):
+        # Solo en la vista de detalle: reconstruye el dataLayer completo a partir de los incrementos
+        try:
+            snapshot_str = json.dumps(obj.snapshot(), indent=2, ensure_ascii=False)
+            return format_html('<pre style="white-space: pre-wrap; word-wrap: break-word;">{}</pre>', snapshot_str)
+        except Exception as e:
+            return f"Error al reconstruir el DataLayer: {e}"
+    formatted_snapshot.short_description = 'DataLayer completo en esta captura'
 
     def formatted_errors(self, obj):
         if not obj.errors:
@@ -0,0 +1,341 @@
+# core/admission.py
+"""
+Control de admisión de sesiones y presupuesto de recursos del navegador.
+
+Cada proceso admite como mucho ``WORKER_SETTINGS['MAX_SESSIONS']`` sesiones
+con navegador a la vez; el resto espera en una cola FIFO y recibe su
+posición cada vez que cambia (el consumer se la envía al cliente). Con
+varios workers la capacidad total es la suma de la de cada proceso, que se
+anuncia en el registro de ``core/workers.py``.
+
+Un bucle de muestreo (``ADMISSION_SETTINGS['SAMPLE_INTERVAL']``) aplica los
+límites de cada sesión admitida y recupera las que los superan:
+
+- duración máxima y tiempo sin mensajes del cliente;
+- páginas abiertas (las ventanas emergentes de más se cierran al abrirse);
+- memoria del heap JS de sus páginas (solo Chromium);
+- RSS del proceso y sus navegadores: por encima de ``MAX_RSS_MB`` no se
+  admite a nadie y se recupera la sesión inactiva desde hace más tiempo.
+
+Los trabajos de los lotes (``core/batch.py``) piden turno con
+``background=True``: esperan en una cola aparte que solo avanza cuando no
+hay sesiones interactivas esperando, y nunca ocupan los últimos
+``INTERACTIVE_RESERVED`` huecos.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from django.conf import settings
+
+from .metrics import update_admission_gauges
+
+logger = logging.getLogger(__name__)
+
+RECLAIM_CLOSE_CODE = 4002 # Sesión recuperada por superar sus límites
+REJECT_CLOSE_CODE = 4003 # Cola de admisión llena o espera agotada
+
+# Heap JS usado por la página (performance.memory solo existe en Chromium)
+JS_HEAP_SCRIPT = "() => (performance.memory ? performance.memory.usedJSHeapSize : null)"
+
+
+class AdmissionError(Exception):
+    """No se pudo admitir la sesión (cola llena o espera agotada)"""
+
+
+def get_admission_settings():
+    return getattr(settings, 'ADMISSION_SETTINGS', {})
+
+
+def _process_tree(pid):
+    """``{pid: (campos de /proc/pid/stat tras el nombre, páginas RSS)}`` del proceso y sus descendientes"""
+    children = {}
+    processes = {}
+    try:
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                with open(f'/proc/{entry}/statm') as f:
+                    processes[int(entry)] = (fields, int(f.read().split()[1]))
+            except (OSError, IndexError, ValueError):
+                continue # El proceso terminó mientras se leía
+            children.setdefault(int(fields[1]), []).append(int(entry))
+    except OSError:
+        return None
+
+    tree, pending = {}, [pid]
+    while pending:
+        current = pending.pop()
+        if current in processes:
+            tree[current] = processes[current]
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def process_tree_rss(pid=None):
+    """RSS en bytes de un proceso y sus descendientes (navegadores incluidos); None fuera de Linux"""
+    tree = _process_tree(pid or os.getpid())
+    if tree is None:
+        return None
+    return sum(rss_pages for _, rss_pages in tree.values()) * os.sysconf('SC_PAGE_SIZE')
+
+
+def process_tree_cpu_seconds(pid=None):
+    """CPU (usuario + sistema) consumida por un proceso y sus descendientes, también los ya terminados"""
+    tree = _process_tree(pid or os.getpid())
+    if tree is None:
+        return None
+    # utime, stime, cutime y cstime: campos 14 a 17 de /proc/pid/stat
+    ticks = sum(sum(int(value) for value in fields[11:15]) for fields, _ in tree.values())
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+
+class SessionBudget:
+    """Uso de recursos de una sesión admitida"""
+
+    def __init__(self, session_id, reclaim, background=False):
+        self.session_id = str(session_id)
+        self.reclaim = reclaim # Corrutina reclaim(reason) del consumer
+        self.background = background # Trabajo de un lote (cede el paso a las sesiones interactivas)
+        self.started_at = time.monotonic()
+        self.last_activity = self.started_at
+        self.context = None
+        self.reclaiming = False
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def attach(self, context, max_pages):
+        """Vigila el contexto del navegador y cierra las páginas que superen ``max_pages``"""
+        self.context = context
+
+        async def on_page(page):
+            if max_pages and len(context.pages) > max_pages:
+                logger.warning(f"Sesión {self.session_id}: límite de {max_pages} páginas alcanzado, se cierra {page.url}")
+                await page.close()
+
+        context.on('page', on_page)
+
+    def page_count(self):
+        return len(self.context.pages) if self.context else 0
+
+    async def js_heap_bytes(self):
+        if not self.context:
+            return None
+        total = None
+        for page in self.context.pages:
+            try:
+                used = await page.evaluate(JS_HEAP_SCRIPT)
+            except Exception:
+                continue # Página cerrándose o navegando
+            if used is not None:
+                total = (total or 0) + used
+        return total
+
+
+class AdmissionController:
+    """Semáforo FIFO de sesiones con navegador y vigilancia de sus límites"""
+
+    def __init__(self, max_sessions=None, max_queue=None, queue_timeout=None):
+        admission_settings = get_admission_settings()
+        self.max_sessions = max_sessions or getattr(settings, 'WORKER_SETTINGS', {}).get('MAX_SESSIONS', 4)
+        self.max_queue = max_queue if max_queue is not None else admission_settings.get('MAX_QUEUE', 20)
+        self.queue_timeout = queue_timeout or admission_settings.get('QUEUE_TIMEOUT', 600)
+        self.limits = admission_settings
+        self.active = {} # session_id -> SessionBudget
+        self.waiters = deque() # (session_id, future, reclaim, on_position)
+        self.background_waiters = deque() # (session_id, future, reclaim) de los lotes
+        self.over_memory = False
+        self.last_rss = None
+        self._monitor_task = None
+
+    # --------------------- ADMISIÓN ---------------------
+
+    async def acquire(self, session_id, reclaim, on_position=None, background=False):
+        """
+        Espera turno y devuelve el ``SessionBudget`` de la sesión.
+        ``on_position(n)`` se llama (corrutina) cada vez que cambia la posición en la cola.
+        Con ``background`` (lotes) se espera sin límite de cola ni de tiempo detrás
+        de las sesiones interactivas; la concurrencia del lote ya acota la espera.
+        """
+        self._ensure_monitor()
+        session_id = str(session_id)
+        if background:
+            return await self._acquire_background(session_id, reclaim)
+        if not self.waiters and self._has_room():
+            return self._admit(session_id, reclaim)
+        if len(self.waiters) >= self.max_queue:
+            raise AdmissionError(f"Servidor completo: {len(self.active)} sesiones activas y {len(self.waiters)} en espera")
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (session_id, future, reclaim, on_position)
+        self.waiters.append(waiter)
+        update_admission_gauges(self.stats())
+        logger.info(f"Sesión {session_id} en cola de admisión (posición {len(self.waiters)})")
+        await self._notify_positions()
+        try:
+            return await asyncio.wait_for(future, self.queue_timeout)
+        except BaseException as e:
+            if waiter in self.waiters:
+                # Cancelada (el cliente se fue) o espera agotada: salir de la cola
+                self.waiters.remove(waiter)
+                update_admission_gauges(self.stats())
+                asyncio.create_task(self._notify_positions())
+            elif future.done() and not future.cancelled():
+                self.release(future.result()) # Turno concedido justo al cancelar
+            if isinstance(e, asyncio.TimeoutError):
+                raise AdmissionError(f"No hubo hueco para la sesión en {self.queue_timeout} s") from None
+            raise
+
+    def release(self, budget):
+        """Libera el hueco de la sesión y da paso a la siguiente de la cola"""
+        if self.active.get(budget.session_id) is budget:
+            del self.active[budget.session_id]
+            logger.info(f"Sesión {budget.session_id} liberada ({len(self.active)}/{self.max_sessions} activas)")
+        self._wake_waiters()
+        update_admission_gauges(self.stats())
+
+    def stats(self):
+        return {
+            'active': len(self.active),
+            'max_sessions': self.max_sessions,
+            'queued': len(self.waiters),
+            'background': sum(1 for budget in self.active.values() if budget.background),
+            'background_queued': len(self.background_waiters),
+            'over_memory': self.over_memory,
+            'rss_bytes': self.last_rss,
+        }
+
+    # --------------------- VIGILANCIA ---------------------
+
+    async def check_budgets(self):
+        """Una ronda de muestreo: RSS del proceso y límites de cada sesión"""
+        now = time.monotonic()
+        max_duration = self.limits.get('MAX_DURATION', 0)
+        idle_timeout = self.limits.get('IDLE_TIMEOUT', 0)
+        max_pages = self.limits.get('MAX_PAGES', 0)
+        max_heap = self.limits.get('MAX_SESSION_MEMORY_MB', 0) * 1024 * 1024
+
+        for budget in list(self.active.values()):
+            if budget.reclaiming:
+                continue
+            reason = None
+            if max_duration and now - budget.started_at > max_duration:
+                reason = f"duración máxima de {max_duration} s alcanzada"
+            elif idle_timeout and now - budget.last_activity > idle_timeout:
+                reason = f"{idle_timeout} s sin actividad"
+            elif max_pages and budget.page_count() > max_pages:
+                reason = f"más de {max_pages} páginas abiertas"
+            elif max_heap:
+                heap = await budget.js_heap_bytes()
+                if heap and heap > max_heap:
+                    reason = f"memoria JS de {heap // (1024 * 1024)} MB (límite {max_heap // (1024 * 1024)} MB)"
+            if reason:
+                await self._reclaim(budget, reason)
+
+        max_rss = self.limits.get('MAX_RSS_MB', 0) * 1024 * 1024
+        self.last_rss = await asyncio.to_thread(process_tree_rss)
+        was_over = self.over_memory
+        self.over_memory = bool(max_rss and self.last_rss and self.last_rss > max_rss)
+        if self.over_memory:
+            idle = [budget for budget in self.active.values() if not budget.reclaiming]
+            if idle:
+                victim = min(idle, key=lambda budget: budget.last_activity)
+                await self._reclaim(victim, f"memoria del servidor al límite ({self.last_rss // (1024 * 1024)} MB)")
+        elif was_over:
+            logger.info(f"Memoria por debajo del límite ({self.last_rss // (1024 * 1024)} MB): se reanudan las admisiones")
+            self._wake_waiters()
+
+    # --------------------- FUNCIONES INTERNAS ---------------------
+
+    async def _acquire_background(self, session_id, reclaim):
+        if not self.waiters and self._has_background_room():
+            return self._admit(session_id, reclaim, background=True)
+        future = asyncio.get_running_loop().create_future()
+        waiter = (session_id, future, reclaim)
+        self.background_waiters.append(waiter)
+        update_admission_gauges(self.stats())
+        try:
+            return await future
+        except BaseException:
+            if waiter in self.background_waiters:
+                self.background_waiters.remove(waiter)
+                update_admission_gauges(self.stats())
+            elif future.done() and not future.cancelled():
+                self.release(future.result()) # Turno concedido justo al cancelar
+            raise
+
+    def _has_room(self):
+        return len(self.active) < self.max_sessions and not self.over_memory
+
+    def _has_background_room(self):
+        """Hueco para un trabajo de lote sin tocar los reservados a las sesiones interactivas"""
+        reserved = self.limits.get('INTERACTIVE_RESERVED', 1)
+        background = sum(1 for budget in self.active.values() if budget.background)
+        return self._has_room() and background < max(1, self.max_sessions - reserved)
+
+    def _admit(self, session_id, reclaim, background=False):
+        budget = SessionBudget(session_id, reclaim, background=background)
+        self.active[session_id] = budget
+        update_admission_gauges(self.stats())
+        kind = 'Trabajo de lote' if background else 'Sesión'
+        logger.info(f"{kind} {session_id} admitido/a ({len(self.active)}/{self.max_sessions} activas)")
+        return budget
+
+    def _wake_waiters(self):
+        """Admite a los primeros de la cola mientras haya hueco"""
+        woke = False
+        while self.waiters and self._has_room():
+            session_id, future, reclaim, on_position = self.waiters.popleft()
+            if future.done():
+                continue # Espera agotada o cancelada
+            future.set_result(self._admit(session_id, reclaim))
+            woke = True
+        # Los lotes solo avanzan cuando no queda ninguna sesión interactiva esperando
+        while not self.waiters and self.background_waiters and self._has_background_room():
+            session_id, future, reclaim = self.background_waiters.popleft()
+            if not future.done():
+                future.set_result(self._admit(session_id, reclaim, background=True))
+        if woke:
+            asyncio.create_task(self._notify_positions())
+
+    async def _notify_positions(self):
+        for position, (session_id, future, reclaim, on_position) in enumerate(list(self.waiters), start=1):
+            if on_position and not future.done():
+                try:
+                    await on_position(position)
+                except Exception as e:
+                    logger.debug(f"No se pudo notificar la posición a la sesión {session_id}: {e}")
+
+    async def _reclaim(self, budget, reason):
+        budget.reclaiming = True
+        logger.warning(f"Recuperando sesión {budget.session_id}: {reason}")
+        try:
+            await budget.reclaim(reason)
+        except Exception as e:
+            logger.exception(f"Error al recuperar la sesión {budget.session_id}: {e}")
+        finally:
+            self.release(budget)
+
+    def _ensure_monitor(self):
+        # La tarea se crea dentro del event loop de Daphne
+        if self._monitor_task is None or self._monitor_task.done():
+            self._monitor_task = asyncio.create_task(self._monitor_loop())
+
+    async def _monitor_loop(self):
+        interval = self.limits.get('SAMPLE_INTERVAL', 15)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.check_budgets()
+            except Exception as e:
+                logger.exception(f"Error en la vigilancia de recursos: {e}")
+
+
+# Controlador del proceso (uno por worker Daphne)
+admission = AdmissionController()
@@ -5,3 +5,7 @@ class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
     verbose_name = 'DataLayer Validator'
+
+    def ready(self):
+        # Registrar la configuración de conexiones (WAL en SQLite)
+        from . import db  # noqa: F401
@@ -0,0 +1,370 @@
+# core/batch.py
+"""
+Validación por lotes sin interfaz: una referencia JSON contra una lista de
+URLs o de recorridos guionizados, en navegadores headless.
+
+Cada trabajo es una URL o un recorrido::
+
+    {"name": "checkout", "url": "https://tienda.example/",
+     "steps": [{"action": "click", "selector": "#comprar"},
+               {"action": "type", "selector": "#email", "text": "qa@example.com"},
+               {"action": "goto", "url": "https://tienda.example/gracias"},
+               {"action": "wait", "ms": 500}]}
+
+Por cada trabajo se crea una ``Session`` con sus ``DataLayerCapture`` y,
+opcionalmente, su ``Report``, que se encola en ``core/report_jobs.py`` como
+los de las sesiones interactivas. Los trabajos se ejecutan en paralelo hasta
+``concurrency`` contextos a la vez (como mucho ``BATCH_SETTINGS['MAX_CONCURRENCY']``),
+sobre un pool de navegadores headless propio (no comparte navegadores con las
+sesiones interactivas). Cada trabajo pide además turno al control de admisión
+del proceso como trabajo en segundo plano (``core/admission.py``), así que un
+lote nunca deja sin hueco a las sesiones interactivas. Por defecto
+con el preset de recursos ``tags`` (``RESOURCE_POLICY_SETTINGS['BATCH_DEFAULT']``):
+nadie ve estas páginas, así que imágenes, fuentes y terceros no se descargan.
+
+Se usa desde ``manage.py run_batch`` y desde ``POST /api/batch/``.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from collections import namedtuple
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from validator.validator import ReferenceIndex
+from .admission import admission
+from .browser_pool import BrowserPool
+from .datalayer_stream import DATALAYER_STREAM_SCRIPT, INTERNAL_EVENT_PREFIXES
+from .db import database_write_to_async
+from .models import Session, DataLayerCapture
+from .report_jobs import new_report_job, enqueue_report_job
+from .resource_policy import ResourcePolicy, ResourceTracker, get_resource_policy_settings
+from .settle import SettleDetector, SETTLE_MONITOR_SCRIPT
+
+logger = logging.getLogger(__name__)
+
+STEP_ACTIONS = ('goto', 'click', 'type', 'wait')
+
+BatchJob = namedtuple('BatchJob', ['name', 'url', 'steps'])
+BatchResult = namedtuple('BatchResult', ['session_id', 'name', 'url', 'status', 'captures', 'valid', 'invalid', 'report_job_id', 'error',
+                                         'requests_blocked', 'bytes_saved_estimate'])
+
+
+class BatchError(ValueError):
+    """Definición de lote no válida"""
+
+
+def get_batch_settings():
+    return getattr(settings, 'BATCH_SETTINGS', {})
+
+
+def parse_jobs(items):
+    """Normaliza una lista de URLs (str) o recorridos (dict) en ``BatchJob``"""
+    if not isinstance(items, list) or not items:
+        raise BatchError("Se esperaba una lista no vacía de URLs o recorridos")
+    max_jobs = get_batch_settings().get('MAX_JOBS', 500)
+    if max_jobs and len(items) > max_jobs:
+        raise BatchError(f"Demasiados trabajos en el lote: {len(items)} (máximo {max_jobs})")
+    jobs = []
+    for position, item in enumerate(items):
+        if isinstance(item, str):
+            item = {'url': item}
+        if not isinstance(item, dict) or not item.get('url'):
+            raise BatchError(f"Trabajo #{position + 1}: falta 'url'")
+        steps = item.get('steps') or []
+        if not isinstance(steps, list):
+            raise BatchError(f"Trabajo #{position + 1}: 'steps' debe ser una lista")
+        for number, step in enumerate(steps):
+            action = step.get('action') if isinstance(step, dict) else None
+            if action not in STEP_ACTIONS:
+                raise BatchError(f"Trabajo #{position + 1}, paso {number + 1}: acción desconocida {action!r} (válidas: {', '.join(STEP_ACTIONS)})")
+            if action in ('click', 'type') and not step.get('selector'):
+                raise BatchError(f"Trabajo #{position + 1}, paso {number + 1}: '{action}' necesita 'selector'")
+            if action == 'goto' and not step.get('url'):
+                raise BatchError(f"Trabajo #{position + 1}, paso {number + 1}: 'goto' necesita 'url'")
+        jobs.append(BatchJob(item.get('name') or item['url'], item['url'], steps))
+    return jobs
+
+
+class BatchRunner:
+    """Ejecuta un lote de trabajos con concurrencia acotada"""
+
+    def __init__(self, reference, browser_type=None, concurrency=None, browsers=None,
+                 generate_reports=True, batch_id=None, pool=None, resource_policy=None, resource_rules=None,
+                 use_admission=True):
+        if not isinstance(reference, list):
+            raise BatchError("La referencia debe ser una lista de eventos de DataLayer")
+        batch_settings = get_batch_settings()
+        self.reference = reference
+        self.reference_index = ReferenceIndex(reference)
+        self.browser_type = browser_type or settings.PLAYWRIGHT_SETTINGS.get('DEFAULT_BROWSER', 'chromium')
+        try:
+            concurrency = int(concurrency or batch_settings.get('CONCURRENCY', 4))
+        except (TypeError, ValueError):
+            raise BatchError(f"'concurrency' debe ser un entero: {concurrency!r}") from None
+        self.concurrency = max(1, min(concurrency, batch_settings.get('MAX_CONCURRENCY', 8)))
+        self.use_admission = use_admission
+        self.generate_reports = generate_reports
+        self.batch_id = batch_id or uuid.uuid4().hex[:8]
+        self.settle_settings = getattr(settings, 'SETTLE_SETTINGS', {})
+        self.resource_policy = ResourcePolicy.from_rules(
+            resource_policy or get_resource_policy_settings().get('BATCH_DEFAULT', 'tags'), resource_rules)
+        # Pool propio y headless; varios contextos comparten cada navegador
+        self.owns_pool = pool is None
+        self.pool = pool or BrowserPool(
+            min_size=0,
+            max_size=browsers or batch_settings.get('BROWSERS', 2),
+            recycle_after=batch_settings.get('RECYCLE_AFTER', 100),
+            headless=True,
+            name='batch',
+        )
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.report_tasks = set() # Reportes en hilos locales (sin worker de reportes)
+
+    # --------------------- PREPARACIÓN ---------------------
+
+    @database_write_to_async
+    def create_sessions(self, jobs, reference_bytes):
+        """Crea las sesiones del lote (pendientes) compartiendo el fichero de referencia"""
+        json_name = default_storage.save(f'uploads/json/lote_{self.batch_id}.json', ContentFile(reference_bytes))
+        sessions = [
+            Session(
+                url=job.url[:Session._meta.get_field('url').max_length],
+                json_file=json_name,
+                browser_type=self.browser_type,
+                headless=True,
+                resource_policy=self.resource_policy.preset,
+                resource_rules=self.resource_policy.rules,
+                description=f"Lote {self.batch_id} · {job.name}"[:255],
+                status='pending',
+            )
+            for job in jobs
+        ]
+        Session.objects.bulk_create(sessions)
+        return sessions
+
+    # --------------------- EJECUCIÓN ---------------------
+
+    async def run(self, jobs, sessions, on_result=None):
+        """Ejecuta todos los trabajos y devuelve sus ``BatchResult`` en el mismo orden"""
+        async def run_one(job, session):
+            async with self.semaphore:
+                result = await self.run_job(job, session)
+            if on_result:
+                on_result(result)
+            return result
+
+        start = time.monotonic()
+        try:
+            results = await asyncio.gather(*(run_one(job, session) for job, session in zip(jobs, sessions)))
+        finally:
+            if self.owns_pool:
+                await self.pool.shutdown()
+        if self.report_tasks:
+            # Se esperan para que el cierre del event loop (manage.py run_batch) no los cancele
+            await asyncio.gather(*self.report_tasks, return_exceptions=True)
+        logger.info(f"Lote {self.batch_id}: {len(results)} trabajos en {time.monotonic() - start:.1f}s (concurrencia {self.concurrency})")
+        return results
+
+    async def run_job(self, job, session):
+        """Recorre una URL (y sus pasos) en un contexto headless y guarda lo capturado"""
+        captures = []
+        error = None
+        lease = None
+        page = None
+        budget = None
+        tracker = ResourceTracker(self.resource_policy)
+        try:
+            if self.use_admission:
+                budget = await admission.acquire(f"lote-{self.batch_id}-{session.id}", self.make_reclaim(lambda: lease), background=True)
+            await self.set_status(session, 'active')
+            lease = await self.pool.acquire(
+                self.browser_type,
+                viewport=settings.PLAYWRIGHT_SETTINGS.get('VIEWPORT_SIZE', {'width': 1280, 'height': 720}),
+                ignore_https_errors=True,
+                locale='es-ES',
+                timezone_id='America/Bogota',
+                service_workers='block' if self.resource_policy.blocks_anything else 'allow',
+            )
+            if budget:
+                budget.attach(lease.context, admission.limits.get('MAX_PAGES', 0))
+            if self.resource_policy.blocks_anything:
+                await lease.context.route('**/*', tracker.handle_route)
+            page_holder = {}
+
+            async def on_push(source, payload):
+                # Solo el documento principal, igual que en las sesiones interactivas
+                page = page_holder.get('page')
+                if page is None or source.get('frame') is not page.main_frame:
+                    return
+                page_holder['detector'].notify_push()
+                if budget:
+                    budget.touch()
+                captures.append(self.build_capture(session, payload, page.url, sequence=len(captures) + 1))
+
+            await lease.context.expose_binding('__dlPush', on_push)
+            await lease.context.add_init_script(DATALAYER_STREAM_SCRIPT)
+            await lease.context.add_init_script(SETTLE_MONITOR_SCRIPT)
+            page = await lease.context.new_page()
+            page_holder['page'] = page
+            detector = page_holder['detector'] = SettleDetector(
+                page,
+                quiet_ms=self.settle_settings.get('QUIET_WINDOW_MS', 300),
+                timeout_ms=self.settle_settings.get('TIMEOUT_MS', 3000),
+                long_request_ms=self.settle_settings.get('LONG_REQUEST_MS', 5000),
+            )
+            navigation_timeout = self.settle_settings.get('NAVIGATION_TIMEOUT_MS', 5000)
+
+            await page.goto(job.url, wait_until='domcontentloaded', timeout=60000)
+            await detector.wait(navigation_timeout)
+            for number, step in enumerate(job.steps, start=1):
+                if budget:
+                    budget.touch()
+                try:
+                    await self.run_step(page, detector, step, navigation_timeout)
+                except Exception as e:
+                    raise RuntimeError(f"Paso {number} ({step['action']}): {e}") from e
+        except Exception as e:
+            error = str(e)
+            logger.warning(f"Lote {self.batch_id}: error en '{job.name}': {error}")
+        finally:
+            if page is not None:
+                try:
+                    await page.close()
+                except Exception:
+                    pass
+            if lease is not None:
+                await self.pool.release(lease)
+            if budget:
+                admission.release(budget)
+
+        await self.finish_job(session, captures, error)
+        report_job_id = await self.enqueue_report(session) if self.generate_reports else None
+        resources = tracker.report()['totals']
+        return BatchResult(
+            session_id=str(session.id),
+            name=job.name,
+            url=job.url,
+            status='error' if error else 'completed',
+            captures=len(captures),
+            valid=sum(1 for capture in captures if capture.is_valid is True),
+            invalid=sum(1 for capture in captures if capture.is_valid is False),
+            report_job_id=report_job_id,
+            error=error,
+            requests_blocked=resources['blocked'],
+            bytes_saved_estimate=resources['bytes_saved_estimate'],
+        )
+
+    def make_reclaim(self, get_lease):
+        """Corrutina ``reclaim(reason)`` para el control de admisión: cierra el contexto del trabajo"""
+        async def reclaim(reason):
+            lease = get_lease()
+            if lease is not None and not lease.released:
+                logger.warning(f"Lote {self.batch_id}: trabajo recuperado ({reason})")
+                await lease.context.close()
+        return reclaim
+
+    async def run_step(self, page, detector, step, navigation_timeout):
+        action = step['action']
+        if action == 'goto':
+            await page.goto(step['url'], wait_until='domcontentloaded', timeout=60000)
+            await detector.wait(navigation_timeout)
+        elif action == 'click':
+            await page.click(step['selector'], timeout=step.get('timeout', 10000))
+            await detector.wait()
+        elif action == 'type':
+            await page.fill(step['selector'], str(step.get('text', '')), timeout=step.get('timeout', 10000))
+            await detector.wait()
+        elif action == 'wait':
+            await asyncio.sleep(float(step.get('ms', 1000)) / 1000)
+
+    def build_capture(self, session, payload, page_url, sequence=0):
+        """Valida un push y crea (sin guardar) su DataLayerCapture"""
+        entry = payload.get('data')
+        if isinstance(entry, dict) and str(entry.get('event', '')).startswith(INTERNAL_EVENT_PREFIXES):
+            valid, errors = None, []
+        elif not self.reference_index:
+            valid, errors = None, ['No hay JSON de referencia.']
+        else:
+            validation = self.reference_index.validate([entry])
+            valid, errors = validation['valid'], validation['errors']
+        url = payload.get('url') or page_url
+        return DataLayerCapture(
+            session=session,
+            url=url[:DataLayerCapture._meta.get_field('url').max_length],
+            data=[entry],
+            offset=payload.get('index', 0),
+            sequence=sequence,
+            is_valid=valid,
+            errors=errors,
+        )
+
+    @database_write_to_async
+    def set_status(self, session, status):
+        session.status = status
+        session.save(update_fields=['status', 'updated_at'])
+
+    @database_write_to_async
+    def finish_job(self, session, captures, error):
+        """Guarda las capturas y cierra la sesión (el reporte se genera fuera del hilo de escritura)"""
+        DataLayerCapture.objects.bulk_create(captures, batch_size=500)
+        session.status = 'error' if error else 'completed'
+        session.save(update_fields=['status', 'updated_at'])
+
+    async def enqueue_report(self, session):
+        """Encola el reporte de la sesión y devuelve el id del trabajo"""
+        job = new_report_job(
+            session.id,
+            {'title': f"Lote {self.batch_id} · {session.description.split(' · ', 1)[-1]}"},
+            reference_events_count=len(self.reference),
+        )
+        try:
+            task = await enqueue_report_job(job)
+        except Exception as e:
+            logger.exception(f"Lote {self.batch_id}: no se pudo encolar el reporte de la sesión {session.id}: {e}")
+            return None
+        if task is not None:
+            self.report_tasks.add(task)
+            task.add_done_callback(self.report_tasks.discard)
+        return job['job_id']
+
+
+async def start_batch(runner, jobs, reference_bytes):
+    """Crea las sesiones del lote y devuelve la tarea que lo ejecuta"""
+    sessions = await runner.create_sessions(jobs, reference_bytes)
+    task = asyncio.create_task(runner.run(jobs, sessions))
+    _running_batches.add(task)
+    task.add_done_callback(_running_batches.discard)
+    return sessions, task
+
+
+_running_batches = set() # Referencias a los lotes lanzados desde la API (evita que el GC los cancele)
+
+
+@database_sync_to_async
+def get_batch_status(batch_id):
+    """Estado de un lote a partir de sus sesiones (por el prefijo de la descripción)"""
+    sessions = Session.objects.filter(description__startswith=f"Lote {batch_id} · ").order_by('created_at').prefetch_related('reports')
+    items = []
+    for session in sessions:
+        report = max(session.reports.all(), key=lambda r: r.created_at, default=None)
+        items.append({
+            'session_id': str(session.id),
+            'name': session.description.split(' · ', 1)[-1],
+            'url': session.url,
+            'status': session.status,
+            'report_id': str(report.id) if report else None,
+            'is_valid': report.is_valid if report else None,
+        })
+    statuses = [item['status'] for item in items]
+    return {
+        'batch_id': batch_id,
+        'total': len(items),
+        'finished': sum(1 for status in statuses if status in ('completed', 'error')),
+        'errors': statuses.count('error'),
+        'sessions': items,
+    }
@@ -0,0 +1,411 @@
+# core/browser_pool.py
+"""
+Pool de navegadores Playwright compartido por todo el proceso.
+
+En lugar de lanzar Playwright y un navegador por cada conexión WebSocket,
+se mantienen navegadores pre-lanzados (agrupados por ``browser_type`` y modo
+headless/con ventana) y a cada sesión se le entrega un ``BrowserContext``
+nuevo. Crear un contexto cuesta ~100 ms frente a los varios segundos de un
+lanzamiento en frío.
+
+Los lanzamientos se hacen fuera del lock del pool: bajo el lock solo se
+reserva el hueco (``_pending``) y luego se registra el navegador, así que un
+lanzamiento lento no retrasa a las sesiones que pueden usar un navegador ya
+abierto ni a las que devuelven su contexto.
+
+El mínimo (``min_size``) solo se mantiene para el navegador y modo por
+defecto; los de otros tipos o modos se cierran tras ``idle_timeout`` sin uso.
+Los navegadores con ventana necesitan un servidor X: si no hay ``DISPLAY`` se
+arranca Xvfb al lanzar el primero y se detiene cuando el pool ya no tiene
+ninguno (ver ``core/display.py``).
+"""
+import asyncio
+import logging
+import os
+import time
+
+from django.conf import settings
+from playwright.async_api import async_playwright
+
+from .display import virtual_display
+from .metrics import BROWSER_LAUNCH_SECONDS, CONTEXT_ACQUIRE_SECONDS, reset_pool_gauges, update_pool_gauges
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_LAUNCH_ARGS = [
+    '--no-sandbox', # Necesario en muchos entornos Docker
+    '--disable-setuid-sandbox', # Alternativa a no-sandbox
+    '--disable-dev-shm-usage', # Evita problemas con /dev/shm pequeño
+    '--disable-gpu', # A menudo innecesario y problemático en Docker/Xvfb
+    '--window-size=1280,720', # Tamaño inicial ventana
+]
+
+
+class PooledBrowser:
+    """Navegador lanzado y gestionado por el pool"""
+
+    def __init__(self, browser, browser_type, headless=False):
+        self.browser = browser
+        self.browser_type = browser_type
+        self.headless = headless
+        self.active_contexts = 0 # Contextos prestados actualmente
+        self.contexts_served = 0 # Contextos creados desde el lanzamiento
+        self.retiring = False # Marcado para reciclar cuando quede libre
+        self.launched_at = time.monotonic()
+        self.last_used = time.monotonic()
+
+    @property
+    def key(self):
+        return (self.browser_type, self.headless)
+
+    def is_healthy(self):
+        try:
+            return self.browser.is_connected()
+        except Exception:
+            return False
+
+    def __repr__(self):
+        return (f"<PooledBrowser {self.browser_type} {'headless' if self.headless else 'con ventana'} activos={self.active_contexts} "
+                f"servidos={self.contexts_served} retirando={self.retiring}>")
+
+
+class BrowserLease:
+    """Contexto prestado a una sesión; se devuelve con ``BrowserPool.release``"""
+
+    def __init__(self, pooled_browser, context):
+        self.pooled_browser = pooled_browser
+        self.context = context
+        self.released = False
+
+    @property
+    def browser(self):
+        return self.pooled_browser.browser
+
+
+class BrowserPool:
+    """
+    Pool de navegadores por tipo con tamaño mínimo/máximo, desalojo por
+    inactividad, chequeo de salud vía ``is_connected()`` y reciclaje tras
+    N contextos servidos.
+    """
+
+    def __init__(self, min_size=1, max_size=2, idle_timeout=300, recycle_after=50,
+                 maintenance_interval=30, launch_timeout=90000, headless=False, name='interactive'):
+        self.name = name # Etiqueta del pool en las métricas
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.idle_timeout = idle_timeout
+        self.recycle_after = recycle_after
+        self.maintenance_interval = maintenance_interval
+        self.launch_timeout = launch_timeout
+        self.headless = headless # Modo por defecto si acquire() no lo indica
+
+        self._playwright = None
+        self._browsers = {} # (browser_type, headless) -> [PooledBrowser]
+        self._pending = {} # (browser_type, headless) -> lanzamientos en curso (huecos reservados)
+        self._uses_display = False # Este pool lanzó navegadores con ventana (Xvfb)
+        self._lock = None
+        self._maintenance_task = None
+
+    @classmethod
+    def from_settings(cls):
+        config = getattr(settings, 'BROWSER_POOL_SETTINGS', {})
+        playwright_config = getattr(settings, 'PLAYWRIGHT_SETTINGS', {})
+        return cls(
+            min_size=config.get('MIN_SIZE', 1),
+            max_size=config.get('MAX_SIZE', 2),
+            idle_timeout=config.get('IDLE_TIMEOUT', 300),
+            recycle_after=config.get('RECYCLE_AFTER', 50),
+            maintenance_interval=config.get('MAINTENANCE_INTERVAL', 30),
+            launch_timeout=config.get('LAUNCH_TIMEOUT', 90000),
+            headless=playwright_config.get('HEADLESS', False),
+        )
+
+    # --------------------- API PÚBLICA ---------------------
+
+    async def acquire(self, browser_type='chromium', headless=None, **context_options):
+        """Presta un contexto nuevo sobre un navegador sano del pool (``headless=None``: modo del pool)"""
+        start = time.perf_counter()
+        key = self._key(browser_type, headless)
+        lock = self._get_lock()
+        async with lock:
+            await self._ensure_started()
+            while True:
+                pooled, launch = self._pick_browser(key)
+                if pooled or launch:
+                    break
+                await lock.wait() # Todo el hueco son lanzamientos en curso: esperar a que acabe uno
+            if pooled:
+                self._check_out(pooled)
+        if launch:
+            pooled = await self._launch_reserved(key, check_out=True)
+
+        try:
+            context = await pooled.browser.new_context(**context_options)
+        except Exception:
+            async with self._get_lock():
+                pooled.active_contexts -= 1
+                # Un fallo al crear contexto suele indicar un navegador roto
+                if not pooled.is_healthy():
+                    pooled.retiring = True
+                await self._close_if_retired(pooled)
+            raise
+
+        CONTEXT_ACQUIRE_SECONDS.labels(browser_type).observe(time.perf_counter() - start)
+        update_pool_gauges(self.name, self.stats())
+        logger.debug(f"Contexto prestado desde {pooled}")
+        return BrowserLease(pooled, context)
+
+    async def release(self, lease):
+        """Cierra el contexto prestado y devuelve la capacidad al pool"""
+        if not lease or lease.released:
+            return
+        lease.released = True
+
+        try:
+            await lease.context.close()
+        except Exception as e:
+            logger.warning(f"Error al cerrar contexto prestado: {e}")
+
+        lock = self._get_lock()
+        async with lock:
+            pooled = lease.pooled_browser
+            pooled.active_contexts = max(0, pooled.active_contexts - 1)
+            pooled.last_used = time.monotonic()
+            await self._close_if_retired(pooled)
+            lock.notify_all() # Puede haber quedado hueco para quien espera un lanzamiento
+        update_pool_gauges(self.name, self.stats())
+        logger.debug(f"Contexto devuelto a {pooled}")
+
+    async def warm_up(self, browser_type=None, headless=None):
+        """Pre-lanza navegadores hasta alcanzar ``min_size``"""
+        browser_type = browser_type or getattr(settings, 'PLAYWRIGHT_SETTINGS', {}).get('DEFAULT_BROWSER', 'chromium')
+        key = self._key(browser_type, headless)
+        try:
+            async with self._get_lock():
+                await self._ensure_started()
+                missing = self._reserve(key, min(self.min_size, self.max_size))
+            for _ in range(missing):
+                await self._launch_reserved(key)
+        except Exception as e:
+            # No es crítico: acquire() lanzará el navegador si hace falta
+            logger.error(f"Error al pre-lanzar navegadores {browser_type}: {e}")
+
+    async def shutdown(self):
+        """Cierra todos los navegadores y detiene Playwright"""
+        if self._maintenance_task:
+            self._maintenance_task.cancel()
+            self._maintenance_task = None
+        async with self._get_lock():
+            for (browser_type, headless), browsers in self._browsers.items():
+                for pooled in browsers:
+                    await self._close_browser(pooled)
+                reset_pool_gauges(self.name, browser_type, headless)
+            self._browsers = {}
+            await self._release_display()
+            if self._playwright:
+                try:
+                    await self._playwright.stop()
+                except Exception as e:
+                    logger.error(f"Error al detener Playwright del pool: {e}")
+                self._playwright = None
+        logger.info("Pool de navegadores detenido")
+
+    def stats(self):
+        """Resumen del estado del pool por tipo de navegador y modo (``chromium/headless``...)"""
+        return {
+            f"{browser_type}/{'headless' if headless else 'headful'}": {
+                'browser_type': browser_type,
+                'headless': headless,
+                'browsers': len(browsers),
+                'active_contexts': sum(p.active_contexts for p in browsers),
+                'retiring': sum(1 for p in browsers if p.retiring),
+            }
+            for (browser_type, headless), browsers in self._browsers.items()
+        }
+
+    # --------------------- FUNCIONES INTERNAS ---------------------
+
+    def _get_lock(self):
+        # El lock se crea dentro del event loop que usa el pool; es una Condition para
+        # poder esperar a que termine un lanzamiento en curso
+        if self._lock is None:
+            self._lock = asyncio.Condition()
+        return self._lock
+
+    async def _ensure_started(self):
+        if self._playwright is None:
+            logger.info("Iniciando Playwright para el pool de navegadores...")
+            self._playwright = await async_playwright().start()
+        if self._maintenance_task is None or self._maintenance_task.done():
+            self._maintenance_task = asyncio.create_task(self._maintenance_loop())
+
+    async def _release_display(self):
+        # Solo el pool que lo pidió lo detiene (el de lotes, headless, no toca el de las sesiones)
+        if self._uses_display:
+            self._uses_display = False
+            await virtual_display.stop()
+
+    def _key(self, browser_type, headless=None):
+        return (browser_type, self.headless if headless is None else bool(headless))
+
+    def _default_key(self):
+        """Tipo y modo por defecto: el único para el que se mantiene ``min_size``"""
+        return self._key(getattr(settings, 'PLAYWRIGHT_SETTINGS', {}).get('DEFAULT_BROWSER', 'chromium'))
+
+    def _healthy(self, key):
+        """Purga navegadores desconectados y devuelve la lista del tipo y modo"""
+        browsers = self._browsers.setdefault(key, [])
+        for pooled in [p for p in browsers if not p.is_healthy()]:
+            logger.warning(f"Navegador desconectado eliminado del pool: {pooled}")
+            browsers.remove(pooled)
+        return browsers
+
+    def _pick_browser(self, key):
+        """
+        Con el lock tomado: ``(navegador, False)`` si hay uno utilizable, ``(None, True)``
+        si hay que lanzar uno (el hueco queda reservado) o ``(None, False)`` si hay que
+        esperar a un lanzamiento en curso.
+        """
+        browsers = self._healthy(key)
+        pending = self._pending.get(key, 0)
+        candidates = [p for p in browsers if not p.retiring]
+        idle = [p for p in candidates if p.active_contexts == 0]
+        if idle:
+            return idle[0], False
+        if len(browsers) + pending < self.max_size:
+            self._pending[key] = pending + 1
+            return None, True
+        if candidates:
+            # Pool lleno: compartir el navegador menos cargado
+            return min(candidates, key=lambda p: p.active_contexts), False
+        if pending:
+            return None, False
+        # Todos retirándose y sin hueco: lanzar uno extra que reemplazará al reciclado
+        self._pending[key] = 1
+        return None, True
+
+    def _reserve(self, key, target):
+        """Con el lock tomado: reserva los lanzamientos que faltan para llegar a ``target``"""
+        missing = max(0, target - len(self._healthy(key)) - self._pending.get(key, 0))
+        if missing:
+            self._pending[key] = self._pending.get(key, 0) + missing
+        return missing
+
+    def _check_out(self, pooled):
+        """Con el lock tomado: cuenta un contexto más prestado desde ``pooled``"""
+        pooled.active_contexts += 1
+        pooled.contexts_served += 1
+        pooled.last_used = time.monotonic()
+        if self.recycle_after and pooled.contexts_served >= self.recycle_after:
+            logger.info(f"Navegador {pooled} alcanzó {pooled.contexts_served} contextos, se reciclará al liberarse")
+            pooled.retiring = True
+
+    async def _launch_reserved(self, key, check_out=False):
+        """Lanza (sin el lock) el navegador de un hueco reservado y lo registra en el pool"""
+        lock = self._get_lock()
+        try:
+            pooled = await self._launch(*key)
+        except BaseException:
+            async with lock:
+                self._pending[key] -= 1
+                lock.notify_all()
+            raise
+        async with lock:
+            self._pending[key] -= 1
+            lock.notify_all()
+            if self._playwright is None:
+                # El pool se detuvo durante el lanzamiento
+                await self._close_browser(pooled)
+                raise RuntimeError("El pool de navegadores se detuvo durante el lanzamiento")
+            self._browsers.setdefault(key, []).append(pooled)
+            if check_out:
+                self._check_out(pooled)
+        return pooled
+
+    async def _launch(self, browser_type, headless):
+        launch_options = {
+            'headless': headless,
+            'args': list(DEFAULT_LAUNCH_ARGS),
+            # Timeout más largo para el lanzamiento por si el sistema está lento
+            'timeout': self.launch_timeout,
+        }
+        if not headless:
+            # Con ventana: DISPLAY del sistema o un Xvfb arrancado ahora
+            launch_options['env'] = dict(os.environ, DISPLAY=await virtual_display.ensure())
+            self._uses_display = True
+        start = time.monotonic()
+        logger.info(f"Lanzando navegador {browser_type} para el pool (headless={headless})...")
+        if browser_type == 'firefox':
+            browser = await self._playwright.firefox.launch(**launch_options)
+        elif browser_type == 'webkit':
+            # Webkit no acepta los flags de Chromium
+            launch_options['args'] = []
+            browser = await self._playwright.webkit.launch(**launch_options)
+        else: # Chromium por defecto
+            browser = await self._playwright.chromium.launch(**launch_options)
+        BROWSER_LAUNCH_SECONDS.labels(browser_type).observe(time.monotonic() - start)
+        logger.info(f"Navegador {browser_type} lanzado en {time.monotonic() - start:.2f}s")
+        return PooledBrowser(browser, browser_type, headless)
+
+    async def _close_if_retired(self, pooled):
+        if pooled.active_contexts > 0:
+            return
+        if pooled.retiring or not pooled.is_healthy():
+            browsers = self._browsers.get(pooled.key, [])
+            if pooled in browsers:
+                browsers.remove(pooled)
+            await self._close_browser(pooled)
+
+    async def _close_browser(self, pooled):
+        try:
+            if pooled.is_healthy():
+                await pooled.browser.close()
+            logger.info(f"Navegador cerrado por el pool: {pooled}")
+        except Exception as e:
+            logger.error(f"Error al cerrar navegador del pool: {e}")
+
+    async def _maintain(self):
+        """Desaloja navegadores inactivos, repone el mínimo del tipo por defecto y olvida los tipos vacíos"""
+        missing = 0
+        async with self._get_lock():
+            now = time.monotonic()
+            default_key = self._default_key()
+            min_size = min(self.min_size, self.max_size)
+            for key in list(self._browsers):
+                browsers = self._healthy(key)
+                keep = min_size if key == default_key else 0
+                idle = [p for p in browsers if p.active_contexts == 0]
+                # Desalojar los más antiguos por encima del mínimo
+                for pooled in sorted(idle, key=lambda p: p.last_used):
+                    if len(browsers) <= keep and not pooled.retiring:
+                        break
+                    if pooled.retiring or now - pooled.last_used >= self.idle_timeout:
+                        browsers.remove(pooled)
+                        await self._close_browser(pooled)
+                if not browsers and not self._pending.get(key):
+                    del self._browsers[key]
+                    reset_pool_gauges(self.name, *key)
+            if self._playwright is not None:
+                missing = self._reserve(default_key, min_size)
+            if not any(headless is False for _, headless in (*self._browsers, *(k for k, n in self._pending.items() if n))):
+                # Sin navegadores con ventana (ni lanzándose) el Xvfb propio sobra
+                await self._release_display()
+        for _ in range(missing):
+            await self._launch_reserved(default_key)
+        update_pool_gauges(self.name, self.stats())
+
+    async def _maintenance_loop(self):
+        while True:
+            try:
+                await asyncio.sleep(self.maintenance_interval)
+                await self._maintain()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Error en mantenimiento del pool de navegadores: {e}")
+
+
+# Pool compartido por todos los consumers del proceso
+browser_pool = BrowserPool.from_settings()
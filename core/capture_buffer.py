@@ -0,0 +1,100 @@
+# core/capture_buffer.py
+"""
+Buffer de escritura diferida para las capturas de DataLayer.
+
+Cada push genera un ``DataLayerCapture`` en memoria (con su UUID ya asignado,
+así que el cliente recibe un id estable al instante). El buffer los inserta
+con ``bulk_create`` cada N capturas o cada T milisegundos, lo que ocurra
+antes, y se vacía también al desconectar o detener la sesión.
+
+Si un lote falla se reintenta (``max_retries`` veces, con espera creciente);
+si sigue fallando se descarta y se avisa con ``on_lost``, porque el cliente
+ya recibió los ids de esas capturas.
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CaptureBuffer:
+    """Agrupa capturas por sesión y las guarda por lotes"""
+
+    def __init__(self, session_id, flush_func, max_batch=50, max_delay_ms=500, max_retries=2, retry_delay_ms=200, on_lost=None):
+        self.session_id = session_id
+        self.flush_func = flush_func # Corrutina (lista de capturas) -> None
+        self.on_lost = on_lost # Corrutina (lista de capturas, excepción) -> None para lotes descartados
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max(0, max_delay_ms) / 1000
+        self.max_retries = max(0, max_retries)
+        self.retry_delay = max(0, retry_delay_ms) / 1000
+        self.pending = []
+        self.flushed_count = 0
+        self.lost_count = 0
+        self._timer = None
+        self._flush_task = None # Vaciado lanzado al llenarse un lote (referencia para que el GC no lo cancele)
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, capture):
+        """Añade una captura sin guardar; programa el vaciado si hace falta"""
+        self.pending.append(capture)
+        if len(self.pending) >= self.max_batch:
+            self._cancel_timer()
+            # Si ya hay un vaciado en curso, recoge lo nuevo al terminar su lote
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.create_task(self.flush())
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        """Guarda todo lo pendiente (en orden, un lote cada vez)"""
+        async with self._lock:
+            while self.pending:
+                batch, self.pending = self.pending, []
+                await self._save(batch)
+
+    async def _save(self, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.flush_func(batch)
+                self.flushed_count += len(batch)
+                logger.debug(f"Lote de {len(batch)} capturas guardado para sesión {self.session_id}")
+                return
+            except Exception as e:
+                error = e
+                if attempt < self.max_retries:
+                    logger.warning(f"Error guardando lote de {len(batch)} capturas para sesión {self.session_id} (intento {attempt + 1}): {e}")
+                    await asyncio.sleep(self.retry_delay * (attempt + 1))
+
+        self.lost_count += len(batch)
+        logger.error(f"Lote de {len(batch)} capturas descartado para sesión {self.session_id} tras {self.max_retries + 1} intentos: {error}")
+        if self.on_lost:
+            try:
+                await self.on_lost(batch, error)
+            except Exception as e:
+                logger.warning(f"No se pudo avisar de las capturas perdidas en sesión {self.session_id}: {e}")
+
+    async def close(self):
+        """Cancela el temporizador y vacía el buffer"""
+        self._cancel_timer()
+        if self._flush_task is not None:
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
+        logger.info(f"Buffer de capturas cerrado para sesión {self.session_id}: {self.flushed_count} guardadas, {self.lost_count} perdidas")
+
+    def _cancel_timer(self):
+        if self._timer is not None and not self._timer.done():
+            self._timer.cancel()
+        self._timer = None
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.max_delay)
+        except asyncio.CancelledError:
+            return
+        self._timer = None
+        await self.flush()
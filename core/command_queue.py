@@ -0,0 +1,225 @@
+# core/command_queue.py
+"""
+Cola de comandos por sesión.
+
+El consumer ya no espera a cada handler dentro de ``receive``: las acciones
+que usan el navegador se encolan y las ejecuta, de una en una, una tarea de
+fondo de la sesión. Así un ``goto`` lento no bloquea lo que venga detrás:
+
+- las acciones de control y estado (``IMMEDIATE_ACTIONS``: ``session stop``,
+  ``validation check``, ``cancel``...) se atienden en el acto;
+- las del navegador se ordenan por prioridad (``PRIORITIES``) y, a igual
+  prioridad, por orden de llegada;
+- las ráfagas se agrupan: un clic, una captura o un ``goto`` pendientes se
+  sustituyen por el más reciente del mismo tipo (``coalesce_key``);
+- ``cancel`` aborta el comando en curso (y con ``all`` también los pendientes).
+
+Cada cambio de estado se comunica al cliente con un mensaje ``command``
+(``queued``, ``coalesced``, ``started``, ``done``, ``cancelled``,
+``failed``) que incluye la profundidad de la cola y el tiempo de espera.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from .metrics import COMMAND_WAIT_SECONDS, COMMANDS, action_label
+
+logger = logging.getLogger(__name__)
+
+# Acciones que no tocan el navegador o que deben poder interrumpir a las demás
+IMMEDIATE_ACTIONS = ('session', 'validation', 'report', 'live_view', 'cancel', 'resource_policy')
+
+# Menor valor = antes. Las acciones sin entrada usan DEFAULT_PRIORITY
+PRIORITIES = {
+    'init': 0,
+    'navigation': 1,
+    'interaction': 2,
+    'screencast': 2,
+    'capture': 3,
+}
+DEFAULT_PRIORITY = 2
+
+
+class CommandQueueFull(Exception):
+    """La sesión tiene demasiados comandos pendientes"""
+
+
+def coalesce_key(action, data):
+    """Clave de agrupación: un comando pendiente con la misma clave se sustituye por el nuevo"""
+    command = data.get('command')
+    if action == 'interaction' and command == 'click':
+        return 'interaction:click'
+    if action == 'interaction' and command == 'type':
+        # 'type' vacía el campo antes de escribir: solo cuenta el último texto
+        return f"interaction:type:{data.get('selector')}"
+    if action == 'capture':
+        return f'capture:{command}'
+    if action == 'navigation' and command in ('goto', 'reload'):
+        return f'navigation:{command}'
+    return None
+
+
+class Command:
+    """Comando pendiente o en curso"""
+
+    def __init__(self, command_id, action, data, priority, key):
+        self.id = command_id
+        self.action = action
+        self.data = data
+        self.priority = priority
+        self.key = key
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.cancelled = False
+
+    def wait_ms(self):
+        end = self.started_at or time.monotonic()
+        return int((end - self.enqueued_at) * 1000)
+
+
+class CommandQueue:
+    """Ejecuta en serie los comandos del navegador de una sesión"""
+
+    def __init__(self, execute, notify, max_depth=50):
+        self.execute = execute # Corrutina execute(action, data)
+        self.notify = notify # Corrutina notify(mensaje) hacia el cliente
+        self.max_depth = max_depth
+        self.pending = [] # heap de (prioridad, secuencia, Command)
+        self.by_key = {} # clave de agrupación -> Command pendiente
+        self.current = None
+        self._current_task = None
+        self._worker = None
+        self._wakeup = asyncio.Event()
+        self._sequence = itertools.count()
+        self._ids = itertools.count(1)
+
+    @staticmethod
+    def is_immediate(action):
+        return action in IMMEDIATE_ACTIONS
+
+    async def submit(self, action, data):
+        """Encola un comando (o actualiza el pendiente equivalente) y devuelve su ``Command``"""
+        command_id = str(data.get('id') or f'c{next(self._ids)}')
+        key = coalesce_key(action, data)
+        previous = self.by_key.get(key) if key else None
+        if previous:
+            # Conserva su sitio en la cola con los datos del comando más reciente
+            replaced_id = previous.id
+            previous.id, previous.data = command_id, data
+            COMMANDS.labels(action_label(action), 'coalesced').inc()
+            await self._notify(previous, 'coalesced', replaced=replaced_id)
+            return previous
+
+        if len(self.pending) >= self.max_depth:
+            COMMANDS.labels(action_label(action), 'rejected').inc()
+            raise CommandQueueFull(f"Demasiados comandos pendientes ({len(self.pending)})")
+
+        command = Command(command_id, action, data, PRIORITIES.get(action, DEFAULT_PRIORITY), key)
+        heapq.heappush(self.pending, (command.priority, next(self._sequence), command))
+        if key:
+            self.by_key[key] = command
+        self._ensure_worker()
+        self._wakeup.set()
+        if self.current or len(self.pending) > 1:
+            await self._notify(command, 'queued')
+        return command
+
+    async def cancel(self, all_pending=False):
+        """Aborta el comando en curso y, con ``all_pending``, vacía la cola. Devuelve cuántos se cancelaron"""
+        dropped = []
+        if all_pending:
+            dropped = [command for _, _, command in self.pending]
+            self.pending.clear()
+            self.by_key.clear()
+        cancelled = len(dropped)
+        if self.current and not self.current.cancelled:
+            self.current.cancelled = True
+            if self._current_task and not self._current_task.done():
+                self._current_task.cancel()
+            cancelled += 1
+        for command in dropped:
+            command.cancelled = True
+            COMMANDS.labels(action_label(command.action), 'cancelled').inc()
+            await self._notify(command, 'cancelled')
+        return cancelled
+
+    async def stop(self):
+        """Cancela todo y detiene la tarea de fondo (al liberar la sesión)"""
+        self.pending.clear()
+        self.by_key.clear()
+        for task in (self._current_task, self._worker):
+            if task and not task.done() and task is not asyncio.current_task():
+                task.cancel()
+        self._worker = None
+
+    def stats(self):
+        oldest = min((command.enqueued_at for _, _, command in self.pending), default=None)
+        return {
+            'depth': len(self.pending),
+            'running': self.current.action if self.current else None,
+            'oldest_wait_ms': int((time.monotonic() - oldest) * 1000) if oldest else 0,
+        }
+
+    # --------------------- FUNCIONES INTERNAS ---------------------
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            _, _, command = heapq.heappop(self.pending)
+            if command.key and self.by_key.get(command.key) is command:
+                del self.by_key[command.key]
+            if command.cancelled:
+                continue
+
+            self.current = command
+            command.started_at = time.monotonic()
+            COMMAND_WAIT_SECONDS.labels(action_label(command.action)).observe(command.started_at - command.enqueued_at)
+            await self._notify(command, 'started')
+
+            try:
+                if command.cancelled:
+                    raise asyncio.CancelledError() # Cancelado antes de empezar
+                self._current_task = asyncio.create_task(self.execute(command.action, command.data))
+                await self._current_task
+                status = 'done'
+            except asyncio.CancelledError:
+                if not command.cancelled:
+                    # Se detiene la cola entera, no solo este comando
+                    if self._current_task:
+                        self._current_task.cancel()
+                    raise
+                status = 'cancelled'
+            except Exception as e:
+                logger.exception(f"Error ejecutando el comando {command.action} ({command.id}): {e}")
+                status = 'failed'
+            finally:
+                self.current = None
+                self._current_task = None
+
+            COMMANDS.labels(action_label(command.action), status).inc()
+            await self._notify(command, status, duration_ms=int((time.monotonic() - command.started_at) * 1000))
+
+    async def _notify(self, command, status, **extra):
+        message = {
+            'action': 'command',
+            'id': command.id,
+            'command': command.action,
+            'status': status,
+            'depth': len(self.pending),
+            'wait_ms': command.wait_ms(),
+            **extra,
+        }
+        try:
+            await self.notify(message)
+        except Exception as e:
+            logger.debug(f"No se pudo notificar el estado del comando {command.id}: {e}")
@@ -4,6 +4,7 @@ import json
 import asyncio
 import base64
 from io import BytesIO
+from collections import deque
 from datetime import datetime
 import logging
 import re
@@ -12,24 +13,40 @@ from urllib.parse import urlparse
 import traceback # Importar traceback para logs detallados
 
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
 from django.conf import settings
 from django.core.files.base import ContentFile
+from django.db.models import Count, Max, Q
 from django.utils import timezone
-from django.urls import reverse
 
-from playwright.async_api import async_playwright
 import jsonschema
 
-from .models import Session, Screenshot, DataLayerCapture, Report
-
-# Eliminar si no usas estas clases directamente aquí (parece que no)
-# from validator.validator.datalayer_validator import DataLayerValidator
-# from validator.parser.schema_builder import SchemaBuilder
+from .models import Session, Screenshot, DataLayerCapture
+from .browser_pool import browser_pool
+from .db import database_sync_to_async, database_write_to_async
+from .metrics import (
+    ACTION_SECONDS, DATALAYER_SECONDS, PAGE_GOTO_SECONDS, SCREENSHOT_SECONDS,
+    WEBSOCKET_CONNECTIONS, WEBSOCKET_MESSAGES, action_label, timer,
+)
+from .screenshot_pipeline import ScreenshotWriter
+from .capture_buffer import CaptureBuffer
+from .report_jobs import new_report_job, enqueue_report_job
+from .live_view import encode_frame, PersistPolicy, PERSIST_ALL, PERSIST_EVENTS
+from .screencast import Screencast
+from .settle import SettleDetector, SETTLE_MONITOR_SCRIPT
+from .command_queue import CommandQueue, CommandQueueFull
+from .macros import MacroRun, MacroError, parse_macro
+from .resource_policy import ResourcePolicy, ResourcePolicyError, ResourceTracker
+from .datalayer_stream import DATALAYER_STREAM_SCRIPT, INTERNAL_EVENT_PREFIXES
+from .interaction import INTERACTION_RUNTIME_SCRIPT, CLICK_MODE_MOUSE, CLICK_MODE_RUNTIME, CLICK_MODES, click_in_page
+from .workers import worker_registry, RELAY_CLOSE_CODE
+from .session_registry import session_registry, get_session_settings
+from .admission import admission, AdmissionError, RECLAIM_CLOSE_CODE, REJECT_CLOSE_CODE
+from validator.validator import ReferenceIndex
 
 # Configurar logger
 logger = logging.getLogger(__name__)
 
+
 class SessionConsumer(AsyncWebsocketConsumer):
     """
     Consumer WebSocket para manejar sesiones de validación de DataLayers
@@ -48,17 +65,70 @@ class SessionConsumer(AsyncWebsocketConsumer):
         )
 
         # Inicializar variables
-        self.playwright = None
+        self.browser_lease = None # Contexto prestado por el pool de navegadores
         self.browser = None
         self.context = None
         self.page = None
         self.capture_interval = None # Podrías implementar captura periódica aquí
         self.session_obj = None
+        self.capture_sequence = 0 # Última secuencia de captura asignada en la sesión
         self.reference_datalayers = None # Para almacenar el JSON parseado
+        self.reference_index = ReferenceIndex() # Referencia compilada e indexada por evento
         self.datalayer_schema = None # Podrías usarlo si quieres validación más profunda
+        self.datalayer_push_lock = asyncio.Lock() # Serializa los pushes recibidos por streaming
+        self.push_listeners = [] # Callbacks por push procesado (p. ej. la macro en curso)
+        self.counts = {'screenshots': 0, 'datalayers': 0, 'valid': 0, 'invalid': 0} # Contadores en memoria
+        # Inserción por lotes de las capturas de DataLayer
+        self.capture_buffer = CaptureBuffer(
+            self.session_id,
+            self.save_datalayers,
+            max_batch=settings.DB_ASYNC_SETTINGS.get('CAPTURE_BATCH_SIZE', 50),
+            max_delay_ms=settings.DB_ASYNC_SETTINGS.get('CAPTURE_FLUSH_MS', 500),
+            max_retries=settings.DB_ASYNC_SETTINGS.get('CAPTURE_FLUSH_RETRIES', 2),
+            on_lost=self.report_lost_datalayers
+        )
+        # Guardado de screenshots en segundo plano con cola acotada
+        self.screenshot_writer = ScreenshotWriter(
+            self.session_id,
+            self.save_screenshot,
+            max_queue=settings.PLAYWRIGHT_SETTINGS.get('SCREENSHOT_QUEUE_SIZE', 4)
+        )
+        # Vista en vivo: capturas como frames binarios y persistencia opcional
+        self.live_view = False
+        self.frame_seq = 0
+        self.persist_policy = PersistPolicy(PERSIST_ALL)
+        self.pushes_since_screenshot = 0 # Pushes del dataLayer desde la última captura
+        self.screencast = None # Screencast de DevTools (solo Chromium)
+        self.settle_detector = None # Detecta cuándo la página queda estable tras una acción
+        self.settle_settings = getattr(settings, 'SETTLE_SETTINGS', {})
+        self.interaction_settings = getattr(settings, 'INTERACTION_SETTINGS', {})
+        # Bloqueo de recursos: política de la sesión y cuenta por página (ver core/resource_policy.py)
+        self.resource_tracker = None
+        self.resource_route_installed = False
+        # Multi-proceso: canal del dueño si otro consumer tiene el navegador de la sesión
+        self.relay_to = None
+        self.relay_holder = None # Holder en este mismo proceso (sin pasar por la capa de canales)
+        self.relay_channels = set() # Relays remotos a los que se reenvía lo que se envía al cliente
+        self.local_relays = set() # Relays de este proceso
+        self.owns_session = False
+        # Reconexión: el navegador sobrevive al socket durante el periodo de gracia
+        self.detached = False
+        self.mailbox_task = None
+        self.missed = deque(maxlen=get_session_settings().get('CATCH_UP_MAX', 1000)) # Mensajes no entregados
+        self.missed_total = 0
+        # Control de admisión: hueco en el semáforo de sesiones con navegador
+        self.admission_budget = None
+        self.admission_task = None
+        # Acciones del navegador en serie, en segundo plano (ver core/command_queue.py)
+        self.command_queue = CommandQueue(
+            self.run_queued_action,
+            self.send_command_status,
+            max_depth=get_session_settings().get('COMMAND_QUEUE_MAX', 50)
+        )
 
         # Aceptar la conexión
         await self.accept()
+        WEBSOCKET_CONNECTIONS.inc()
         logger.info(f"Conexión WebSocket aceptada para sesión: {self.session_id}")
 
         # Cargar la sesión desde la base de datos
@@ -70,9 +140,24 @@ class SessionConsumer(AsyncWebsocketConsumer):
                 await self.close()
                 return
 
+            # Un solo navegador por sesión: si ya tiene dueño (en este u otro worker), hacer de relay
+            owner = await worker_registry.claim_session(self.session_id, self.channel_name)
+            if owner:
+                await self.start_relay(owner)
+                return
+            self.owns_session = True
+            session_registry.register(self)
+
+            # Ir pre-lanzando el navegador del pool mientras se carga la referencia
+            browser_type = os.environ.get('PLAYWRIGHT_BROWSER', self.session_obj.browser_type)
+            asyncio.create_task(browser_pool.warm_up(browser_type, headless=self.use_headless()))
+
             # Cargar y parsear el JSON de referencia
             await self.load_reference_json()
 
+            # Contadores previos de la sesión (antes de que el navegador genere capturas nuevas)
+            self.counts = await self.load_counts()
+
         except Exception as e:
             logger.exception(f"Error durante la conexión/carga de sesión {self.session_id}: {str(e)}")
             await self.send_error_message(f'Error al cargar la sesión: {str(e)}')
@@ -93,14 +178,26 @@ class SessionConsumer(AsyncWebsocketConsumer):
     async def disconnect(self, close_code):
         """Cierra la conexión y libera recursos"""
         logger.info(f"Desconectando WebSocket para sesión {self.session_id}, código: {close_code}")
+        WEBSOCKET_CONNECTIONS.dec()
 
         # Detener la captura automática si está activa
         # (No implementado en este código, pero sería aquí)
         # if self.capture_interval:
         #     self.capture_interval.cancel()
 
-        # Cerrar el navegador Playwright
-        await self.close_browser()
+        if self.relay_to:
+            if self.relay_holder:
+                await self.relay_holder.detach_relay(self)
+            else:
+                await self.channel_layer.send(self.relay_to, {'type': 'relay.detach', 'channel': self.channel_name})
+        elif self.owns_session and self.browser and session_registry.grace_seconds > 0:
+            # El navegador sobrevive a la desconexión durante el periodo de gracia
+            await self.detach()
+        else:
+            # Salir de la cola de admisión si aún se esperaba turno
+            if self.admission_task and not self.admission_task.done():
+                self.admission_task.cancel()
+            await self.release_session_resources()
 
         # Abandonar el grupo de Channels
         await self.channel_layer.group_discard(
@@ -113,20 +210,63 @@ class SessionConsumer(AsyncWebsocketConsumer):
     async def receive(self, text_data):
         """Procesa los mensajes recibidos del cliente"""
         logger.debug(f"Mensaje recibido para sesión {self.session_id}: {text_data}")
+        if self.relay_holder:
+            await self.relay_holder.receive(text_data=text_data)
+            return
+        if self.relay_to:
+            await self.channel_layer.send(self.relay_to, {'type': 'relay.input', 'text': text_data})
+            return
         try:
             data = json.loads(text_data)
             action = data.get('action')
 
+            WEBSOCKET_MESSAGES.labels('in', action_label(action)).inc()
             if not action:
                 await self.send_error_message('Acción no especificada en el mensaje')
                 return
 
+            if self.admission_budget:
+                self.admission_budget.touch()
+
+            # Control y estado en el acto; lo que usa el navegador, a la cola de la sesión
+            if self.command_queue.is_immediate(action):
+                await self.run_action(action, data)
+            else:
+                await self.command_queue.submit(action, data)
+
+        except json.JSONDecodeError:
+            logger.error("Error al decodificar JSON recibido")
+            await self.send_error_message('Formato JSON inválido recibido')
+        except CommandQueueFull as e:
+            await self.send_error_message(f'{e}. Espera a que terminen o envía "cancel".')
+        except Exception as e:
+            logger.exception(f"Error al procesar mensaje para sesión {self.session_id}: {str(e)}")
+            await self.send_error_message(f'Error interno al procesar mensaje: {str(e)}')
+
+
+    async def run_queued_action(self, action, data):
+        """Ejecuta una acción desde la cola de comandos: los errores llegan a la cola (estado ``failed``)"""
+        await self.run_action(action, data, queued=True)
+
+    async def run_action(self, action, data, queued=False):
+        """
+        Ejecuta una acción: en el acto (control y estado) o desde la cola de comandos.
+        (No es ``dispatch``: ese nombre lo usa Channels para enrutar los mensajes del consumer.)
+        """
+        try:
             # Asegurarse que el navegador esté inicializado para acciones que lo requieran
-            required_actions = ['navigation', 'capture', 'interaction', 'validation', 'report']
+            # (validation y report trabajan con los contadores y la BD: no esperan al navegador)
+            required_actions = ['navigation', 'capture', 'interaction', 'macro']
             # Init ahora no necesita navegador pre-inicializado
             # if action == 'init' and not self.browser:
             #    pass # Permitir init sin navegador
 
+            if action in required_actions and not self.browser and not self.admission_budget:
+                # Sin hueco todavía: pedir turno y descartar la acción
+                self.request_admission()
+                await self.send_error_message("La sesión está esperando un navegador libre; repite la acción cuando esté lista.")
+                return
+
             if action in required_actions and not self.browser:
                 logger.warning(f"Acción '{action}' recibida pero el navegador no está inicializado. Intentando inicializar...")
                 await self.initialize_browser()
@@ -136,29 +276,38 @@ class SessionConsumer(AsyncWebsocketConsumer):
 
             # Procesar según el tipo de acción
             handler_method = getattr(self, f'handle_{action}', None)
-            if handler_method and callable(handler_method):
-                await handler_method(data)
-            else:
-                # Manejar 'session' explícitamente si no tiene su propio handler
-                if action == 'session':
-                    await self.handle_session_action(data)
+            with timer(ACTION_SECONDS, action_label(action)):
+                if handler_method and callable(handler_method):
+                    await handler_method(data)
                 else:
-                    logger.warning(f"Acción desconocida recibida: {action}")
-                    await self.send_error_message(f'Acción desconocida: {action}')
+                    # Manejar 'session' explícitamente si no tiene su propio handler
+                    if action == 'session':
+                        await self.handle_session_action(data)
+                    else:
+                        logger.warning(f"Acción desconocida recibida: {action}")
+                        await self.send_error_message(f'Acción desconocida: {action}')
 
-        except json.JSONDecodeError:
-            logger.error("Error al decodificar JSON recibido")
-            await self.send_error_message('Formato JSON inválido recibido')
         except Exception as e:
-            logger.exception(f"Error al procesar mensaje para sesión {self.session_id}: {str(e)}")
             await self.send_error_message(f'Error interno al procesar mensaje: {str(e)}')
+            if queued:
+                raise # La cola lo registra y notifica el comando como 'failed'
+            logger.exception(f"Error al procesar mensaje para sesión {self.session_id}: {str(e)}")
 
 
     # --------------------- MANEJADORES DE ACCIONES ---------------------
 
-    async def handle_init(self, data=None): # data no se usa pero lo mantenemos por consistencia
+    async def handle_init(self, data=None):
         """Inicializa la sesión y envía el estado actual"""
         logger.info(f"Manejando acción 'init' para sesión {self.session_id}")
+        data = data or {}
+        if data.get('live_view'):
+            self.configure_live_view(True, data.get('persist'))
+
+        # Esperar turno antes de lanzar el navegador (la cola no bloquea el consumer)
+        if not self.admission_budget:
+            self.request_admission(data)
+            return
+
         # Inicializar el navegador si no lo está ya
         if not self.browser:
             await self.initialize_browser()
@@ -166,18 +315,18 @@ class SessionConsumer(AsyncWebsocketConsumer):
                 return
 
         # Enviar estado actual
-        screenshots_count = await self.get_screenshots_count()
-        datalayers_count = await self.get_datalayers_count()
-        valid_count, invalid_count = await self.get_validation_stats()
+        counts = self.get_counts()
 
         await self.send(text_data=json.dumps({
             'action': 'status',
             'current_url': self.page.url if self.page else self.session_obj.url, # Usa la URL real si la página existe
-            'screenshot_count': screenshots_count,
-            'datalayer_count': datalayers_count,
-            'valid_count': valid_count,
-            'invalid_count': invalid_count,
-            'session_status': self.session_obj.status
+            'screenshot_count': counts['screenshots'],
+            'datalayer_count': counts['datalayers'],
+            'valid_count': counts['valid'],
+            'invalid_count': counts['invalid'],
+            'session_status': self.session_obj.status,
+            'headless': self.use_headless(),
+            'resource_policy': self.resource_tracker.policy.preset if self.resource_tracker else self.session_obj.resource_policy,
         }))
         logger.info(f"Estado inicial enviado para sesión {self.session_id}")
 
@@ -199,16 +348,20 @@ class SessionConsumer(AsyncWebsocketConsumer):
 
         try:
             if command == 'back':
-                await self.page.go_back(wait_until='domcontentloaded', timeout=30000)
+                with timer(PAGE_GOTO_SECONDS, 'back'):
+                    await self.page.go_back(wait_until='domcontentloaded', timeout=30000)
             elif command == 'forward':
-                await self.page.go_forward(wait_until='domcontentloaded', timeout=30000)
+                with timer(PAGE_GOTO_SECONDS, 'forward'):
+                    await self.page.go_forward(wait_until='domcontentloaded', timeout=30000)
             elif command == 'reload':
-                await self.page.reload(wait_until='domcontentloaded', timeout=30000)
+                with timer(PAGE_GOTO_SECONDS, 'reload'):
+                    await self.page.reload(wait_until='domcontentloaded', timeout=30000)
             elif command == 'goto':
                 url = data.get('url')
                 if url:
                     logger.info(f"Navegando a: {url}")
-                    await self.page.goto(url, wait_until='domcontentloaded', timeout=60000)
+                    with timer(PAGE_GOTO_SECONDS, 'navigation'):
+                        await self.page.goto(url, wait_until='domcontentloaded', timeout=60000)
                 else:
                      await self.send_error_message("Comando 'goto' requiere una URL.")
                      return
@@ -216,8 +369,8 @@ class SessionConsumer(AsyncWebsocketConsumer):
                 await self.send_error_message(f'Comando de navegación desconocido: {command}')
                 return
 
-            # Esperar un poco a que la navegación surta efecto y JS se ejecute
-            await asyncio.sleep(0.5)
+            # Esperar a que la nueva página se estabilice (red, DOM y dataLayer)
+            await self.settle('navigation', timeout_ms=self.settle_settings.get('NAVIGATION_TIMEOUT_MS'))
             current_url = self.page.url
             logger.info(f"Navegación completada, URL actual: {current_url}")
 
@@ -230,8 +383,8 @@ class SessionConsumer(AsyncWebsocketConsumer):
             self.session_obj.url = current_url
             # await self.update_session_url(current_url) # Opcional: guardar en cada paso
 
+            # Los pushes de la nueva página llegan solos por el binding de streaming
             await self.capture_screenshot()
-            await self.capture_datalayer() # Capturar DL después de navegación
 
         except Exception as e:
              logger.exception(f"Error durante navegación ({command}): {str(e)}")
@@ -250,11 +403,128 @@ class SessionConsumer(AsyncWebsocketConsumer):
         if command == 'datalayer':
             await self.capture_datalayer()
         elif command == 'screenshot':
-            await self.capture_screenshot()
+            await self.capture_screenshot(force=True)
         else:
              await self.send_error_message(f'Comando de captura desconocido: {command}')
 
 
+    async def handle_live_view(self, data):
+        """Activa o desactiva la vista en vivo con frames binarios"""
+        command = data.get('command')
+        logger.info(f"Manejando acción 'live_view', comando: {command} para sesión {self.session_id}")
+
+        if command not in ('enable', 'disable'):
+            await self.send_error_message(f'Comando de vista en vivo desconocido: {command}')
+            return
+
+        self.configure_live_view(command == 'enable', data.get('persist'))
+        await self.send(text_data=json.dumps({
+            'action': 'live_view',
+            'enabled': self.live_view,
+            'persist': self.persist_policy.mode
+        }))
+
+
+    async def handle_resource_policy(self, data):
+        """Consulta (``get``) o cambia (``set``) el bloqueo de recursos de la sesión"""
+        command = data.get('command', 'get')
+        if command not in ('get', 'set'):
+            await self.send_error_message(f'Comando de bloqueo de recursos desconocido: {command}')
+            return
+
+        tracker = self.get_resource_tracker()
+        if command == 'set':
+            try:
+                policy = ResourcePolicy.from_rules(data.get('preset'), data.get('rules'))
+            except ResourcePolicyError as e:
+                await self.send_error_message(str(e))
+                return
+            tracker.policy = policy
+            if (policy.preset, policy.rules) != (self.session_obj.resource_policy, self.session_obj.resource_rules):
+                await self.update_session_resource_policy(policy.preset, policy.rules)
+            # Afecta a las peticiones siguientes; lo ya cargado no se vuelve a pedir
+            await self.apply_resource_policy()
+            logger.info(f"Sesión {self.session_id}: bloqueo de recursos '{policy.preset}' (interceptando: {policy.blocks_anything})")
+
+        await self.send(text_data=json.dumps({
+            'action': 'resource_policy',
+            **tracker.policy.describe(),
+            'stats': tracker.report(),
+            'pages': tracker.history(),
+        }))
+
+
+    async def handle_screencast(self, data):
+        """Controla el screencast de DevTools (start, stop, configure)"""
+        command = data.get('command')
+        logger.info(f"Manejando acción 'screencast', comando: {command} para sesión {self.session_id}")
+
+        if not self.page:
+            await self.send_error_message("Navegador no está listo para el screencast.")
+            return
+        if not Screencast.is_supported(self.browser):
+            await self.send_error_message("El screencast solo está disponible con Chromium.")
+            return
+
+        options = {
+            'fps': data.get('fps'),
+            'quality': data.get('quality'),
+            'max_width': data.get('max_width'),
+            'max_height': data.get('max_height'),
+        }
+        try:
+            if command == 'start':
+                if not self.screencast:
+                    screencast_settings = settings.PLAYWRIGHT_SETTINGS.get('SCREENCAST', {})
+                    self.screencast = Screencast(
+                        self.page,
+                        self.send_screencast_frame,
+                        fps=screencast_settings.get('FPS', 5),
+                        quality=screencast_settings.get('QUALITY', 60),
+                        max_width=screencast_settings.get('MAX_WIDTH', 1280),
+                        max_height=screencast_settings.get('MAX_HEIGHT', 720)
+                    )
+                self.screencast.configure(**options)
+                # Los frames viajan como en la vista en vivo
+                if not self.live_view:
+                    self.configure_live_view(True, data.get('persist'))
+                await self.screencast.restart()
+            elif command == 'configure':
+                if not self.screencast:
+                    await self.send_error_message("No hay screencast activo que configurar.")
+                    return
+                self.screencast.configure(**options)
+                if self.screencast.running:
+                    await self.screencast.restart()
+            elif command == 'stop':
+                if self.screencast:
+                    await self.screencast.stop()
+            else:
+                await self.send_error_message(f'Comando de screencast desconocido: {command}')
+                return
+        except Exception as e:
+            logger.exception(f"Error en screencast ({command}) para sesión {self.session_id}: {str(e)}")
+            await self.send_error_message(f'Error en screencast: {str(e)}')
+            return
+
+        await self.send(text_data=json.dumps({
+            'action': 'screencast',
+            'running': bool(self.screencast and self.screencast.running),
+            'options': self.screencast.options() if self.screencast else None
+        }))
+
+
+    def configure_live_view(self, enabled, persist_mode=None):
+        """Cambia el modo de envío de capturas y su política de persistencia"""
+        self.live_view = enabled
+        live_settings = settings.PLAYWRIGHT_SETTINGS
+        self.persist_policy = PersistPolicy(
+            persist_mode or live_settings.get('SCREENSHOT_PERSIST', PERSIST_EVENTS),
+            live_settings.get('SCREENSHOT_SAMPLE_EVERY', 10)
+        )
+        logger.info(f"Vista en vivo {'activada' if enabled else 'desactivada'} para sesión {self.session_id} (persistencia: {self.persist_policy.mode})")
+
+
     # --- INICIO MODIFICACIÓN: Método handle_interaction corregido ---
     async def handle_interaction(self, data):
         """Maneja interacciones del usuario con el navegador"""
@@ -268,10 +538,14 @@ class SessionConsumer(AsyncWebsocketConsumer):
         if command == 'click':
             x_percent = data.get('x')
             y_percent = data.get('y')
+            mode = data.get('mode') or CLICK_MODE_MOUSE
 
             if x_percent is None or y_percent is None:
                 await self.send_error_message("Comando 'click' requiere coordenadas 'x' e 'y'.")
                 return
+            if mode not in CLICK_MODES:
+                await self.send_error_message(f"Modo de clic desconocido: {mode}")
+                return
 
             try:
                 viewport_size = self.page.viewport_size
@@ -294,7 +568,12 @@ class SessionConsumer(AsyncWebsocketConsumer):
                 x = max(0, min(width - 1, int(width * x_percent)))
                 y = max(0, min(height - 1, int(height * y_percent)))
 
-                logger.info(f"Realizando clic en coordenadas: ({x}, {y}) (porcentajes: {x_percent:.3f}, {y_percent:.3f})")
+                logger.info(f"Realizando clic ({mode}) en coordenadas: ({x}, {y}) (porcentajes: {x_percent:.3f}, {y_percent:.3f})")
+
+                if mode == CLICK_MODE_RUNTIME:
+                    if await self.runtime_click(x, y):
+                        return
+                    logger.info("Runtime de interacción no disponible en la página; se usa el clic de ratón")
 
                 # Intentar identificar el elemento en esas coordenadas
                 element_info = await self.page.evaluate("""(coords) => { // <-- Recibe un solo argumento 'coords'
@@ -319,38 +598,11 @@ class SessionConsumer(AsyncWebsocketConsumer):
 
                 if element_info:
                     logger.info(f"Elemento identificado en coordenadas: {element_info}")
-
-                    # Si es un elemento interactivo, intentar hacer clic directamente usando JavaScript como primer intento
-                    # Esto puede ser más rápido pero podría no disparar todos los eventos JS del sitio
-                    if element_info.get('isInteractive'):
-                        try:
-                            logger.debug("Intentando clic directo con JavaScript...")
-                            click_success = await self.page.evaluate("""(coords) => { // <-- Recibe 'coords'
-                                const x = coords[0]; // <-- Obtiene x
-                                const y = coords[1]; // <-- Obtiene y
-                                const element = document.elementFromPoint(x, y);
-                                if (element) {
-                                     // Intentar simular evento de mouse si click() no funciona
-                                     const evt = new MouseEvent('click', { bubbles: true, cancelable: true, view: window });
-                                     element.dispatchEvent(evt);
-                                     //element.click(); // Método más simple pero menos fiable
-                                     return true;
-                                }
-                                return false;
-                            }""", [x, y]) # <--- Pasar [x, y]
-
-                            if click_success:
-                                logger.info("Clic JS ejecutado en elemento interactivo (o evento disparado)")
-                                # Dar tiempo a que el JS de la página reaccione
-                                await asyncio.sleep(0.3)
-                            else:
-                                logger.warning("Clic JS no pudo encontrar/clickear el elemento. Usando clic de mouse como fallback.")
-                        except Exception as e:
-                            logger.warning(f"Error al intentar clic JS: {str(e)}, usando clic de mouse como fallback")
                 else:
                      logger.info("No se encontró información del elemento en las coordenadas. Procediendo con clic de mouse.")
 
-                # Como fallback o si el clic JS falló, usar la secuencia de mouse de Playwright (más robusta)
+                # Un único clic con la secuencia de ratón de Playwright (antes, los elementos
+                # interactivos recibían además un click sintético y se pulsaban dos veces)
                 logger.info(f"Ejecutando secuencia mouse.move({x}, {y}), down, up...")
                 await self.page.mouse.move(x, y, steps=5) # Añadir steps para suavizar el movimiento
                 await asyncio.sleep(0.05) # Pausa muy corta
@@ -369,15 +621,10 @@ class SessionConsumer(AsyncWebsocketConsumer):
                     logger.debug(f"Timeout esperando estado post-clic (esperado si no hay navegación completa): {timeout_error}")
                     pass # Continuar de todos modos
 
-                # Espera final para asegurar renderizado y JS post-carga
-                await asyncio.sleep(1.0)
+                # Esperar a que la página se estabilice tras el clic
+                await self.settle('click')
                 await self.capture_screenshot() # Captura después de la espera
-
-                # Intentar capturar datalayer después de cada interacción
-                try:
-                    await self.capture_datalayer()
-                except Exception as e:
-                    logger.debug(f"Captura de datalayer post-clic falló (no crítico): {str(e)}")
+                # No hace falta capturar el dataLayer: los pushes del clic ya se transmitieron
 
             except Exception as e:
                 # Log completo del traceback para depurar mejor
@@ -408,8 +655,8 @@ class SessionConsumer(AsyncWebsocketConsumer):
                 await self.page.locator(selector).type(text, delay=50)
                 logger.info(f"Texto ingresado en '{selector}': '{text}'")
 
-                # Espera y captura
-                await asyncio.sleep(0.5)
+                # Esperar a que la página reaccione y capturar
+                await self.settle('type')
                 await self.capture_screenshot()
             except Exception as e:
                 logger.exception(f"Error al ingresar texto en sesión {self.session_id} (selector: '{selector}'): {str(e)}")
@@ -419,13 +666,87 @@ class SessionConsumer(AsyncWebsocketConsumer):
     # --- FIN MODIFICACIÓN ---
 
 
+    async def runtime_click(self, x, y):
+        """
+        Clic de un solo viaje con el runtime de la página: identifica el elemento,
+        lo pulsa y devuelve los pushes del dataLayer que provocó. ``False`` si el
+        runtime no está instalado en el documento actual.
+        """
+        previous_url = self.page.url
+        result = await click_in_page(
+            self.page, x, y,
+            quiet_ms=self.interaction_settings.get('CLICK_QUIET_MS', 150),
+            max_wait_ms=self.interaction_settings.get('CLICK_MAX_WAIT_MS', 1500),
+        )
+        if result is None:
+            return False
+        logger.info(f"Clic runtime en ({x}, {y}): elemento {result.get('element')}, {len(result['pushes'])} pushes, navegó: {result['navigated']}")
+
+        if result['navigated']:
+            # El documento cambió: esperar al nuevo antes de informar
+            try:
+                await self.page.wait_for_load_state('domcontentloaded', timeout=3000)
+            except Exception as e:
+                logger.debug(f"Timeout esperando la página tras el clic runtime: {e}")
+            await self.settle('click')
+
+        await self.send(text_data=json.dumps({
+            'action': 'click_result',
+            'mode': CLICK_MODE_RUNTIME,
+            'found': result['found'],
+            'element': result.get('element'),
+            'pushes': result['pushes'],
+            'navigated': result['navigated'],
+            'duration_ms': result.get('duration_ms'),
+        }))
+        if self.page.url != previous_url:
+            self.session_obj.url = self.page.url
+            await self.send(text_data=json.dumps({'action': 'url_changed', 'url': self.page.url}))
+        await self.capture_screenshot()
+        return True
+
+
+    async def handle_macro(self, data):
+        """Ejecuta una secuencia de pasos seguidos y responde con un único 'macro_result'"""
+        try:
+            steps = parse_macro(
+                data.get('steps'),
+                max_steps=self.interaction_settings.get('MACRO_MAX_STEPS', 100),
+                max_wait_ms=self.interaction_settings.get('MACRO_MAX_WAIT_MS', 30000),
+                max_timeout_ms=self.interaction_settings.get('MACRO_MAX_TIMEOUT_MS', 60000),
+            )
+        except MacroError as e:
+            await self.send_error_message(str(e))
+            return
+
+        logger.info(f"Ejecutando macro de {len(steps)} pasos para sesión {self.session_id}")
+        previous_url = self.page.url
+        run = MacroRun(
+            self, steps,
+            stop_on_failure=bool(data.get('stop_on_failure')),
+            event_timeout_ms=self.interaction_settings.get('MACRO_EVENT_TIMEOUT_MS', 10000),
+        )
+        self.push_listeners.append(run.on_push)
+        try:
+            await run.run()
+        finally:
+            self.push_listeners.remove(run.on_push)
+            # También con la macro cancelada: el cliente recibe lo que llegó a ejecutarse
+            await self.send(text_data=json.dumps({'action': 'macro_result', 'id': data.get('id'), **run.result}))
+            if self.page and self.page.url != previous_url:
+                self.session_obj.url = self.page.url
+                await self.send(text_data=json.dumps({'action': 'url_changed', 'url': self.page.url}))
+        logger.info(f"Macro de sesión {self.session_id}: {run.result['status']} en {run.result['duration_ms']} ms ({run.result['failed_steps']} pasos fallidos)")
+
+
     async def handle_validation(self, data):
         """Maneja comandos relacionados con la validación ( Placeholder )"""
         command = data.get('command')
         logger.info(f"Manejando acción 'validation', comando: {command} para sesión {self.session_id}")
 
         if command == 'check':
-             valid_count, invalid_count = await self.get_validation_stats()
+             counts = self.get_counts()
+             valid_count, invalid_count = counts['valid'], counts['invalid']
              total = valid_count + invalid_count
              message = f"Estadísticas actuales: {valid_count} válidos, {invalid_count} inválidos (Total: {total})."
              # Podrías añadir lógica para re-validar todo aquí si fuera necesario
@@ -441,12 +762,40 @@ class SessionConsumer(AsyncWebsocketConsumer):
              await self.send_error_message(f'Comando de validación desconocido: {command}')
 
 
+    async def handle_cancel(self, data):
+        """Aborta el comando en curso; con ``all: true`` también vacía la cola"""
+        running = self.command_queue.current
+        cancelled = await self.command_queue.cancel(all_pending=bool(data.get('all')))
+        logger.info(f"Sesión {self.session_id}: {cancelled} comandos cancelados (en curso: {running.action if running else None})")
+
+        if running and running.action == 'navigation' and self.page:
+            # La tarea ya no espera la carga, pero el navegador seguiría descargando la página
+            try:
+                await asyncio.wait_for(self.page.evaluate("() => window.stop()"), timeout=2)
+            except Exception as e:
+                logger.debug(f"No se pudo detener la carga tras cancelar: {e}")
+
+        await self.send(text_data=json.dumps({
+            'action': 'cancel',
+            'cancelled': cancelled,
+            **self.command_queue.stats()
+        }))
+
+
+    async def send_command_status(self, message):
+        """Estado de un comando de la cola (queued, started, done...) para el cliente"""
+        await self.send(text_data=json.dumps(message))
+
+
     async def handle_session_action(self, data):
         """Maneja comandos relacionados con la sesión (stop)"""
         command = data.get('command')
         logger.info(f"Manejando acción 'session', comando: {command} para sesión {self.session_id}")
 
         if command == 'stop':
+            # Lo que quede en la cola ya no tiene sentido
+            await self.command_queue.cancel(all_pending=True)
+            await self.capture_buffer.flush()
             await self.update_session_status('completed')
             logger.info(f"Sesión {self.session_id} marcada como completada.")
 
@@ -475,16 +824,16 @@ class SessionConsumer(AsyncWebsocketConsumer):
             logger.info(f"Opciones de reporte recibidas: {options}")
 
             try:
-                report_obj = await self.generate_report(options)
-                report_url = reverse('report_detail', args=[report_obj.id]) # Asumiendo 'report_detail' es el nombre de la URL
-                logger.info(f"Reporte generado para sesión {self.session_id}, ID: {report_obj.id}, URL: {report_url}")
+                await self.capture_buffer.flush() # El reporte debe incluir todas las capturas
+                # Se genera en segundo plano; el progreso llega por el grupo de la sesión
+                job = new_report_job(self.session_id, options, reference_events_count=len(self.reference_datalayers or []))
+                await enqueue_report_job(job)
 
                 await self.send(text_data=json.dumps({
                     'action': 'report',
-                    'status': 'generated',
-                    'report_id': str(report_obj.id),
-                    'report_url': report_url,
-                    'message': 'Reporte generado correctamente.'
+                    'status': 'queued',
+                    'job_id': job['job_id'],
+                    'message': 'Reporte en cola de generación.'
                 }))
 
             except Exception as e:
@@ -494,10 +843,212 @@ class SessionConsumer(AsyncWebsocketConsumer):
              await self.send_error_message(f'Comando de reporte desconocido: {command}')
 
 
+    async def report_status(self, event):
+        """Reenvía al cliente el estado de un trabajo de reporte (mensaje de grupo 'report.status')"""
+        message = {key: value for key, value in event.items() if key != 'type'}
+        # Los relays también están en el grupo: no reenviarles el mensaje otra vez
+        await self.send(text_data=json.dumps({'action': 'report', **message}), relay=False)
+
+
+    # --------------------- MULTI-PROCESO Y RECONEXIÓN (RELAY) ---------------------
+
+    async def send(self, text_data=None, bytes_data=None, close=False, relay=True):
+        """Envía al cliente y, si hay relays de la sesión, también a ellos"""
+        if not self.detached:
+            WEBSOCKET_MESSAGES.labels('out', 'binary' if bytes_data else 'text').inc()
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+        if not relay or close:
+            return
+        if self.has_relays():
+            for target in list(self.relay_channels) + list(self.local_relays):
+                await self.send_to_relay(target, text_data, bytes_data)
+        elif self.detached and text_data:
+            # Nadie escucha: guardar para la recuperación al reconectar (los frames no)
+            self.missed.append(text_data)
+            self.missed_total += 1
+
+    async def close(self, code=None):
+        """Cierra el socket y el de los relays; un holder desacoplado solo cierra sus relays"""
+        for target in list(self.relay_channels) + list(self.local_relays):
+            if isinstance(target, str):
+                await self.channel_layer.send(target, {'type': 'relay.close', 'code': code})
+            else:
+                await target.close(code=code)
+        if not self.detached:
+            await super().close(code=code)
+        elif not self.browser:
+            await self.end_detached() # Sesión terminada (stop o recuperada) sin cliente propio
+
+    def has_relays(self):
+        return bool(self.relay_channels or self.local_relays)
+
+    async def send_to_relay(self, target, text_data=None, bytes_data=None):
+        """``target`` es un consumer de este proceso o el canal de uno remoto"""
+        if isinstance(target, str):
+            await self.channel_layer.send(target, {'type': 'relay.output', 'text': text_data, 'bytes': bytes_data})
+        else:
+            await target.relay_output({'text': text_data, 'bytes': bytes_data})
+
+    async def start_relay(self, owner):
+        """Atiende el socket reenviando sus mensajes al holder de la sesión"""
+        self.relay_to = owner['channel']
+        # Holder en este proceso: llamadas directas, sin pasar por la capa de canales
+        self.relay_holder = session_registry.get(self.relay_to)
+        logger.info(f"Sesión {self.session_id} atendida por el worker {owner['worker']}: relay desde {self.channel_name}")
+        await self.send(text_data=json.dumps({
+            'action': 'status',
+            'message': 'Conexión establecida con el navegador activo de la sesión.'
+        }))
+        if self.relay_holder:
+            await self.relay_holder.attach_relay(self)
+        else:
+            await self.channel_layer.send(self.relay_to, {'type': 'relay.attach', 'channel': self.channel_name})
+
+    async def attach_relay(self, target):
+        """Acopla un cliente (consumer local o canal remoto) y le envía lo que se perdió"""
+        session_registry.cancel_grace(self)
+        missed, dropped = list(self.missed), self.missed_total - len(self.missed)
+        self.missed.clear()
+        self.missed_total = 0
+        if isinstance(target, str):
+            self.relay_channels.add(target)
+        else:
+            self.local_relays.add(target)
+        logger.info(f"Cliente acoplado a sesión {self.session_id} ({len(self.relay_channels) + len(self.local_relays)} en total, {len(missed)} mensajes pendientes)")
+
+        if self.detached:
+            await self.send_to_relay(target, json.dumps({
+                'action': 'catch_up',
+                'count': len(missed),
+                'dropped': dropped,
+                'current_url': self.page.url if self.page else None,
+                'message': f'Reconectado al navegador activo; {len(missed)} mensajes recuperados.'
+            }))
+            for text_data in missed:
+                await self.send_to_relay(target, text_data)
+
+    async def detach_relay(self, target):
+        self.relay_channels.discard(target)
+        self.local_relays.discard(target)
+        if self.detached and self.owns_session and not self.has_relays():
+            session_registry.start_grace(self)
+
+    async def detach(self):
+        """El socket del holder se cayó: mantener el navegador para una reconexión"""
+        self.detached = True
+        if self.screencast and self.screencast.running:
+            await self.screencast.stop() # Nadie ve los frames; el cliente lo reactiva al volver
+        # Los relays remotos escriben en el canal de este consumer, que ya no lee Channels
+        self.mailbox_task = asyncio.create_task(self.serve_mailbox())
+        if not self.has_relays():
+            session_registry.start_grace(self)
+
+    async def serve_mailbox(self):
+        while True:
+            try:
+                message = await self.channel_layer.receive(self.channel_name)
+            except KeyError:
+                return # InMemoryChannelLayer borra el canal al cancelar la espera
+            try:
+                await self.dispatch(message)
+            except Exception as e:
+                logger.exception(f"Error procesando '{message.get('type')}' en la sesión desacoplada {self.session_id}: {e}")
+
+    async def end_detached(self):
+        """Fin del periodo de gracia (o de la sesión) sin cliente propio: liberar todo"""
+        if self.mailbox_task and self.mailbox_task is not asyncio.current_task():
+            self.mailbox_task.cancel()
+        await self.release_session_resources()
+
+    async def release_session_resources(self):
+        """Cola de comandos, navegador, hueco de admisión, capturas pendientes y propiedad de la sesión"""
+        await self.command_queue.stop()
+        await self.close_browser()
+        if self.admission_budget:
+            admission.release(self.admission_budget)
+            self.admission_budget = None
+
+        # Terminar de guardar las capturas pendientes
+        await self.capture_buffer.close()
+        await self.screenshot_writer.stop(flush=True)
+
+        if self.owns_session:
+            self.owns_session = False
+            session_registry.unregister(self)
+            await worker_registry.release_session(self.session_id, self.channel_name)
+            # Los relays que queden cierran para que sus clientes reconecten
+            await self.channel_layer.group_send(self.session_group_name, {'type': 'session.released', 'channel': self.channel_name})
+
+    async def relay_attach(self, event):
+        await self.attach_relay(event['channel'])
+
+    async def relay_detach(self, event):
+        await self.detach_relay(event['channel'])
+
+    async def relay_input(self, event):
+        """Mensaje del cliente de un relay: se procesa como si fuera propio"""
+        await self.receive(text_data=event['text'])
+
+    async def relay_output(self, event):
+        if self.relay_to:
+            WEBSOCKET_MESSAGES.labels('out', 'binary' if event.get('bytes') else 'text').inc()
+            await super().send(text_data=event.get('text'), bytes_data=event.get('bytes'))
+
+    async def relay_close(self, event):
+        await self.close(code=event.get('code'))
+
+    async def session_released(self, event):
+        """El holder de la sesión liberó el navegador (mensaje de grupo 'session.released')"""
+        if self.relay_to == event['channel']:
+            await self.close(code=RELAY_CLOSE_CODE)
+
+
+    # --------------------- CONTROL DE ADMISIÓN ---------------------
+
+    def request_admission(self, data=None):
+        """Pide turno en segundo plano; al obtenerlo continúa con 'init'"""
+        if self.admission_task and not self.admission_task.done():
+            return
+        self.admission_task = asyncio.create_task(self.wait_for_admission(data))
+
+    async def wait_for_admission(self, data):
+        try:
+            self.admission_budget = await admission.acquire(self.session_id, self.reclaim, self.send_queue_position)
+        except AdmissionError as e:
+            logger.warning(f"Sesión {self.session_id} no admitida: {e}")
+            await self.send(text_data=json.dumps({'action': 'queue', 'status': 'rejected', 'message': str(e)}))
+            await self.close(code=REJECT_CLOSE_CODE)
+            return
+
+        await self.send(text_data=json.dumps({'action': 'queue', 'status': 'admitted'}))
+        # El navegador se lanza desde la cola, en serie con el resto de comandos
+        await self.command_queue.submit('init', data or {})
+
+    async def send_queue_position(self, position):
+        await self.send(text_data=json.dumps({
+            'action': 'queue',
+            'status': 'waiting',
+            'position': position,
+            'message': f'Todos los navegadores están ocupados. Posición en la cola: {position}.'
+        }))
+
+    async def reclaim(self, reason):
+        """Cierra la sesión por superar sus límites de recursos (lo llama el control de admisión)"""
+        await self.send_error_message(f'Sesión cerrada para liberar recursos: {reason}')
+        await self.command_queue.stop()
+        await self.close_browser()
+        await self.capture_buffer.flush()
+        await self.update_session_status('completed')
+        await self.close(code=RECLAIM_CLOSE_CODE)
+
+
     # --------------------- FUNCIONES DE CAPTURA ---------------------
 
-    async def capture_screenshot(self):
+    async def capture_screenshot(self, force=False):
         """Captura una imagen del navegador y la envía al cliente"""
+        if self.screencast and self.screencast.running and not force:
+            return # El screencast ya está enviando la vista en vivo
+
         if not self.page or not self.browser.is_connected():
             logger.warning(f"Intento de captura de pantalla sin página/navegador para sesión {self.session_id}")
             # await self.send_error_message("No se puede capturar pantalla, el navegador no está listo.")
@@ -506,20 +1057,27 @@ class SessionConsumer(AsyncWebsocketConsumer):
         logger.debug(f"Capturando pantalla para sesión {self.session_id}...")
         try:
             # Captura JPEG con calidad moderada para ahorrar ancho de banda
-            screenshot_bytes = await self.page.screenshot(type='jpeg', quality=70, timeout=10000) # Timeout para evitar bloqueos
+            with timer(SCREENSHOT_SECONDS, 'capture'):
+                screenshot_bytes = await self.page.screenshot(type='jpeg', quality=70, timeout=10000) # Timeout para evitar bloqueos
             logger.debug(f"Screenshot bytes obtenidos ({len(screenshot_bytes)} bytes)")
 
-            screenshot_obj = await self.save_screenshot(screenshot_bytes)
-            if not screenshot_obj:
-                 raise Exception("Fallo al guardar screenshot en DB.")
-
-            logger.debug(f"Screenshot guardado en DB, ID: {screenshot_obj.id}, URL: {screenshot_obj.image.url}")
+            # Enviar al cliente de inmediato; el guardado en disco/BD va en segundo plano
+            if self.live_view:
+                # Frame binario: sin base64 ni segunda petición HTTP
+                self.frame_seq += 1
+                await self.send(bytes_data=encode_frame(self.frame_seq, screenshot_bytes))
+            else:
+                await self.send(text_data=json.dumps({
+                    'action': 'screenshot',
+                    'image_data': 'data:image/jpeg;base64,' + base64.b64encode(screenshot_bytes).decode('ascii')
+                }))
+            logger.debug(f"Screenshot enviado para sesión {self.session_id} (vista en vivo: {self.live_view})")
 
-            await self.send(text_data=json.dumps({
-                'action': 'screenshot',
-                'image_url': screenshot_obj.image.url
-            }))
-            logger.debug(f"Mensaje de screenshot enviado para sesión {self.session_id}")
+            # Guardar solo lo que pida la política (todo si no hay vista en vivo)
+            relevant = self.pushes_since_screenshot > 0
+            self.pushes_since_screenshot = 0
+            if not self.live_view or self.persist_policy.should_persist(relevant):
+                self.screenshot_writer.submit(screenshot_bytes, self.page.url)
 
         except Exception as e:
             logger.exception(f"Error al capturar/guardar/enviar screenshot para sesión {self.session_id}: {str(e)}")
@@ -527,18 +1085,20 @@ class SessionConsumer(AsyncWebsocketConsumer):
 
 
     async def capture_datalayer(self):
-        """Captura el DataLayer actual y lo procesa"""
+        """
+        Comprueba el estado del dataLayer en la página.
+        Los pushes ya llegan uno a uno por ``handle_datalayer_push``, así que
+        aquí no se transfiere el array completo, solo su estado y longitud.
+        """
         if not self.page or not self.browser.is_connected():
             logger.warning(f"Intento de captura de datalayer sin página/navegador para sesión {self.session_id}")
             # await self.send_error_message("No se puede capturar DataLayer, el navegador no está listo.")
             return
 
-        logger.debug(f"Capturando DataLayer para sesión {self.session_id}...")
+        logger.debug(f"Comprobando DataLayer para sesión {self.session_id}...")
         try:
-            # Este script intenta obtener el dataLayer de forma segura
-            js_script = '''() => {
-                try {
-                    // Intentar acceder a window.dataLayer de forma segura
+            with timer(DATALAYER_SECONDS, 'evaluate'):
+                result = await self.page.evaluate('''() => {
                     const dl = window.dataLayer;
                     if (typeof dl === 'undefined' || dl === null) {
                         return { status: 'not_found' }; // Indicar que no existe
@@ -546,28 +1106,9 @@ class SessionConsumer(AsyncWebsocketConsumer):
                     if (!Array.isArray(dl)) {
                          return { status: 'not_array', type: typeof dl }; // Indicar si no es array
                     }
-                    // Intentar clonar para evitar problemas de serialización circular
-                    // Esto es una simplificación, puede fallar con objetos complejos
-                    return { status: 'success', data: JSON.parse(JSON.stringify(dl)) };
-                } catch (e) {
-                    // Si falla la serialización, devolver un indicador de error o un array vacío
-                    console.error('Error al serializar dataLayer:', e);
-                    // Podríamos intentar devolver una versión más simple si es un array
-                    if (Array.isArray(window.dataLayer)) {
-                        // Devolver solo eventos si es posible (simplificación)
-                         try {
-                            // Solo devolver los últimos N eventos para no sobrecargar
-                            const lastN = window.dataLayer.slice(-10); // Últimos 10
-                            return { status: 'partial_success', data: JSON.parse(JSON.stringify(lastN)) };
-                         } catch (mapError) {
-                            return { status: 'error', message: `Error mapeando/serializando parcialmente: ${mapError.toString()}` };
-                         }
-                    }
-                    return { status: 'error', message: `Error al serializar dataLayer completo: ${e.toString()}` };
-                }
-            }'''
-            result = await self.page.evaluate(js_script)
-            logger.debug(f"Resultado de obtención de DataLayer desde página: {result}")
+                    return { status: 'success', length: dl.length, streaming: !!dl.__dlInstrumented };
+                }''')
+            logger.debug(f"Estado de DataLayer en la página: {result}")
 
             if result['status'] == 'not_found':
                 logger.warning(f"No se encontró 'window.dataLayer' en la página para sesión {self.session_id}")
@@ -577,59 +1118,155 @@ class SessionConsumer(AsyncWebsocketConsumer):
                  logger.warning(f"window.dataLayer no es un Array (tipo: {result['type']}) en sesión {self.session_id}")
                  await self.send_error_message(f"El objeto dataLayer encontrado no es un Array (tipo: {result['type']}).")
                  return
-            if result['status'] == 'error':
-                 logger.error(f"Error al obtener/serializar dataLayer desde JS: {result['message']}")
-                 await self.send_error_message(f"Error interno al obtener dataLayer: {result.get('message', 'Error desconocido')}")
-                 return
 
-            captured_data = result.get('data', [])
-            if not captured_data: # Si está vacío o no hay 'data'
-                 logger.info(f"DataLayer capturado está vacío para sesión {self.session_id}")
-                 # No enviar error, solo informar que está vacío si es necesario
-                 # await self.send(...)
+            if not result.get('streaming'):
+                 logger.warning(f"dataLayer sin instrumentar en sesión {self.session_id}")
+                 await self.send_error_message('El dataLayer de la página no está siendo monitorizado.')
                  return
 
-            # Aquí viene la validación contra el JSON de referencia (self.reference_datalayers)
-            validation_results = self.validate_against_reference(captured_data)
-            valid = validation_results['valid']
-            errors = validation_results['errors']
+            await self.send(text_data=json.dumps({
+                'action': 'status',
+                'message': f"DataLayer monitorizado: {result['length']} entradas en la página actual.",
+                'datalayer_length': result['length']
+            }))
+
+        except Exception as e:
+            logger.exception(f"Error al comprobar dataLayer para sesión {self.session_id}: {str(e)}")
+            await self.send_error_message(f'Error al capturar dataLayer: {str(e)}')
+
 
-            # El evento principal podría ser el último push si result es una lista
-            event_name = "dataLayer Event" # Nombre por defecto
-            last_event_obj = None
-            if isinstance(captured_data, list) and len(captured_data) > 0:
-                 # Buscar el último objeto en la lista que parezca un evento (tenga 'event')
-                 for item in reversed(captured_data):
-                    if isinstance(item, dict) and 'event' in item:
-                        last_event_obj = item
-                        event_name = item.get('event', event_name)
-                        break
-                 if not last_event_obj: # Si ninguno tiene 'event', usar el último elemento
-                    last_event_obj = captured_data[-1]
+    async def handle_datalayer_push(self, source, payload):
+        """Recibe un push del dataLayer desde el binding expuesto en la página"""
+        # Ignorar iframes (anuncios, widgets): solo interesa el documento principal
+        if self.page is None or source.get('frame') is not self.page.main_frame:
+            return
+        if self.settle_detector:
+            self.settle_detector.notify_push()
 
+        # Procesar en orden de llegada aunque Playwright lance varias tareas
+        async with self.datalayer_push_lock:
+            await self.process_datalayer_push(payload.get('data'), payload.get('url') or self.page.url, payload.get('index', 0))
 
-            datalayer_obj = await self.save_datalayer(captured_data, valid, errors)
-            logger.debug(f"DataLayer guardado en DB, ID: {datalayer_obj.id}")
+
+    async def process_datalayer_push(self, entry, url, offset=0):
+        """Valida, guarda y envía al cliente un único push del dataLayer"""
+        try:
+            event_name = "dataLayer Event" # Nombre por defecto
+            if isinstance(entry, dict) and 'event' in entry:
+                event_name = entry.get('event') or event_name
+
+            if isinstance(entry, dict) and str(entry.get('event', '')).startswith(INTERNAL_EVENT_PREFIXES):
+                valid, errors = None, []
+            else:
+                with timer(DATALAYER_SECONDS, 'validate'):
+                    validation_results = self.validate_against_reference([entry])
+                valid = validation_results['valid']
+                errors = validation_results['errors']
+
+            self.pushes_since_screenshot += 1
+            # El id (UUID) ya existe; la inserción se hace por lotes en segundo plano
+            datalayer_obj = self.build_datalayer_capture([entry], valid, errors, url=url, offset=offset)
+            self.capture_buffer.add(datalayer_obj)
+            self.count_datalayer(valid)
+            logger.debug(f"Push de DataLayer encolado para guardar, ID: {datalayer_obj.id}")
+            for listener in list(self.push_listeners):
+                listener({'id': str(datalayer_obj.id), 'event': event_name, 'data': entry, 'valid': valid, 'errors': errors})
 
             await self.send(text_data=json.dumps({
                 'action': 'datalayer',
-                'data': last_event_obj, # Enviar solo el último evento/objeto para simplificar UI? O todo 'captured_data'?
-                'full_datalayer': captured_data, # Opcional: enviar todo si la UI lo necesita
+                'data': entry,
                 'valid': valid,
                 'errors': errors,
                 'id': str(datalayer_obj.id),
-                'timestamp': datalayer_obj.created_at.isoformat(),
-                'event': event_name # Nombre del evento inferido
+                'timestamp': timezone.now().isoformat(),
+                'url': url,
+                'event': event_name
             }))
             logger.debug(f"Mensaje de datalayer enviado para sesión {self.session_id}")
 
         except Exception as e:
-            logger.exception(f"Error al capturar/validar/guardar dataLayer para sesión {self.session_id}: {str(e)}")
-            await self.send_error_message(f'Error al capturar dataLayer: {str(e)}')
+            logger.exception(f"Error al validar/guardar push de dataLayer para sesión {self.session_id}: {str(e)}")
+            await self.send_error_message(f'Error al procesar dataLayer: {str(e)}')
+
+
+    async def settle(self, source, timeout_ms=None):
+        """
+        Espera a que la página esté estable (red, DOM y dataLayer en silencio)
+        y comunica al cliente cuánto tardó.
+        """
+        if not self.settle_detector:
+            return None
+        result = await self.settle_detector.wait(timeout_ms)
+        logger.debug(f"Página estable tras '{source}' en {result.duration_ms} ms (estable: {result.settled}, ocupado: {result.busy})")
+        await self.send(text_data=json.dumps({
+            'action': 'settled',
+            'source': source,
+            'settled': result.settled,
+            'duration_ms': result.duration_ms,
+            'busy': result.busy
+        }))
+        await self.send_resource_stats()
+        return result
+
+
+    async def send_resource_stats(self):
+        """Peticiones permitidas y bloqueadas de la página actual, si cambiaron desde el último envío"""
+        if self.resource_tracker and self.resource_tracker.changed:
+            await self.send(text_data=json.dumps({
+                'action': 'resource_stats',
+                **self.resource_tracker.report(),
+            }))
+
+
+    async def send_screencast_frame(self, frame_bytes):
+        """Envía un frame del screencast y lo guarda si la política lo pide"""
+        self.frame_seq += 1
+        await self.send(bytes_data=encode_frame(self.frame_seq, frame_bytes))
+
+        relevant = self.pushes_since_screenshot > 0
+        self.pushes_since_screenshot = 0
+        if self.persist_policy.should_persist(relevant) and self.page:
+            self.screenshot_writer.submit(frame_bytes, self.page.url)
 
 
     # --------------------- FUNCIONES DE INICIALIZACIÓN Y CIERRE ---------------------
 
+    def use_headless(self):
+        """Headless si el despliegue lo impone (``FORCE_HEADLESS``) o la sesión lo eligió"""
+        playwright_settings = getattr(settings, 'PLAYWRIGHT_SETTINGS', {})
+        if playwright_settings.get('FORCE_HEADLESS'):
+            return True
+        if self.session_obj:
+            return self.session_obj.headless
+        return playwright_settings.get('HEADLESS', False)
+
+    def get_resource_tracker(self):
+        """Tracker de la sesión, creado con el preset y las reglas guardados la primera vez"""
+        if self.resource_tracker is None:
+            try:
+                policy = ResourcePolicy.from_rules(
+                    self.session_obj.resource_policy if self.session_obj else None,
+                    self.session_obj.resource_rules if self.session_obj else None,
+                )
+            except ResourcePolicyError as e:
+                logger.warning(f"Sesión {self.session_id}: {e}; se cargan todos los recursos")
+                policy = ResourcePolicy()
+            self.resource_tracker = ResourceTracker(policy)
+        return self.resource_tracker
+
+    async def apply_resource_policy(self):
+        """Intercepta las peticiones del contexto solo si la política bloquea algo"""
+        if not self.context:
+            return
+        tracker = self.get_resource_tracker()
+        if tracker.policy.blocks_anything and not self.resource_route_installed:
+            await self.context.route('**/*', tracker.handle_route)
+            self.resource_route_installed = True
+        elif not tracker.policy.blocks_anything and self.resource_route_installed:
+            # Sin reglas, interceptar solo añadiría un viaje de ida y vuelta por petición
+            await self.context.unroute('**/*', tracker.handle_route)
+            self.resource_route_installed = False
+
     async def initialize_browser(self):
      """Inicializa el navegador de Playwright"""
      if self.browser and self.browser.is_connected():
@@ -638,54 +1275,53 @@ class SessionConsumer(AsyncWebsocketConsumer):
 
      logger.info(f"Inicializando navegador para sesión {self.session_id}...")
      try:
-        browser_type = os.environ.get('PLAYWRIGHT_BROWSER', self.session_obj.browser_type if self.session_obj else 'chromium')
-        # Forzar headless=False ya que eliminamos la opción
-        # headless = os.environ.get('PLAYWRIGHT_HEADLESS', 'false').lower() == 'true' # Ya no se usa
-        logger.info(f"Configuración navegador: Tipo={browser_type}, Headless=False")
-
-        self.playwright = await async_playwright().start()
-
-        # Opciones optimizadas para ejecución en Docker y modo interactivo
-        browser_options = {
-            'headless': False, # Siempre interactivo
-            'args': [
-                '--no-sandbox', # Necesario en muchos entornos Docker
-                '--disable-setuid-sandbox', # Alternativa a no-sandbox
-                '--disable-dev-shm-usage', # Evita problemas con /dev/shm pequeño
-                '--disable-gpu', # A menudo innecesario y problemático en Docker/Xvfb
-                '--window-size=1280,720', # Tamaño inicial ventana
-                # '--disable-web-security', # Considerar solo si hay problemas CORS/iframe extremos
-                # '--allow-running-insecure-content' # Para contenido mixto si es necesario
-            ],
-            # Timeout más largo para el lanzamiento por si el sistema está lento
-            'timeout': 90000 # 90 segundos
-        }
+        # Si quedó un contexto de un navegador caído, devolverlo antes de pedir otro
+        if self.browser_lease:
+            await self.close_browser()
 
-        logger.debug(f"Lanzando navegador {browser_type} con opciones: {browser_options}")
-        if browser_type == 'firefox':
-            self.browser = await self.playwright.firefox.launch(**browser_options)
-        elif browser_type == 'webkit':
-            # Webkit puede tener menos argumentos soportados
-            webkit_args = [arg for arg in browser_options['args'] if 'webkit' not in arg.lower()] # Filtrar args no soportados si se conocen
-            browser_options['args'] = webkit_args
-            self.browser = await self.playwright.webkit.launch(**browser_options)
-        else: # Chromium por defecto
-            self.browser = await self.playwright.chromium.launch(**browser_options)
-
-        logger.info(f"Navegador {browser_type} lanzado. Creando contexto...")
-        self.context = await self.browser.new_context(
+        browser_type = os.environ.get('PLAYWRIGHT_BROWSER', self.session_obj.browser_type if self.session_obj else 'chromium')
+        headless = self.use_headless()
+        resource_policy = self.get_resource_tracker().policy
+        logger.info(f"Configuración navegador: Tipo={browser_type}, Headless={headless}, Recursos={resource_policy.preset}")
+
+        # Pedir un contexto nuevo al pool compartido (el navegador ya está lanzado)
+        self.browser_lease = await browser_pool.acquire(
+            browser_type,
+            headless=headless,
             viewport={'width': 1280, 'height': 720}, # Sincronizado con window-size
             ignore_https_errors=True,  # Ayuda con sitios HTTPS problemáticos
-            # has_touch=False, # Desactivar emulación touch que puede interferir
-            # user_agent=... # Podrías definir un user agent específico si es necesario
             locale='es-ES', # Configurar locale
-            timezone_id='America/Bogota' # Configurar timezone
+            timezone_id='America/Bogota', # Configurar timezone
+            # Las peticiones de un service worker no pasan por context.route y el preset
+            # puede cambiar a mitad de sesión ('set'): se bloquean siempre
+            service_workers='block'
         )
-        logger.info("Contexto creado. Creando página...")
+        self.browser = self.browser_lease.browser
+        self.context = self.browser_lease.context
+        self.resource_route_installed = False
+        await self.apply_resource_policy()
+        self.admission_budget.attach(self.context, admission.limits.get('MAX_PAGES', 0))
+        logger.info("Contexto creado. Instalando streaming de DataLayer...")
+
+        # Cada dataLayer.push llega a Python en cuanto ocurre, en todas las navegaciones
+        await self.context.expose_binding('__dlPush', self.handle_datalayer_push)
+        await self.context.add_init_script(script=DATALAYER_STREAM_SCRIPT)
+        # MutationObserver para la detección de página estable
+        await self.context.add_init_script(script=SETTLE_MONITOR_SCRIPT)
+        # Runtime de interacción para los clics de un solo viaje (modo 'runtime')
+        await self.context.add_init_script(script=INTERACTION_RUNTIME_SCRIPT)
+        logger.info("Streaming de DataLayer instalado. Creando página...")
 
         self.page = await self.context.new_page()
         logger.info(f"Página creada para sesión {self.session_id}")
 
+        self.settle_detector = SettleDetector(
+            self.page,
+            quiet_ms=self.settle_settings.get('QUIET_WINDOW_MS', 300),
+            timeout_ms=self.settle_settings.get('TIMEOUT_MS', 3000),
+            long_request_ms=self.settle_settings.get('LONG_REQUEST_MS', 5000)
+        )
+
         # Configurar manejadores de eventos mejorados
         self.page.on("close", lambda: logger.info(f"Evento 'close' de página recibido para sesión {self.session_id}"))
         self.page.on("crash", lambda: logger.error(f"¡Página CRASHEADA para sesión {self.session_id}!"))
@@ -694,46 +1330,6 @@ class SessionConsumer(AsyncWebsocketConsumer):
         self.page.on("console", lambda msg: asyncio.create_task(self.handle_console_message(msg)))
         self.page.on("dialog", lambda dialog: asyncio.create_task(self.handle_dialog(dialog)))
 
-        # Añadir monitor de eventos de clic para depuración (ya estaba)
-        # await self.page.evaluate("""() => {
-        #     window.addEventListener('click', function(e) {
-        #         console.log('Click detectado en página:', e.clientX, e.clientY, e.target.tagName);
-        #     }, true);
-        # }""")
-
-        # Inyectar script para monitorizar dataLayer (asegurarse que se ejecuta)
-        try:
-            await self.page.evaluate("""() => {
-                if (typeof window._dl_monitor_installed === 'undefined') {
-                    window._dl_monitor_installed = true; // Marcar como instalado
-                    if (typeof window.dataLayer === 'undefined') {
-                        console.log('[DL Monitor] window.dataLayer no existe, inicializando...');
-                        window.dataLayer = [];
-                    } else {
-                        console.log('[DL Monitor] window.dataLayer ya existe, tipo:', typeof window.dataLayer);
-                    }
-
-                    if (Array.isArray(window.dataLayer) && typeof window.dataLayer.push === 'function') {
-                        const originalPush = window.dataLayer.push;
-                        window.dataLayer.push = function() {
-                            console.log('[DL Monitor] dataLayer.push detectado:', JSON.stringify(arguments[0] || null));
-                            // Podríamos enviar un evento al backend aquí si quisiéramos captura en tiempo real
-                            // window.ws.send(...) // Si tuviéramos acceso al websocket aquí
-                            return originalPush.apply(this, arguments);
-                        };
-                        console.log('[DL Monitor] dataLayer.push instrumentado.');
-                    } else {
-                         console.warn('[DL Monitor] No se pudo instrumentar dataLayer.push (no es array o no tiene push).');
-                    }
-                } else {
-                     console.log('[DL Monitor] Monitor ya instalado.');
-                }
-            }""")
-            logger.info("Script de monitorización de DataLayer inyectado.")
-        except Exception as script_error:
-            logger.error(f"Error inyectando script de monitorización de DataLayer: {script_error}")
-
-
         # Navegar a la URL inicial
         initial_url = self.session_obj.url if self.session_obj else 'about:blank'
         if not initial_url or not initial_url.startswith('http'):
@@ -742,11 +1338,12 @@ class SessionConsumer(AsyncWebsocketConsumer):
 
         logger.info(f"Navegando a URL inicial: {initial_url}")
         # Aumentar timeout y usar 'load' o 'commit' podría ser más robusto que 'domcontentloaded' a veces
-        await self.page.goto(initial_url, wait_until='load', timeout=90000) # Timeout más largo para carga inicial
+        with timer(PAGE_GOTO_SECONDS, 'initial'):
+            await self.page.goto(initial_url, wait_until='load', timeout=90000) # Timeout más largo para carga inicial
         logger.info(f"Navegación inicial completada a: {self.page.url}")
 
-        # Esperar un poco más para asegurar que la página esté completamente estable
-        await asyncio.sleep(1.5)
+        # Esperar a que la página esté estable en lugar de una pausa fija
+        await self.settle('initial_load', timeout_ms=self.settle_settings.get('NAVIGATION_TIMEOUT_MS'))
 
         # Notificar URL actual al cliente
         await self.send(text_data=json.dumps({
@@ -757,6 +1354,12 @@ class SessionConsumer(AsyncWebsocketConsumer):
         logger.info(f"Navegador inicializado correctamente para sesión {self.session_id}")
         await self.update_session_status('active')
 
+     except asyncio.CancelledError:
+        # 'cancel' de la cola a mitad del init: sin limpiar quedaría un navegador sin página
+        # y el siguiente init volvería sin hacer nada
+        logger.warning(f"Inicialización del navegador cancelada para sesión {self.session_id}; se liberan los recursos")
+        await self.close_browser()
+        raise
      except Exception as e:
         logger.exception(f"FALLO CRÍTICO al inicializar navegador para sesión {self.session_id}: {str(e)}")
         await self.send_error_message(f'Error crítico al inicializar navegador: {str(e)}')
@@ -805,51 +1408,39 @@ class SessionConsumer(AsyncWebsocketConsumer):
 
 
     async def close_browser(self):
-        """Cierra el navegador y libera recursos de Playwright"""
-        if not self.browser and not self.playwright:
-            logger.info(f"No hay navegador/playwright que cerrar para sesión {self.session_id}")
+        """Cierra la página y devuelve el contexto al pool de navegadores"""
+        if not self.browser and not self.browser_lease:
+            logger.info(f"No hay navegador que liberar para sesión {self.session_id}")
             return
 
         logger.info(f"Iniciando cierre del navegador para sesión {self.session_id}...")
         closed_something = False
         try:
-            # Cerrar en orden inverso: página -> contexto -> navegador -> playwright
+            if self.screencast:
+                await self.screencast.stop()
+                self.screencast = None
+
+            # Cerrar en orden inverso: página -> contexto (el navegador sigue vivo en el pool)
             if self.page:
                 try:
                     await self.page.close(run_before_unload=True) # Intentar disparar eventos unload
                     self.page = None
+                    self.settle_detector = None
                     closed_something = True
                     logger.info(f"Página cerrada para sesión {self.session_id}")
                 except Exception as page_close_err:
                      logger.error(f"Error al cerrar página: {page_close_err}")
 
-            if self.context:
-                try:
-                    await self.context.close()
-                    self.context = None
-                    closed_something = True
-                    logger.info(f"Contexto cerrado para sesión {self.session_id}")
-                except Exception as context_close_err:
-                     logger.error(f"Error al cerrar contexto: {context_close_err}")
-
-            if self.browser and self.browser.is_connected():
-                try:
-                    await self.browser.close()
-                    self.browser = None
-                    closed_something = True
-                    logger.info(f"Navegador cerrado para sesión {self.session_id}")
-                except Exception as browser_close_err:
-                     logger.error(f"Error al cerrar navegador: {browser_close_err}")
-
-            if self.playwright:
+            if self.browser_lease:
                 try:
-                    await self.playwright.stop()
-                    self.playwright = None
+                    await browser_pool.release(self.browser_lease)
                     closed_something = True
-                    logger.info(f"Playwright detenido para sesión {self.session_id}")
-                except Exception as playwright_stop_err:
-                     logger.error(f"Error al detener Playwright: {playwright_stop_err}")
-
+                    logger.info(f"Contexto devuelto al pool para sesión {self.session_id}")
+                except Exception as release_err:
+                     logger.error(f"Error al devolver contexto al pool: {release_err}")
+                self.browser_lease = None
+                self.context = None
+                self.browser = None
 
             if closed_something:
                  logger.info(f"Recursos de Playwright liberados para sesión {self.session_id}")
@@ -867,7 +1458,10 @@ class SessionConsumer(AsyncWebsocketConsumer):
         """Obtiene la sesión de la base de datos"""
         try:
             # Usamos select_related para precargar el archivo JSON si es necesario más adelante
-            return Session.objects.select_related(None).get(id=self.session_id)
+            session = Session.objects.select_related(None).get(id=self.session_id)
+            # Las capturas nuevas continúan la numeración de las ya guardadas
+            self.capture_sequence = DataLayerCapture.objects.filter(session=session).aggregate(last=Max('sequence'))['last'] or 0
+            return session
         except Session.DoesNotExist:
             logger.error(f"Session.DoesNotExist en get_session para ID: {self.session_id}")
             return None
@@ -889,6 +1483,8 @@ class SessionConsumer(AsyncWebsocketConsumer):
             self.session_obj.json_file.seek(0)
             json_content = self.session_obj.json_file.read().decode('utf-8')
             self.reference_datalayers = json.loads(json_content)
+            # Compilar una sola vez para no recorrer la lista en cada captura
+            self.reference_index = ReferenceIndex(self.reference_datalayers)
             logger.info(f"Archivo JSON de referencia cargado para sesión {self.session_id}. {len(self.reference_datalayers)} eventos de referencia.")
             # Aquí podríamos construir el esquema de validación si fuera necesario
             # self.datalayer_schema = self.build_validation_schema(self.reference_datalayers)
@@ -904,6 +1500,13 @@ class SessionConsumer(AsyncWebsocketConsumer):
             asyncio.create_task(self.send_error_message(f"Error al procesar archivo JSON de referencia: {str(e)}"))
 
 
+    @database_write_to_async
+    def update_session_resource_policy(self, preset, rules):
+        """Guarda el preset y las reglas de bloqueo para las próximas sesiones del navegador"""
+        Session.objects.filter(id=self.session_id).update(resource_policy=preset, resource_rules=rules)
+        self.session_obj.resource_policy = preset
+        self.session_obj.resource_rules = rules
+
     @database_sync_to_async
     def update_session_status(self, status):
         """Actualiza el estado de la sesión en la BD"""
@@ -922,25 +1525,21 @@ class SessionConsumer(AsyncWebsocketConsumer):
              logger.exception(f"Error al actualizar estado de sesión {self.session_id} a {status}: {e}")
 
 
-    @database_sync_to_async
-    def save_screenshot(self, image_bytes):
+    @database_write_to_async
+    def save_screenshot(self, image_bytes, url=None):
         """Guarda una captura de pantalla en la base de datos y devuelve el objeto"""
         if not self.session_obj: return None
-        current_url = "N/A"
+        # La URL se toma en el event loop: aquí no se debe tocar la página de Playwright
+        current_url = url or "N/A"
         try:
-            # Intentar obtener la URL actual de forma segura
-            if self.page and self.browser.is_connected():
-                current_url = self.page.url
-            else:
-                 logger.warning("No se pudo obtener URL actual para guardar screenshot (page/browser no listo)")
-
             filename = f"scr_{self.session_id}_{uuid.uuid4().hex[:6]}.jpg"
 
             screenshot = Screenshot(
                 session=self.session_obj,
                 url=current_url
             )
-            screenshot.image.save(filename, ContentFile(image_bytes), save=True)
+            with timer(SCREENSHOT_SECONDS, 'save'):
+                screenshot.image.save(filename, ContentFile(image_bytes), save=True)
             logger.debug(f"Screenshot guardado: {filename} para URL {current_url}")
             return screenshot
         except Exception as e:
@@ -948,146 +1547,77 @@ class SessionConsumer(AsyncWebsocketConsumer):
              return None
 
 
-    @database_sync_to_async
-    def save_datalayer(self, data, is_valid=None, errors=None):
-        """Guarda un DataLayer capturado en la base de datos"""
-        if not self.session_obj: return None
-        current_url = "N/A"
-        try:
-            # Intentar obtener la URL actual de forma segura
-            if self.page and self.browser.is_connected():
-                 current_url = self.page.url
-            else:
-                  logger.warning("No se pudo obtener URL actual para guardar datalayer (page/browser no listo)")
+    def build_datalayer_capture(self, data, is_valid=None, errors=None, url=None, offset=0):
+        """
+        Crea (sin guardar) una captura de DataLayer con su UUID ya asignado.
+        ``data`` son solo las entradas nuevas y ``offset`` su posición en window.dataLayer.
+        """
+        current_url = url or (self.page.url if self.page else "N/A")
+        # Las URLs con muchos parámetros superan el max_length del campo y romperían el lote entero
+        max_length = DataLayerCapture._meta.get_field('url').max_length
+        self.capture_sequence += 1
+        return DataLayerCapture(
+            session=self.session_obj,
+            url=current_url[:max_length],
+            data=data, # Entradas nuevas empujadas al dataLayer
+            offset=offset,
+            sequence=self.capture_sequence, # Orden de llegada; created_at es la hora del push
+            is_valid=is_valid,
+            errors=errors or []
+            # validated_data podría añadirse aquí si la validación produce datos estructurados
+        )
 
-            datalayer_capture = DataLayerCapture(
-                session=self.session_obj,
-                url=current_url,
-                data=data, # Guardar el datalayer completo capturado
-                is_valid=is_valid,
-                errors=errors or []
-                # validated_data podría añadirse aquí si la validación produce datos estructurados
-            )
-            datalayer_capture.save()
-            logger.debug(f"DataLayer guardado para URL {current_url}. Válido: {is_valid}")
-            return datalayer_capture
-        except Exception as e:
-             logger.exception(f"Error al guardar datalayer en DB para sesión {self.session_id} (URL: {current_url}): {e}")
-             return None
 
+    @database_write_to_async
+    def save_datalayers(self, captures):
+        """Guarda un lote de capturas de DataLayer con una sola inserción"""
+        with timer(DATALAYER_SECONDS, 'save'):
+            DataLayerCapture.objects.bulk_create(captures)
+        logger.debug(f"{len(captures)} capturas de DataLayer guardadas para sesión {self.session_id}")
 
-    @database_sync_to_async
-    def get_screenshots_count(self):
-        """Obtiene el número de capturas de pantalla de la sesión"""
-        if not self.session_obj: return 0
-        try:
-            return Screenshot.objects.filter(session=self.session_obj).count()
-        except Exception as e:
-             logger.exception(f"Error al contar screenshots para sesión {self.session_id}: {e}")
-             return 0
 
-    @database_sync_to_async
-    def get_datalayers_count(self):
-        """Obtiene el número de DataLayers capturados en la sesión"""
-        if not self.session_obj: return 0
-        try:
-            return DataLayerCapture.objects.filter(session=self.session_obj).count()
-        except Exception as e:
-             logger.exception(f"Error al contar datalayers para sesión {self.session_id}: {e}")
-             return 0
+    async def report_lost_datalayers(self, captures, error):
+        """Avisa al cliente de las capturas (ya enviadas con su id) que no se pudieron guardar"""
+        for capture in captures:
+            self.count_datalayer(capture.is_valid, -1)
+        await self.send(text_data=json.dumps({
+            'action': 'datalayer_lost',
+            'ids': [str(capture.id) for capture in captures],
+            'message': f'No se pudieron guardar {len(captures)} capturas de DataLayer: {error}'
+        }))
 
-    @database_sync_to_async
-    def get_validation_stats(self):
-        """Obtiene las estadísticas de validación (válidos/inválidos)"""
-        if not self.session_obj: return 0, 0
-        try:
-            qs = DataLayerCapture.objects.filter(session=self.session_obj)
-            valid_count = qs.filter(is_valid=True).count()
-            invalid_count = qs.filter(is_valid=False).count()
-            return valid_count, invalid_count
-        except Exception as e:
-             logger.exception(f"Error al obtener stats de validación para sesión {self.session_id}: {e}")
-             return 0, 0
 
+    def get_counts(self):
+        """
+        Contadores de la sesión. Se leen de la BD una sola vez al conectar y
+        después se mantienen en memoria a medida que llegan capturas.
+        """
+        # Los screenshots se cuentan cuando el escritor en segundo plano los guarda
+        return dict(self.counts, screenshots=self.counts['screenshots'] + self.screenshot_writer.saved_count)
 
-    @database_sync_to_async
-    def generate_report(self, options=None):
-        """Crea el objeto Report en la base de datos"""
-        if not self.session_obj: raise ValueError("No hay sesión activa para generar reporte")
-        options = options or {}
-        title = options.get('title', f"Validación {self.session_obj.id} - {timezone.now().strftime('%Y-%m-%d')}")
+    def count_datalayer(self, is_valid, delta=1):
+        """Actualiza los contadores en memoria con una captura de DataLayer nueva (o perdida, ``delta`` -1)"""
+        self.counts['datalayers'] += delta
+        if is_valid is True:
+            self.counts['valid'] += delta
+        elif is_valid is False:
+            self.counts['invalid'] += delta
 
+    @database_sync_to_async
+    def load_counts(self):
+        """Obtiene todos los contadores de la sesión con una consulta por tabla"""
+        counts = {'screenshots': 0, 'datalayers': 0, 'valid': 0, 'invalid': 0}
+        if not self.session_obj: return counts
         try:
-            # 1. Obtener todos los DataLayers capturados para esta sesión
-            datalayer_captures = list(DataLayerCapture.objects.filter(session=self.session_obj).order_by('created_at'))
-
-            # 2. Obtener Screenshots (opcionalmente)
-            screenshots = []
-            if options.get('include_screenshots', True):
-                 screenshots = list(Screenshot.objects.filter(session=self.session_obj).order_by('created_at'))
-
-            # 3. Calcular estadísticas
-            valid_count = sum(1 for dl in datalayer_captures if dl.is_valid is True)
-            invalid_count = sum(1 for dl in datalayer_captures if dl.is_valid is False)
-            total_validated = valid_count + invalid_count # Total de DLs que fueron validados (no necesariamente todos los capturados)
-            success_percent = round((valid_count / total_validated) * 100) if total_validated > 0 else 0
-            is_valid_overall = success_percent >= 90 # Ejemplo: considerar válido si 90% o más son válidos
-
-            # 4. Preparar datos para el campo JSON del reporte
-            report_data = {
-                'summary': {
-                    'url': self.session_obj.url,
-                    'session_id': str(self.session_obj.id),
-                    'created_at': self.session_obj.created_at.isoformat(),
-                    'report_generated_at': timezone.now().isoformat(),
-                    'total_datalayers_captured': len(datalayer_captures),
-                    'valid_count': valid_count,
-                    'invalid_count': invalid_count,
-                    'success_percent': success_percent,
-                    'is_valid_overall': is_valid_overall
-                },
-                'details': [
-                    {
-                        'index': i,
-                        'url': dl.url,
-                        'timestamp': dl.created_at.isoformat(),
-                        'data': dl.data if options.get('include_raw_data', True) else {'event': dl.data[-1].get('event', 'N/A') if isinstance(dl.data, list) and dl.data else 'N/A'}, # Mostrar solo evento del último push si no raw
-                        'is_valid': dl.is_valid,
-                        'errors': dl.errors,
-                        'validated_data': getattr(dl, 'validated_data', None) # Incluir si existe
-                    } for i, dl in enumerate(datalayer_captures)
-                ],
-                'screenshots': [
-                     {
-                        'url': s.url,
-                        'timestamp': s.created_at.isoformat(),
-                        'image_url': s.image.url if s.image else None # Verificar si la imagen existe
-                     } for s in screenshots
-                ] if options.get('include_screenshots', True) else [],
-                'reference_comparison': {
-                    # Esta parte necesita la lógica de comparación real
-                    'reference_events_count': len(self.reference_datalayers or []),
-                    'matched_events': 0, # Calcular esto
-                    'missing_events': 0, # Calcular esto
-                    'extra_events': 0    # Calcular esto
-                }
-            }
-
-            # 5. Crear y guardar el objeto Report
-            report = Report(
-                session=self.session_obj,
-                title=title,
-                is_valid=is_valid_overall,
-                data=report_data
-                # Los archivos (HTML, PDF, etc.) se generarían y adjuntarían después si es necesario
-            )
-            report.save()
-            logger.info(f"Objeto Report creado en DB con ID: {report.id}")
-            return report
-
+            counts.update(DataLayerCapture.objects.filter(session=self.session_obj).aggregate(
+                datalayers=Count('id'),
+                valid=Count('id', filter=Q(is_valid=True)),
+                invalid=Count('id', filter=Q(is_valid=False)),
+            ))
+            counts['screenshots'] = Screenshot.objects.filter(session=self.session_obj).count()
         except Exception as e:
-             logger.exception(f"Error CRÍTICO al generar datos para el reporte {self.session_id}: {e}")
-             raise # Relanzar la excepción para que se maneje arriba
+             logger.exception(f"Error al obtener contadores para sesión {self.session_id}: {e}")
+        return counts
 
 
     # --------------------- FUNCIONES DE UTILIDAD Y VALIDACIÓN ---------------------
@@ -1097,89 +1627,12 @@ class SessionConsumer(AsyncWebsocketConsumer):
         Valida una lista de datalayers capturados contra la lista de referencia.
         Esta es una validación simplificada basada en eventos y propiedades clave.
         """
-        results = {'valid': True, 'errors': []}
-        if not self.reference_datalayers:
+        if not self.reference_index:
             # No es un error si no hay referencia, simplemente no se valida
-            # results['errors'].append("No hay DataLayers de referencia cargados para comparar.")
-            # results['valid'] = False # Considerar inválido si no hay referencia? O solo warning?
             logger.info(f"No hay JSON de referencia para sesión {self.session_id}, no se realizará validación.")
             return {'valid': None, 'errors': ['No hay JSON de referencia.']} # Indicar que no se validó
 
-        # Ejemplo: Validar el último evento capturado (simplificación)
-        if not captured_datalayer_list or not isinstance(captured_datalayer_list, list):
-             results['errors'].append("No hay DataLayers capturados válidos para validar.")
-             results['valid'] = False
-             return results
-
-        last_event_captured = None
-        # Buscar el último objeto en la lista que sea un diccionario y tenga 'event'
-        for item in reversed(captured_datalayer_list):
-            if isinstance(item, dict) and 'event' in item:
-                last_event_captured = item
-                break
-
-        if not last_event_captured:
-             # Si no hay evento explícito, no podemos comparar fácilmente. Marcar como no validado.
-             results['errors'].append("No se encontró un evento explícito ('event': '...') en el último push del DataLayer capturado.")
-             results['valid'] = None # Indicar que no se pudo validar vs referencia
-             return results
-
-        event_name = last_event_captured.get('event')
-        logger.debug(f"Validando evento capturado: '{event_name}' contra referencia...")
-
-        # Buscar un evento coincidente en la referencia
-        matching_ref = None
-        validation_errors_for_event = []
-        found_match = False
-        for ref_event in self.reference_datalayers:
-            # Solo comparar si es un diccionario y el nombre del evento coincide
-            if isinstance(ref_event, dict) and ref_event.get('event') == event_name:
-                found_match = True # Encontramos al menos un evento con el mismo nombre
-                match = True # Asumir que coincide hasta encontrar diferencia
-                # Comprobar propiedades clave (simplificado)
-                # Iterar sobre las claves presentes en el evento de referencia
-                for key, ref_value in ref_event.items():
-                     # Ignorar la clave 'event' misma y valores nulos/vacíos en la referencia (asumir que no se validan)
-                     if key == 'event' or ref_value is None or ref_value == '':
-                         continue
-
-                     captured_value = last_event_captured.get(key)
-
-                     # Si la clave no existe en el capturado, es un error
-                     if captured_value is None:
-                          match = False
-                          validation_errors_for_event.append(f"Propiedad requerida '{key}' falta en evento '{event_name}'.")
-                          continue # Pasar a la siguiente clave
-
-                     # Comparar valores (simplificado, considera convertir a string para comparar)
-                     # Ignorar variables tipo {{variable}}
-                     if isinstance(ref_value, str) and '{{' in ref_value and '}}' in ref_value:
-                          continue # Es una variable, no comparar valor exacto
-
-                     # Comparación simple (podría mejorarse para tipos)
-                     if str(ref_value) != str(captured_value):
-                         match = False
-                         validation_errors_for_event.append(f"Propiedad '{key}' no coincide para evento '{event_name}'. Esperado: '{ref_value}', Capturado: '{captured_value}'")
-
-                if match:
-                     # Si todas las propiedades coinciden para este evento de referencia, lo consideramos válido
-                     matching_ref = ref_event
-                     validation_errors_for_event = [] # Limpiar errores si encontramos un match perfecto
-                     break # Salir del bucle de referencia, encontramos un match válido
-
-        # Evaluar resultados de la búsqueda
-        if not found_match:
-             results['errors'].append(f"No se encontró ningún evento de referencia con nombre '{event_name}'.")
-             results['valid'] = False
-        elif not matching_ref: # Se encontró el evento pero ninguna referencia coincidió perfectamente
-             results['errors'].extend(validation_errors_for_event) # Añadir los errores del último intento de match
-             results['valid'] = False
-        elif results['errors']: # Si por alguna razón quedaron errores (no debería pasar si matching_ref se encontró)
-             results['valid'] = False
-
-
-        logger.debug(f"Resultado validación para evento '{event_name}': Válido={results['valid']}, Errores={results['errors']}")
-        return results
+        return self.reference_index.validate(captured_datalayer_list)
 
 
     async def send_error_message(self, message):
@@ -0,0 +1,68 @@
+# core/datalayer_stream.py
+"""
+Streaming del dataLayer de la página hacia Python.
+
+Lo comparten las sesiones interactivas (``core/consumers.py``) y los lotes
+headless (``core/batch.py``): el script se instala con ``add_init_script`` y
+cada push llega por el binding ``__dlPush`` con ``{seq, index, url, data}``.
+"""
+
+# Eventos que GTM empuja por sí mismo y que no se validan contra la referencia
+INTERNAL_EVENT_PREFIXES = ('gtm.',)
+
+# Script inyectado con add_init_script: se ejecuta en cada documento antes que
+# los scripts de la página, así que sobrevive a las navegaciones. Cada push se
+# envía a Python por el binding expuesto ``__dlPush`` en cuanto ocurre.
+DATALAYER_STREAM_SCRIPT = """(() => {
+    if (window.__dlStreamInstalled) return;
+    window.__dlStreamInstalled = true;
+    let seq = 0;
+    const nativePush = Array.prototype.push;
+
+    const emit = (entry, index) => {
+        let data;
+        try {
+            data = JSON.parse(JSON.stringify(entry === undefined ? null : entry));
+        } catch (e) {
+            data = { __unserializable__: String(e) }; // Objetos circulares, etc.
+        }
+        try {
+            window.__dlPush({ seq: seq++, index: index, url: location.href, data: data });
+        } catch (e) {
+            console.error('[DL Stream] Error enviando push:', e);
+        }
+    };
+
+    const instrument = (arr) => {
+        if (!Array.isArray(arr) || arr.__dlInstrumented) return arr;
+        Object.defineProperty(arr, '__dlInstrumented', { value: true });
+        arr.forEach((entry, index) => emit(entry, index)); // Entradas empujadas antes de instrumentar
+        let currentPush = arr.push;
+        let depth = 0;
+        const wrapped = function () {
+            // GTM reemplaza push y llama al anterior: evitar emitir dos veces
+            if (depth > 0) return nativePush.apply(this, arguments);
+            depth++;
+            try {
+                const base = arr.length; // Posición de cada entrada en el array
+                Array.prototype.forEach.call(arguments, (entry, i) => emit(entry, base + i));
+                return currentPush.apply(this, arguments);
+            } finally {
+                depth--;
+            }
+        };
+        Object.defineProperty(arr, 'push', {
+            configurable: true,
+            get() { return wrapped; },
+            set(fn) { currentPush = fn; } // Encadenar el push que instale GTM
+        });
+        return arr;
+    };
+
+    let dataLayer = instrument(window.dataLayer);
+    Object.defineProperty(window, 'dataLayer', {
+        configurable: true,
+        get() { return dataLayer; },
+        set(value) { dataLayer = instrument(value); }
+    });
+})();"""
@@ -0,0 +1,75 @@
+# core/db.py
+"""
+Acceso a base de datos desde los consumers.
+
+``database_sync_to_async`` de Channels usa por defecto el modo
+*thread_sensitive*: todas las llamadas de todos los consumers del proceso se
+ejecutan en un único hilo, una detrás de otra. Para las escrituras frecuentes
+(``save_datalayers``, ``save_screenshot``) se usa ``database_write_to_async``,
+que las ejecuta en un pool de hilos propio y acotado. Cada hilo mantiene su
+conexión persistente (``CONN_MAX_AGE``), así que el número de conexiones
+abiertas nunca supera ``DB_ASYNC_SETTINGS['WRITE_WORKERS']``.
+
+Con PostgreSQL las escrituras de varias sesiones avanzan en paralelo; con
+SQLite conviene dejar un único hilo, ya que solo hay un escritor a la vez
+(ver ``manage.py benchmark_db_writes``).
+
+Ambos decoradores miden cuánto espera cada llamada hasta que un hilo la
+empieza (``dlv_db_queue_wait_seconds``, ver ``core/metrics.py``).
+"""
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from .metrics import DB_QUEUE_WAIT_SECONDS
+
+
+_write_executor = None
+
+
+def get_write_executor():
+    """Pool de hilos compartido para las escrituras (se crea al primer uso)"""
+    global _write_executor
+    if _write_executor is None:
+        workers = getattr(settings, 'DB_ASYNC_SETTINGS', {}).get('WRITE_WORKERS', 1)
+        _write_executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='db-write')
+    return _write_executor
+
+
+def _timed_database_to_async(func, executor_label, **options):
+    """DatabaseSyncToAsync que mide la espera en cola hasta que el hilo empieza la tarea"""
+    def timed(submitted_at, *args, **kwargs):
+        DB_QUEUE_WAIT_SECONDS.labels(executor_label).observe(time.monotonic() - submitted_at)
+        return func(*args, **kwargs)
+
+    runner = DatabaseSyncToAsync(timed, **options)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await runner(time.monotonic(), *args, **kwargs)
+    return wrapper
+
+
+def database_sync_to_async(func):
+    """``database_sync_to_async`` de Channels (hilo compartido) con métrica de espera"""
+    return _timed_database_to_async(func, 'shared')
+
+
+def database_write_to_async(func):
+    """Como ``database_sync_to_async`` pero en el pool de escrituras"""
+    return _timed_database_to_async(func, 'write', thread_sensitive=False, executor=get_write_executor())
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    """Activa WAL en SQLite para que las lecturas no bloqueen a los escritores"""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode=WAL;')
+        cursor.execute('PRAGMA synchronous=NORMAL;')
@@ -0,0 +1,134 @@
+# core/display.py
+"""
+Servidor X virtual bajo demanda para los navegadores con ventana.
+
+Las sesiones headless no necesitan ningún display. Para las que piden
+ventana, ``virtual_display.ensure()`` devuelve el ``DISPLAY`` a usar:
+
+- si el proceso ya tiene ``DISPLAY`` (escritorio local, Xvfb externo), ese;
+- si no, arranca un Xvfb propio con ``-displayfd`` (elige un número de
+  display libre, así varios procesos no chocan) y lo reutiliza mientras
+  haya navegadores con ventana.
+
+El pool de navegadores llama a ``stop()`` cuando ya no le queda ninguno con
+ventana, y el Xvfb se termina también al salir del proceso.
+"""
+import asyncio
+import atexit
+import logging
+import os
+import subprocess
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class DisplayError(RuntimeError):
+    """No hay display disponible para un navegador con ventana"""
+
+
+class VirtualDisplay:
+    """Xvfb propio del proceso, arrancado con el primer navegador con ventana"""
+
+    def __init__(self, screen='1980x1020x24', start_timeout=10):
+        self.screen = screen
+        self.start_timeout = start_timeout
+        self.process = None
+        self.display = None
+        self._lock = None
+
+    @classmethod
+    def from_settings(cls):
+        playwright_settings = getattr(settings, 'PLAYWRIGHT_SETTINGS', {})
+        return cls(screen=playwright_settings.get('XVFB_SCREEN', '1980x1020x24'))
+
+    def _get_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def ensure(self):
+        """Devuelve el DISPLAY para un navegador con ventana, arrancando Xvfb si hace falta"""
+        external = os.environ.get('DISPLAY')
+        if external:
+            return external
+        async with self._get_lock():
+            if not self.running:
+                await self._start()
+            return self.display
+
+    async def stop(self):
+        """Termina el Xvfb propio (no hace nada con un DISPLAY externo)"""
+        async with self._get_lock():
+            if not self.running:
+                return
+            logger.info(f"Deteniendo Xvfb {self.display}: no quedan navegadores con ventana")
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), 5)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+            self.process = None
+            self.display = None
+
+    def stop_sync(self):
+        """Versión síncrona para ``atexit``"""
+        if self.running:
+            try:
+                self.process.terminate()
+            except ProcessLookupError:
+                pass
+
+    # --------------------- FUNCIONES INTERNAS ---------------------
+
+    async def _start(self):
+        # Xvfb escribe el número de display elegido en el descriptor de -displayfd cuando está listo
+        read_fd, write_fd = os.pipe()
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                'Xvfb', '-displayfd', str(write_fd), '-screen', '0', self.screen, '-ac', '-nolisten', 'tcp',
+                pass_fds=(write_fd,),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        except FileNotFoundError:
+            os.close(read_fd)
+            raise DisplayError("Xvfb no está instalado: usa sesiones headless o define DISPLAY")
+        finally:
+            os.close(write_fd)
+
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def on_readable():
+            if not ready.done():
+                ready.set_result(os.read(read_fd, 32))
+
+        loop.add_reader(read_fd, on_readable)
+        try:
+            output = await asyncio.wait_for(ready, self.start_timeout)
+        except asyncio.TimeoutError:
+            output = b''
+        finally:
+            loop.remove_reader(read_fd)
+            os.close(read_fd)
+
+        number = output.decode(errors='replace').strip()
+        if not number.isdigit():
+            if self.process.returncode is None:
+                self.process.kill()
+            await self.process.wait()
+            self.process = None
+            raise DisplayError(f"Xvfb no arrancó en {self.start_timeout}s")
+        self.display = f':{number}'
+        logger.info(f"Xvfb arrancado en {self.display} (pid {self.process.pid}, pantalla {self.screen})")
+
+
+virtual_display = VirtualDisplay.from_settings()
+atexit.register(virtual_display.stop_sync)
@@ -0,0 +1,188 @@
+# core/exports.py
+"""
+Exportación en streaming de las capturas de DataLayer de una sesión.
+
+Las filas se leen con ``iterator()`` (cursor de servidor en PostgreSQL) y se
+emiten en bloques de ~64 KB, así que la memoria no depende del número de
+capturas. Formatos:
+
+- ``ndjson``: una línea JSON por captura;
+- ``csv``: una fila por entrada del dataLayer, con las claves del evento
+  aplanadas en columnas (``ecommerce.value``...). Las columnas se obtienen
+  con una primera pasada que solo lee ``data``;
+- ``csv.gz`` / ``ndjson.gz``: lo mismo comprimido con gzip al vuelo.
+
+Bajo ASGI (Daphne) la respuesta necesita un iterador asíncrono: Django 4.2
+consume los síncronos con ``sync_to_async(list)``, es decir, genera el
+fichero entero en memoria antes de enviar el primer byte. ``aiter_chunks``
+pide cada bloque por separado al generador síncrono.
+"""
+import csv
+import json
+import zlib
+
+from asgiref.sync import sync_to_async
+
+from .models import DataLayerCapture
+
+EXPORT_FORMATS = ('csv', 'ndjson', 'csv.gz', 'ndjson.gz')
+
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+CHUNK_SIZE = 2000 # Filas por viaje al cursor
+FLUSH_BYTES = 64 * 1024 # Tamaño aproximado de cada bloque de la respuesta
+
+CSV_BASE_COLUMNS = ['capture_id', 'index', 'timestamp', 'url', 'is_valid', 'errors']
+
+_END = object() # Fin del generador (StopIteration no atraviesa sync_to_async)
+
+
+class _Echo:
+    """Pseudo-fichero para csv.writer: devuelve la línea en vez de escribirla"""
+
+    def write(self, value):
+        return value
+
+
+def filter_captures(session, is_valid=None, url=None):
+    """Capturas de la sesión en orden, con los filtros que se pueden aplicar en la BD"""
+    captures = DataLayerCapture.objects.filter(session=session)
+    if is_valid == 'true':
+        captures = captures.filter(is_valid=True)
+    elif is_valid == 'false':
+        captures = captures.filter(is_valid=False)
+    elif is_valid == 'none':
+        captures = captures.filter(is_valid__isnull=True)
+    if url:
+        captures = captures.filter(url__icontains=url)
+    return captures.in_capture_order()
+
+
+def flatten(value, prefix=''):
+    """Aplana diccionarios anidados en claves con puntos; las listas quedan como JSON"""
+    if isinstance(value, dict):
+        flat = {}
+        for key, item in value.items():
+            flat.update(flatten(item, f'{prefix}{key}.'))
+        return flat
+    return {prefix[:-1] or 'value': value}
+
+
+def _csv_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def _capture_entries(capture, event=None):
+    """Entradas de una captura (posición, entrada), filtradas por evento si se pide"""
+    entries = capture.entries()
+    if event is None:
+        return entries
+    return [(index, entry) for index, entry in entries if isinstance(entry, dict) and entry.get('event') == event]
+
+
+def _buffered(lines):
+    """Agrupa líneas en bloques de ~FLUSH_BYTES para no emitir una respuesta por fila"""
+    buffer, size = [], 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= FLUSH_BYTES:
+            yield ''.join(buffer).encode('utf-8')
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+
+def gzip_stream(chunks):
+    """Comprime al vuelo un iterable de bytes en formato gzip"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # wbits 31: cabecera gzip
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def ndjson_lines(captures, event=None):
+    for capture in captures.iterator(chunk_size=CHUNK_SIZE):
+        if event is not None and not _capture_entries(capture, event):
+            continue
+        yield json.dumps({
+            'id': str(capture.id),
+            'offset': capture.offset,
+            'timestamp': capture.created_at.isoformat(),
+            'url': capture.url,
+            'is_valid': capture.is_valid,
+            'errors': capture.errors,
+            'data': capture.data,
+        }, ensure_ascii=False) + '\n'
+
+
+def csv_columns(captures, event=None):
+    """Primera pasada: todas las claves aplanadas de las entradas (solo se lee ``data``)"""
+    keys = set()
+    for capture in captures.only('id', 'data', 'offset').iterator(chunk_size=CHUNK_SIZE):
+        for index, entry in _capture_entries(capture, event):
+            keys.update(flatten(entry))
+    # 'event' primero, el resto en orden alfabético
+    return (['event'] if 'event' in keys else []) + sorted(keys - {'event'})
+
+
+def csv_lines(captures, event=None):
+    data_columns = csv_columns(captures, event)
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_BASE_COLUMNS + data_columns)
+    for capture in captures.iterator(chunk_size=CHUNK_SIZE):
+        for index, entry in _capture_entries(capture, event):
+            flat = flatten(entry)
+            yield writer.writerow([
+                capture.id,
+                index,
+                capture.created_at.isoformat(),
+                capture.url,
+                '' if capture.is_valid is None else capture.is_valid,
+                ' | '.join(str(error) for error in capture.errors or []),
+            ] + [_csv_cell(flat.get(column)) for column in data_columns])
+
+
+def export_stream(captures, format_type, event=None):
+    """Bloques de bytes del fichero exportado en el formato pedido"""
+    base_format = format_type.removesuffix('.gz')
+    lines = csv_lines(captures, event) if base_format == 'csv' else ndjson_lines(captures, event)
+    chunks = _buffered(lines)
+    if format_type.endswith('.gz'):
+        return gzip_stream(chunks)
+    return chunks
+
+
+async def aiter_chunks(chunks):
+    """
+    Recorre un iterable síncrono de bloques desde código asíncrono, un bloque
+    por llamada y siempre en el mismo hilo (el cursor de la BD vive en él).
+    """
+    chunks = iter(chunks)
+    next_chunk = sync_to_async(next, thread_sensitive=True)
+    try:
+        while True:
+            chunk = await next_chunk(chunks, _END)
+            if chunk is _END:
+                return
+            yield chunk
+    finally:
+        # Cliente desconectado: cerrar el generador (y su cursor) en su hilo
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            await sync_to_async(close, thread_sensitive=True)()
+
+
+def export_content_type(format_type):
+    if format_type.endswith('.gz'):
+        return 'application/gzip'
+    return EXPORT_CONTENT_TYPES[format_type]
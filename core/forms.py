@@ -13,17 +13,21 @@ class SessionForm(forms.ModelForm):
 
     class Meta:
         model = Session
-        fields = ['url', 'json_file', 'browser_type','description']
+        fields = ['url', 'json_file', 'browser_type', 'headless', 'resource_policy', 'description']
         widgets = {
             'url': forms.URLInput(attrs={'class': 'form-control', 'placeholder': 'https://ejemplo.com'}),
             'json_file': forms.FileInput(attrs={'class': 'form-control'}),
             'browser_type': forms.Select(attrs={'class': 'form-select'}),
+            'headless': forms.CheckboxInput(attrs={'class': 'form-check-input'}),
+            'resource_policy': forms.Select(attrs={'class': 'form-select'}),
             'description': forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Descripción opcional de la sesión'}),
         }
         help_texts = {
             'url': _('URL del sitio web que deseas validar'),
             'json_file': _('Archivo JSON con la estructura esperada de DataLayers'),
             'browser_type': _('Navegador a utilizar para la automatización'),
+            'headless': _('Sin ventana real: consume menos CPU y memoria (la vista llega igual por capturas)'),
+            'resource_policy': _('Recursos que no se descargan al cargar páginas; el tag manager y la analítica siempre se cargan'),
             'description': _('Descripción opcional para identificar esta sesión'),
         }
 
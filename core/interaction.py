@@ -0,0 +1,173 @@
+# core/interaction.py
+"""
+Runtime de interacción inyectado en la página.
+
+El clic clásico (``mode: 'mouse'``) identifica el elemento con un
+``evaluate``, mueve el ratón de Playwright paso a paso y después espera a
+que la página se estabilice: varios viajes de ida y vuelta por CDP.
+
+Con ``mode: 'runtime'`` todo ocurre en un solo ``evaluate``: el runtime
+(instalado con ``add_init_script`` en cada documento) localiza el elemento
+en las coordenadas, le envía la secuencia pointer/mouse/click, espera a que
+el dataLayer deje de recibir pushes y devuelve el elemento junto con las
+entradas empujadas por el clic. Los eventos son sintéticos
+(``isTrusted: false``); si una página los ignora, el modo ``mouse`` sigue
+disponible.
+
+Si el clic navega, el contexto de la página se destruye antes de responder:
+el resultado se marca ``navigated`` y los pushes del nuevo documento llegan,
+como siempre, por el streaming del dataLayer.
+"""
+import logging
+
+from playwright.async_api import Error as PlaywrightError
+
+logger = logging.getLogger(__name__)
+
+CLICK_MODE_MOUSE = 'mouse'
+CLICK_MODE_RUNTIME = 'runtime'
+CLICK_MODES = (CLICK_MODE_MOUSE, CLICK_MODE_RUNTIME)
+
+MAX_DELTA_ENTRIES = 200 # Pushes devueltos como máximo por clic
+
+# Se inyecta con add_init_script para que exista en cada documento
+INTERACTION_RUNTIME_SCRIPT = """(() => {
+    if (window.__dlvInteract) return;
+    const INTERACTIVE = 'a, button, input, select, textarea, label, summary, [onclick], [role="button"], [role="link"], [role="tab"], [role="menuitem"]';
+
+    const dataLayerLength = () => (Array.isArray(window.dataLayer) ? window.dataLayer.length : 0);
+
+    const serialize = (entry) => {
+        try {
+            return JSON.parse(JSON.stringify(entry === undefined ? null : entry));
+        } catch (e) {
+            return { __unserializable__: String(e) };
+        }
+    };
+
+    const cssPath = (element) => {
+        const parts = [];
+        for (let node = element; node && node.nodeType === 1 && parts.length < 5; node = node.parentElement) {
+            if (node.id) {
+                parts.unshift('#' + CSS.escape(node.id));
+                break;
+            }
+            let part = node.tagName.toLowerCase();
+            const parent = node.parentElement;
+            if (parent) {
+                const siblings = Array.prototype.filter.call(parent.children, (child) => child.tagName === node.tagName);
+                if (siblings.length > 1) part += ':nth-of-type(' + (siblings.indexOf(node) + 1) + ')';
+            }
+            parts.unshift(part);
+        }
+        return parts.join(' > ');
+    };
+
+    const describe = (element) => {
+        const target = element.closest(INTERACTIVE) || element;
+        return {
+            tagName: element.tagName.toLowerCase(),
+            id: element.id || '',
+            className: element.getAttribute('class') || '',
+            isInteractive: target !== element || element.matches(INTERACTIVE),
+            target: target.tagName.toLowerCase(),
+            selector: cssPath(target),
+            href: target.href ? String(target.href) : null,
+            innerText: (target.innerText || '').substring(0, 50).replace(/\\n/g, ' ')
+        };
+    };
+
+    const dispatchClick = (element, x, y) => {
+        const base = { bubbles: true, cancelable: true, composed: true, view: window, clientX: x, clientY: y, button: 0 };
+        const pointer = Object.assign({ pointerId: 1, pointerType: 'mouse', isPrimary: true }, base);
+        const PointerCtor = window.PointerEvent || window.MouseEvent;
+        element.dispatchEvent(new PointerCtor('pointerover', pointer));
+        element.dispatchEvent(new MouseEvent('mouseover', base));
+        element.dispatchEvent(new PointerCtor('pointerdown', Object.assign({ buttons: 1 }, pointer)));
+        element.dispatchEvent(new MouseEvent('mousedown', Object.assign({ buttons: 1 }, base)));
+        if (typeof element.focus === 'function') element.focus({ preventScroll: true });
+        element.dispatchEvent(new PointerCtor('pointerup', pointer));
+        element.dispatchEvent(new MouseEvent('mouseup', base));
+        // El click sintético también activa enlaces y envía formularios
+        element.dispatchEvent(new MouseEvent('click', Object.assign({ detail: 1 }, base)));
+    };
+
+    // Resuelve cuando el dataLayer lleva quietMs sin crecer (o al llegar a maxMs)
+    const waitForQuiet = (quietMs, maxMs) => new Promise((resolve) => {
+        const start = performance.now();
+        let lastLength = dataLayerLength();
+        let lastChange = start;
+        const check = () => {
+            const now = performance.now();
+            const length = dataLayerLength();
+            if (length !== lastLength) {
+                lastLength = length;
+                lastChange = now;
+            }
+            if (now - lastChange >= quietMs || now - start >= maxMs) return resolve();
+            setTimeout(check, 20);
+        };
+        setTimeout(check, 20);
+    });
+
+    window.__dlvInteract = {
+        click: (x, y, quietMs, maxMs, maxEntries) => new Promise((resolve) => {
+            const start = performance.now();
+            const element = document.elementFromPoint(x, y);
+            if (!element) return resolve({ found: false, element: null, pushes: [], navigated: false, url: location.href, duration_ms: 0 });
+
+            const before = dataLayerLength();
+            const info = describe(element);
+            const finish = (navigated) => {
+                window.removeEventListener('beforeunload', onUnload);
+                const pushes = Array.isArray(window.dataLayer) ? window.dataLayer.slice(before, before + maxEntries).map(serialize) : [];
+                resolve({
+                    found: true,
+                    element: info,
+                    pushes: pushes,
+                    navigated: navigated,
+                    url: location.href,
+                    duration_ms: Math.round(performance.now() - start)
+                });
+            };
+            // Si el clic navega, responder antes de que se destruya el documento
+            const onUnload = () => finish(true);
+            window.addEventListener('beforeunload', onUnload);
+
+            dispatchClick(element, x, y);
+            waitForQuiet(quietMs, maxMs).then(() => finish(false));
+        })
+    };
+})();"""
+
+CLICK_SCRIPT = """([x, y, quietMs, maxMs, maxEntries]) => (
+    window.__dlvInteract ? window.__dlvInteract.click(x, y, quietMs, maxMs, maxEntries) : null
+)"""
+
+
+# Mensajes de Playwright cuando el documento desaparece a mitad del evaluate
+NAVIGATION_ERROR_MARKERS = (
+    'Execution context was destroyed', # El clic navegó
+    'Target page, context or browser has been closed', # El clic cerró la página (p. ej. window.close())
+    'Frame was detached', # El iframe se eliminó
+)
+
+
+def is_navigation_error(error):
+    """El evaluate falló porque el documento se descargó (el clic navegó); el resto de errores se propagan"""
+    message = str(error)
+    return any(marker in message for marker in NAVIGATION_ERROR_MARKERS)
+
+
+async def click_in_page(page, x, y, quiet_ms=150, max_wait_ms=1500):
+    """
+    Hace clic en (x, y) con el runtime de la página en un solo viaje de ida y vuelta.
+    Devuelve el resultado del runtime o ``None`` si el runtime no está instalado.
+    """
+    try:
+        return await page.evaluate(CLICK_SCRIPT, [x, y, quiet_ms, max_wait_ms, MAX_DELTA_ENTRIES])
+    except PlaywrightError as e:
+        if not is_navigation_error(e):
+            raise
+        logger.debug(f"El clic en ({x}, {y}) navegó antes de responder: {e}")
+        return {'found': True, 'element': None, 'pushes': [], 'navigated': True, 'url': None, 'duration_ms': None}
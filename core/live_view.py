@@ -0,0 +1,57 @@
+# core/live_view.py
+"""
+Frames binarios para la vista en vivo del navegador.
+
+En modo vista en vivo las capturas viajan como frames binarios de WebSocket
+con una cabecera fija de 6 bytes (big-endian) seguida del JPEG:
+
+    versión (uint8) | tipo (uint8) | secuencia (uint32) | payload
+
+El cliente las pinta directamente desde un Blob, sin pasar por disco ni por
+una segunda petición HTTP. Guardar el frame como ``Screenshot`` pasa a ser
+opcional según una política de persistencia.
+"""
+import struct
+
+FRAME_VERSION = 1
+FRAME_TYPE_JPEG = 1
+
+FRAME_HEADER = struct.Struct('!BBI')
+
+# Modos de persistencia de capturas en vista en vivo
+PERSIST_ALL = 'all' # Guardar todas (comportamiento clásico)
+PERSIST_SAMPLED = 'sampled' # Guardar una de cada N
+PERSIST_EVENTS = 'events' # Guardar solo si hubo pushes del dataLayer desde la anterior
+PERSIST_NONE = 'none'
+PERSIST_MODES = (PERSIST_ALL, PERSIST_SAMPLED, PERSIST_EVENTS, PERSIST_NONE)
+
+
+def encode_frame(seq, payload, frame_type=FRAME_TYPE_JPEG):
+    """Antepone la cabecera binaria al payload"""
+    return FRAME_HEADER.pack(FRAME_VERSION, frame_type, seq & 0xFFFFFFFF) + payload
+
+
+def decode_frame(data):
+    """Separa cabecera y payload (útil para clientes Python y depuración)"""
+    version, frame_type, seq = FRAME_HEADER.unpack_from(data)
+    return version, frame_type, seq, data[FRAME_HEADER.size:]
+
+
+class PersistPolicy:
+    """Decide qué capturas de la vista en vivo se guardan en la base de datos"""
+
+    def __init__(self, mode=PERSIST_EVENTS, sample_every=10):
+        self.mode = mode if mode in PERSIST_MODES else PERSIST_EVENTS
+        self.sample_every = max(1, int(sample_every))
+        self.frames_seen = 0
+
+    def should_persist(self, relevant=False):
+        """``relevant`` indica que la captura acompaña a eventos del dataLayer"""
+        self.frames_seen += 1
+        if self.mode == PERSIST_ALL:
+            return True
+        if self.mode == PERSIST_SAMPLED:
+            return relevant or (self.frames_seen - 1) % self.sample_every == 0
+        if self.mode == PERSIST_EVENTS:
+            return relevant
+        return False
@@ -0,0 +1,284 @@
+# core/macros.py
+"""
+Macros de interacción: una secuencia de pasos en un solo mensaje.
+
+El cliente envía ``{"action": "macro", "steps": [...]}`` y la sesión ejecuta
+los pasos seguidos, sin screenshot ni comprobación del dataLayer entre
+ellos, y responde con un único ``macro_result``. Los pasos usan el mismo
+vocabulario que los recorridos de ``core/batch.py`` más tres propios::
+
+    {"action": "goto", "url": "https://tienda.example/"}
+    {"action": "click", "selector": "#comprar"}          # o "x"/"y" en 0..1 del viewport
+    {"action": "type", "selector": "#email", "text": "qa@example.com"}
+    {"action": "wait", "ms": 500}
+    {"action": "wait_for_event", "event": "add_to_cart", "timeout": 5000}
+    {"action": "assert_datalayer", "event": "purchase", "valid": true,
+     "match": {"ecommerce.currency": "EUR"}}
+
+Cualquier paso admite ``"checkpoint": true`` (captura de pantalla y
+resumen del estado en ese punto) y ``"settle": false`` (no esperar a que la
+página se estabilice tras él). Los ``ms`` de ``wait`` y los ``timeout`` de
+cada paso se recortan a ``INTERACTION_SETTINGS['MACRO_MAX_WAIT_MS']`` y
+``['MACRO_MAX_TIMEOUT_MS']``.
+
+``wait_for_event`` y ``assert_datalayer`` miran los pushes recibidos
+durante la macro. Los pushes se siguen validando, guardando y enviando uno a
+uno como siempre. Un error en un paso detiene la macro; una aserción fallida
+solo la detiene con ``"stop_on_failure": true``.
+"""
+import asyncio
+import logging
+import time
+
+from .interaction import click_in_page
+
+logger = logging.getLogger(__name__)
+
+STEP_ACTIONS = ('goto', 'click', 'type', 'wait', 'wait_for_event', 'assert_datalayer')
+
+_MISSING = object()
+
+
+class MacroError(ValueError):
+    """Definición de macro no válida"""
+
+
+def parse_macro(steps, max_steps=100, max_wait_ms=30000, max_timeout_ms=60000):
+    """Valida la lista de pasos y la devuelve con esperas y timeouts recortados a los máximos"""
+    if not isinstance(steps, list) or not steps:
+        raise MacroError("La macro necesita una lista no vacía de pasos en 'steps'")
+    if len(steps) > max_steps:
+        raise MacroError(f"La macro tiene {len(steps)} pasos (máximo {max_steps})")
+    parsed = []
+    for number, step in enumerate(steps, start=1):
+        action = step.get('action') if isinstance(step, dict) else None
+        if action not in STEP_ACTIONS:
+            raise MacroError(f"Paso {number}: acción desconocida {action!r} (válidas: {', '.join(STEP_ACTIONS)})")
+        if action == 'goto' and not step.get('url'):
+            raise MacroError(f"Paso {number}: 'goto' necesita 'url'")
+        if action == 'click' and not step.get('selector') and (step.get('x') is None or step.get('y') is None):
+            raise MacroError(f"Paso {number}: 'click' necesita 'selector' o coordenadas 'x' e 'y'")
+        if action == 'type' and not step.get('selector'):
+            raise MacroError(f"Paso {number}: 'type' necesita 'selector'")
+        if action == 'wait_for_event' and not step.get('event'):
+            raise MacroError(f"Paso {number}: 'wait_for_event' necesita 'event'")
+        if action == 'assert_datalayer' and not (step.get('event') or step.get('match')):
+            raise MacroError(f"Paso {number}: 'assert_datalayer' necesita 'event' o 'match'")
+        if 'match' in step and not isinstance(step['match'], dict):
+            raise MacroError(f"Paso {number}: 'match' debe ser un objeto {{ruta: valor}}")
+        for key, limit in (('ms', max_wait_ms), ('timeout', max_timeout_ms)):
+            if key not in step:
+                continue
+            value = step[key]
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise MacroError(f"Paso {number}: '{key}' debe ser un número de milisegundos no negativo")
+            if limit and value > limit:
+                step = dict(step, **{key: limit})
+        parsed.append(step)
+    return parsed
+
+
+def get_path(entry, path):
+    """Valor de ``entry`` en la ruta con puntos (``ecommerce.items.0.id``)"""
+    value = entry
+    for part in path.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return _MISSING
+    return value
+
+
+def push_matches(push, step):
+    """El push cumple el evento, los valores de ``match`` y, si se pide, la validación"""
+    entry = push['data']
+    if step.get('event') and not (isinstance(entry, dict) and entry.get('event') == step['event']):
+        return False
+    for path, expected in (step.get('match') or {}).items():
+        if get_path(entry, path) != expected:
+            return False
+    if 'valid' in step and push['valid'] is not step['valid']:
+        return False
+    return True
+
+
+class MacroRun:
+    """Ejecución de una macro sobre la página de un ``SessionConsumer``"""
+
+    def __init__(self, consumer, steps, stop_on_failure=False, event_timeout_ms=10000):
+        self.consumer = consumer
+        self.steps = steps
+        self.stop_on_failure = stop_on_failure
+        self.event_timeout_ms = event_timeout_ms
+        self.pushes = [] # Pushes recibidos durante la macro, con el paso en curso
+        self.step_results = []
+        self.checkpoints = []
+        self.current_step = 0
+        self.result = None
+        self._push_arrived = asyncio.Event()
+
+    def on_push(self, push):
+        """Lo llama el consumer por cada push procesado mientras dura la macro"""
+        self.pushes.append(dict(push, step=self.current_step))
+        self._push_arrived.set()
+
+    async def run(self):
+        """Ejecuta los pasos y devuelve el resultado consolidado (también si se cancela)"""
+        started = time.monotonic()
+        status = 'completed'
+        try:
+            for number, step in enumerate(self.steps, start=1):
+                self.current_step = number
+                result = await self.run_step(number, step)
+                self.step_results.append(result)
+                if result['status'] == 'error' or (result['status'] == 'failed' and self.stop_on_failure):
+                    status = 'failed'
+                    break
+        except asyncio.CancelledError:
+            status = 'cancelled'
+            raise
+        finally:
+            self.result = self.summary(status, started)
+        return self.result
+
+    async def run_step(self, number, step):
+        action = step['action']
+        page = self.consumer.page
+        step_started = time.monotonic()
+        pushes_before = len(self.pushes)
+        result = {'step': number, 'action': action, 'status': 'ok'}
+        try:
+            if action == 'goto':
+                await page.goto(step['url'], wait_until='domcontentloaded', timeout=step.get('timeout', 60000))
+                await self.settle(step, navigation=True)
+            elif action == 'click':
+                await self.click(page, step, result)
+                await self.settle(step)
+            elif action == 'type':
+                if step.get('delay'):
+                    await page.fill(step['selector'], '', timeout=step.get('timeout', 10000))
+                    await page.locator(step['selector']).type(str(step.get('text', '')), delay=step['delay'])
+                else:
+                    await page.fill(step['selector'], str(step.get('text', '')), timeout=step.get('timeout', 10000))
+                await self.settle(step)
+            elif action == 'wait':
+                await asyncio.sleep(float(step.get('ms', 1000)) / 1000)
+            elif action == 'wait_for_event':
+                push = await self.wait_for_event(step)
+                if push is None:
+                    result['status'] = 'failed'
+                    result['error'] = f"No llegó el evento '{step['event']}' en {step.get('timeout', self.event_timeout_ms)} ms"
+                else:
+                    result['push_id'] = push['id']
+            elif action == 'assert_datalayer':
+                self.assert_datalayer(step, result)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Macro de sesión {self.consumer.session_id}: error en el paso {number} ({action}): {e}")
+            result['status'] = 'error'
+            result['error'] = str(e)
+
+        result['duration_ms'] = int((time.monotonic() - step_started) * 1000)
+        result['pushes'] = len(self.pushes) - pushes_before
+        if step.get('checkpoint'):
+            await self.checkpoint(number)
+        return result
+
+    async def click(self, page, step, result):
+        if step.get('selector'):
+            await page.click(step['selector'], timeout=step.get('timeout', 10000))
+            return
+        viewport = page.viewport_size or {'width': 1280, 'height': 720}
+        x = max(0, min(viewport['width'] - 1, int(viewport['width'] * float(step['x']))))
+        y = max(0, min(viewport['height'] - 1, int(viewport['height'] * float(step['y']))))
+        clicked = await click_in_page(page, x, y, quiet_ms=0, max_wait_ms=0)
+        if clicked is None:
+            await page.mouse.click(x, y) # Documento sin runtime de interacción
+        elif not clicked['found']:
+            raise RuntimeError(f"No hay ningún elemento en ({x}, {y})")
+        else:
+            result['element'] = clicked['element']
+
+    async def settle(self, step, navigation=False):
+        detector = self.consumer.settle_detector
+        if detector and step.get('settle', True):
+            timeout = self.consumer.settle_settings.get('NAVIGATION_TIMEOUT_MS') if navigation else None
+            await detector.wait(timeout)
+
+    async def wait_for_event(self, step):
+        """Primer push con ese evento desde el último paso que no fue una espera o aserción"""
+        since = self.last_action_index()
+        deadline = time.monotonic() + float(step.get('timeout', self.event_timeout_ms)) / 1000
+        while True:
+            for push in self.pushes[since:]:
+                if push_matches(push, step):
+                    return push
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self._push_arrived.clear()
+            try:
+                await asyncio.wait_for(self._push_arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def assert_datalayer(self, step, result):
+        """Algún push de la macro cumple la aserción (``count`` exige un número exacto)"""
+        matches = [push for push in self.pushes if push_matches(push, step)]
+        result['matches'] = len(matches)
+        expected_count = step.get('count')
+        passed = len(matches) == expected_count if expected_count is not None else bool(matches)
+        if not passed:
+            result['status'] = 'failed'
+            expected = f"{expected_count} pushes" if expected_count is not None else "algún push"
+            result['error'] = f"Se esperaba {expected} con {self.describe_assertion(step)} y hubo {len(matches)}"
+
+    @staticmethod
+    def describe_assertion(step):
+        parts = []
+        if step.get('event'):
+            parts.append(f"event={step['event']}")
+        parts.extend(f"{path}={value!r}" for path, value in (step.get('match') or {}).items())
+        if 'valid' in step:
+            parts.append(f"valid={step['valid']}")
+        return ', '.join(parts)
+
+    def last_action_index(self):
+        """Índice del primer push del último paso de navegador o interacción"""
+        for result in reversed(self.step_results):
+            if result['action'] in ('goto', 'click', 'type'):
+                return sum(1 for push in self.pushes if push['step'] < result['step'])
+        return 0
+
+    async def checkpoint(self, number):
+        await self.consumer.capture_screenshot(force=True)
+        self.checkpoints.append({
+            'step': number,
+            'url': self.consumer.page.url,
+            'pushes': len(self.pushes),
+        })
+
+    def summary(self, status, started):
+        failed = [result for result in self.step_results if result['status'] != 'ok']
+        assertions = [result for result in self.step_results if result['action'] == 'assert_datalayer']
+        return {
+            'status': status,
+            'duration_ms': int((time.monotonic() - started) * 1000),
+            'steps_total': len(self.steps),
+            'steps_run': len(self.step_results),
+            'failed_steps': len(failed),
+            'assertions': {
+                'passed': sum(1 for result in assertions if result['status'] == 'ok'),
+                'failed': sum(1 for result in assertions if result['status'] != 'ok'),
+            },
+            'steps': self.step_results,
+            'pushes': [
+                {'id': push['id'], 'event': push['event'], 'valid': push['valid'], 'step': push['step']}
+                for push in self.pushes
+            ],
+            'checkpoints': self.checkpoints,
+            'url': self.consumer.page.url if self.consumer.page else None,
+        }
@@ -0,0 +1,176 @@
+# core/management/commands/benchmark_browser_modes.py
+"""
+Compara el coste de las sesiones headless y con ventana.
+
+Por cada modo lanza un navegador en un pool propio, abre N contextos como
+los de las sesiones interactivas y en cada uno hace varias cargas de página
+seguidas de una captura. Mide el arranque en frío (Xvfb incluido si el modo
+con ventana lo necesita), la latencia de carga y de captura, el pico de
+memoria RSS y la CPU consumida por el proceso y sus descendientes
+(navegadores y Xvfb):
+
+    python manage.py benchmark_browser_modes --contexts 4 --navigations 5
+    python manage.py benchmark_browser_modes --url https://tienda.example/ --mode headless
+
+Con ``--resource-policy`` los contextos aplican ese preset de bloqueo de
+recursos (ver ``core/resource_policy.py``); repetir con ``full`` para medir
+lo que ahorra en una página con muchos medios.
+
+Sin ``--url`` se usa una página sintética con ``set_content`` (no necesita red).
+"""
+import asyncio
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.admission import process_tree_cpu_seconds, process_tree_rss
+from core.browser_pool import BrowserPool
+from core.display import DisplayError, virtual_display
+from core.resource_policy import PRESETS, ResourcePolicy, ResourceTracker
+
+SYNTHETIC_PAGE = """<!DOCTYPE html>
+<html><head><style>
+body { font-family: sans-serif; margin: 0; }
+.card { display: inline-block; width: 220px; height: 140px; margin: 8px; border-radius: 8px;
+        background: linear-gradient(135deg, #4e73df, #1cc88a); box-shadow: 0 2px 6px rgba(0,0,0,.3); }
+</style></head><body>
+<h1>Benchmark</h1>
+<div id="grid"></div>
+<script>
+window.dataLayer = window.dataLayer || [];
+const grid = document.getElementById('grid');
+for (let i = 0; i < 60; i++) {
+    const card = document.createElement('div');
+    card.className = 'card';
+    card.textContent = 'Producto ' + i;
+    grid.appendChild(card);
+}
+window.dataLayer.push({event: 'page_view', page: {type: 'benchmark'}});
+window.dataLayer.push({event: 'view_item_list', ecommerce: {items: Array.from({length: 20}, (_, i) => ({item_id: 'SKU' + i}))}});
+</script>
+</body></html>"""
+
+MODES = {'headless': True, 'headful': False}
+
+
+class Command(BaseCommand):
+    help = 'Compara CPU, memoria y latencias de las sesiones headless y con ventana'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=['headless', 'headful', 'both'], default='both',
+                            help="Modo a medir ('headful' = con ventana, en Xvfb si no hay DISPLAY)")
+        parser.add_argument('--browser', default=None, help='Tipo de navegador (por defecto DEFAULT_BROWSER)')
+        parser.add_argument('--contexts', type=int, default=4, help='Contextos (sesiones) simultáneos por navegador')
+        parser.add_argument('--navigations', type=int, default=5, help='Cargas de página por contexto')
+        parser.add_argument('--url', default=None, help='URL a cargar (por defecto una página sintética)')
+        parser.add_argument('--resource-policy', choices=list(PRESETS), default='full', help='Preset de bloqueo de recursos')
+
+    def handle(self, *args, **options):
+        browser_type = options['browser'] or settings.PLAYWRIGHT_SETTINGS.get('DEFAULT_BROWSER', 'chromium')
+        modes = list(MODES) if options['mode'] == 'both' else [options['mode']]
+        self.stdout.write(f"Navegador: {browser_type}, {options['contexts']} contextos x {options['navigations']} cargas, "
+                          f"página: {options['url'] or 'sintética'}, recursos '{options['resource_policy']}'")
+
+        results = {}
+        for mode in modes:
+            try:
+                results[mode] = asyncio.run(self.run_mode(browser_type, MODES[mode], options))
+            except DisplayError as e:
+                self.stdout.write(self.style.WARNING(f"[{mode}] omitido: {e}"))
+                continue
+            self.report(mode, results[mode])
+
+        if len(results) == 2:
+            headless, headful = results['headless'], results['headful']
+            self.stdout.write(self.style.SUCCESS(
+                f"Con ventana frente a headless: CPU x{headful['cpu'] / max(headless['cpu'], 0.01):.2f}, "
+                f"RSS pico x{headful['rss_peak'] / max(headless['rss_peak'], 1):.2f}, "
+                f"arranque x{headful['cold_start'] / max(headless['cold_start'], 0.001):.2f}"
+            ))
+
+    async def run_mode(self, browser_type, headless, options):
+        pool = BrowserPool(min_size=0, max_size=1, recycle_after=0, headless=headless, name='benchmark')
+        viewport = settings.PLAYWRIGHT_SETTINGS.get('VIEWPORT_SIZE', {'width': 1280, 'height': 720})
+        tracker = ResourceTracker(ResourcePolicy(options['resource_policy']))
+        rss_base = process_tree_rss() or 0
+        cpu_base = process_tree_cpu_seconds() or 0.0
+        rss_peak = rss_base
+        sampling = True
+
+        async def sample_rss():
+            nonlocal rss_peak
+            while sampling:
+                rss_peak = max(rss_peak, await asyncio.to_thread(process_tree_rss) or 0)
+                await asyncio.sleep(0.25)
+
+        sampler = asyncio.create_task(sample_rss())
+        leases = []
+        loads, captures, acquires = [], [], []
+        try:
+            start = time.perf_counter()
+            leases.append(await pool.acquire(browser_type, viewport=viewport))
+            cold_start = time.perf_counter() - start
+
+            async def acquire():
+                started = time.perf_counter()
+                lease = await pool.acquire(browser_type, viewport=viewport)
+                acquires.append(time.perf_counter() - started)
+                return lease
+
+            leases.extend(await asyncio.gather(*(acquire() for _ in range(options['contexts'] - 1))))
+
+            async def browse(lease):
+                if tracker.policy.blocks_anything:
+                    await lease.context.route('**/*', tracker.handle_route)
+                page = await lease.context.new_page()
+                for _ in range(options['navigations']):
+                    started = time.perf_counter()
+                    if options['url']:
+                        await page.goto(options['url'], wait_until='load', timeout=60000)
+                    else:
+                        await page.set_content(SYNTHETIC_PAGE, wait_until='load')
+                    loads.append(time.perf_counter() - started)
+                    started = time.perf_counter()
+                    await page.screenshot(type='jpeg', quality=80)
+                    captures.append(time.perf_counter() - started)
+                await page.close()
+
+            await asyncio.gather(*(browse(lease) for lease in leases))
+            # Antes de cerrar: la CPU de los procesos vivos (y de los hijos que ya recogieron)
+            cpu = (process_tree_cpu_seconds() or 0.0) - cpu_base
+        finally:
+            sampling = False
+            await sampler
+            for lease in leases:
+                await pool.release(lease)
+            await pool.shutdown()
+            await virtual_display.stop()
+
+        return {
+            'cold_start': cold_start,
+            'acquires': acquires,
+            'loads': loads,
+            'captures': captures,
+            'rss_base': rss_base,
+            'rss_peak': rss_peak,
+            'cpu': cpu,
+            'blocked': tracker.report()['totals']['blocked'],
+        }
+
+    def report(self, mode, result):
+        def p50_p95(values):
+            if not values:
+                return "-"
+            values = sorted(values)
+            p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+            return f"p50 {statistics.median(values) * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms"
+
+        mb = 1024 * 1024
+        self.stdout.write(self.style.SUCCESS(
+            f"[{mode}] arranque en frío {result['cold_start']:.2f}s | contexto {p50_p95(result['acquires'])} | "
+            f"carga {p50_p95(result['loads'])} | captura {p50_p95(result['captures'])} | "
+            f"RSS pico {result['rss_peak'] / mb:.0f} MB (+{(result['rss_peak'] - result['rss_base']) / mb:.0f} MB) | "
+            f"CPU {result['cpu']:.2f}s | {result['blocked']} peticiones bloqueadas"
+        ))
@@ -0,0 +1,92 @@
+# core/management/commands/benchmark_db_writes.py
+"""
+Mide el rendimiento de escrituras concurrentes de DataLayerCapture.
+
+Simula N sesiones escribiendo a la vez, como lo hacen los consumers, con la
+ruta clásica (``database_sync_to_async``, un único hilo compartido) y con el
+pool de escrituras (``database_write_to_async``). Ejecutarlo contra cada
+motor para comparar SQLite (WAL) y PostgreSQL:
+
+    python manage.py benchmark_db_writes --sessions 20 --writes 200
+    POSTGRES_HOST=localhost python manage.py benchmark_db_writes --sessions 20 --writes 200
+"""
+import asyncio
+import statistics
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from core.db import database_write_to_async
+from core.models import Session, DataLayerCapture
+
+
+def insert_capture(session, payload):
+    return DataLayerCapture.objects.create(
+        session=session,
+        url=session.url,
+        data=payload,
+        is_valid=True,
+        errors=[]
+    )
+
+
+class Command(BaseCommand):
+    help = 'Mide el rendimiento de escrituras concurrentes de capturas de DataLayer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', type=int, default=10, help='Sesiones concurrentes simuladas')
+        parser.add_argument('--writes', type=int, default=100, help='Capturas escritas por sesión')
+        parser.add_argument('--payload-keys', type=int, default=20, help='Claves en cada push simulado')
+        parser.add_argument('--mode', choices=['legacy', 'pool', 'both'], default='both',
+                            help="'legacy' = database_sync_to_async, 'pool' = database_write_to_async")
+
+    def handle(self, *args, **options):
+        vendor = connection.vendor
+        self.stdout.write(f"Motor: {vendor} ({settings.DATABASES['default']['NAME']}), "
+                          f"hilos de escritura: {settings.DB_ASYNC_SETTINGS['WRITE_WORKERS']}")
+        if vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode;')
+                self.stdout.write(f"journal_mode: {cursor.fetchone()[0]}")
+
+        payload = [{'event': 'benchmark_event', **{f'key_{i}': f'value_{i}' for i in range(options['payload_keys'])}}]
+        modes = ['legacy', 'pool'] if options['mode'] == 'both' else [options['mode']]
+
+        for mode in modes:
+            sessions = [
+                Session.objects.create(url='https://benchmark.invalid/', json_file='uploads/json/benchmark.json',
+                                       description='benchmark_db_writes')
+                for _ in range(options['sessions'])
+            ]
+            try:
+                write = database_sync_to_async(insert_capture) if mode == 'legacy' else database_write_to_async(insert_capture)
+                elapsed, latencies = asyncio.run(self.run_sessions(write, sessions, options['writes'], payload))
+                self.report(mode, elapsed, latencies)
+            finally:
+                # Las capturas se borran en cascada
+                Session.objects.filter(id__in=[s.id for s in sessions]).delete()
+
+    async def run_sessions(self, write, sessions, writes, payload):
+        latencies = []
+
+        async def session_worker(session):
+            for _ in range(writes):
+                start = time.perf_counter()
+                await write(session, payload)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(session_worker(session) for session in sessions))
+        return time.perf_counter() - start, latencies
+
+    def report(self, mode, elapsed, latencies):
+        latencies.sort()
+        total = len(latencies)
+        p95 = latencies[min(total - 1, int(total * 0.95))]
+        self.stdout.write(self.style.SUCCESS(
+            f"[{mode}] {total} escrituras en {elapsed:.2f}s -> {total / elapsed:.0f} escrituras/s | "
+            f"latencia p50 {statistics.median(latencies) * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms"
+        ))
@@ -0,0 +1,83 @@
+# core/management/commands/run_batch.py
+"""
+Valida un lote de URLs o recorridos en navegadores headless.
+
+    python manage.py run_batch --reference referencia.json --urls urls.txt
+    python manage.py run_batch --reference referencia.json --journeys recorridos.json --concurrency 8
+
+``--urls`` es un fichero con una URL por línea (``#`` para comentarios);
+``--journeys`` un JSON con la lista de trabajos (ver ``core/batch.py``).
+Pensado para regresiones nocturnas: con ``--fail-on-invalid`` termina con
+código 1 si alguna sesión falla o tiene capturas inválidas.
+"""
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.batch import BatchRunner, BatchError, parse_jobs
+
+
+class Command(BaseCommand):
+    help = 'Valida un lote de URLs o recorridos guionizados en navegadores headless'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reference', required=True, help='JSON de referencia (lista de eventos de DataLayer)')
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--urls', help='Fichero con una URL por línea')
+        source.add_argument('--journeys', help='JSON con la lista de URLs o recorridos {url, name, steps}')
+        parser.add_argument('--browser', choices=['chromium', 'firefox', 'webkit'], help='Navegador (por defecto el de PLAYWRIGHT_SETTINGS)')
+        parser.add_argument('--concurrency', type=int, help='Contextos simultáneos (por defecto BATCH_SETTINGS)')
+        parser.add_argument('--browsers', type=int, help='Navegadores headless que comparten los contextos')
+        parser.add_argument('--resource-policy', choices=['full', 'visual', 'tags'],
+                            help="Bloqueo de recursos (por defecto RESOURCE_POLICY_SETTINGS['BATCH_DEFAULT'])")
+        parser.add_argument('--no-report', action='store_true', help='No generar un Report por sesión')
+        parser.add_argument('--fail-on-invalid', action='store_true', help='Salir con código 1 si hay errores o capturas inválidas')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['reference'], 'rb') as f:
+                reference_bytes = f.read()
+            reference = json.loads(reference_bytes)
+            if options['urls']:
+                with open(options['urls'], encoding='utf-8') as f:
+                    items = [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+            else:
+                with open(options['journeys'], encoding='utf-8') as f:
+                    items = json.load(f)
+            jobs = parse_jobs(items)
+            runner = BatchRunner(
+                reference,
+                browser_type=options['browser'],
+                concurrency=options['concurrency'],
+                browsers=options['browsers'],
+                generate_reports=not options['no_report'],
+                resource_policy=options['resource_policy'],
+                use_admission=False, # Proceso propio: no compite con sesiones interactivas
+            )
+        except (OSError, ValueError) as e: # Ficheros, JSON inválido y BatchError
+            raise CommandError(str(e))
+
+        self.stdout.write(f"Lote {runner.batch_id}: {len(jobs)} trabajos, concurrencia {runner.concurrency}, navegador {runner.browser_type} (headless), recursos '{runner.resource_policy.preset}'")
+        results = asyncio.run(self.run(runner, jobs, reference_bytes))
+
+        failed = [r for r in results if r.status == 'error' or r.invalid]
+        total_captures = sum(r.captures for r in results)
+        self.stdout.write(f"Lote {runner.batch_id} terminado: {len(results)} sesiones, {total_captures} capturas, "
+                          f"{sum(r.invalid for r in results)} inválidas, {sum(1 for r in results if r.status == 'error')} con error")
+        if failed and options['fail_on_invalid']:
+            raise CommandError(f"{len(failed)} sesiones con errores o capturas inválidas")
+
+    async def run(self, runner, jobs, reference_bytes):
+        sessions = await runner.create_sessions(jobs, reference_bytes)
+        return await runner.run(jobs, sessions, on_result=self.print_result)
+
+    def print_result(self, result):
+        if result.status == 'error':
+            line = self.style.ERROR(f"  ERROR     {result.name}: {result.error}")
+        elif result.invalid:
+            line = self.style.WARNING(f"  INVÁLIDO  {result.name}: {result.valid} válidas, {result.invalid} inválidas de {result.captures}")
+        else:
+            line = self.style.SUCCESS(f"  OK        {result.name}: {result.valid} válidas de {result.captures}")
+        blocked = f", {result.requests_blocked} peticiones bloqueadas (~{result.bytes_saved_estimate // 1024} KB)" if result.requests_blocked else ''
+        self.stdout.write(f"{line} (sesión {result.session_id}{', reporte en cola ' + result.report_job_id if result.report_job_id else ''}{blocked})")
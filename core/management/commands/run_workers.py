@@ -0,0 +1,107 @@
+# core/management/commands/run_workers.py
+"""
+Lanza varios procesos Daphne que comparten un mismo socket.
+
+    python manage.py run_workers --workers 4 --port 8000
+
+El socket se abre aquí y se hereda en cada hijo (``daphne --fd``), así que
+el kernel reparte las conexiones entre los procesos sin proxy delante. Cada
+hijo recibe ``WORKER_ID`` y anuncia su capacidad en Redis; las sesiones se
+enrutan a su dueño por la capa de Channels (ver ``core/workers.py``).
+
+Los hijos que terminan inesperadamente se relanzan; SIGTERM/SIGINT los
+detiene a todos.
+
+Las métricas de Prometheus de todos los hijos se escriben en
+``METRICS_SETTINGS['MULTIPROC_DIR']`` (``PROMETHEUS_MULTIPROC_DIR``), que se
+vacía al arrancar; ``/metrics`` las agrega en cualquier worker.
+"""
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.metrics import mark_process_dead
+
+RESTART_DELAY = 2 # Segundos antes de relanzar un proceso caído
+
+
+class Command(BaseCommand):
+    help = 'Lanza N procesos Daphne sobre el mismo socket (modo multi-worker)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='Procesos Daphne (por defecto WORKER_SETTINGS["PROCESSES"])')
+        parser.add_argument('--bind', default='0.0.0.0', help='Dirección de escucha')
+        parser.add_argument('--port', type=int, default=8000, help='Puerto de escucha')
+        parser.add_argument('--application', default='datalayer_validator.asgi:application', help='Aplicación ASGI')
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or getattr(settings, 'WORKER_SETTINGS', {}).get('PROCESSES', 1)
+        if workers < 1:
+            raise CommandError("--workers debe ser al menos 1")
+
+        try:
+            listener = socket.create_server((options['bind'], options['port']), backlog=1024)
+        except OSError as e:
+            raise CommandError(f"No se pudo abrir {options['bind']}:{options['port']}: {e}")
+        listener.set_inheritable(True)
+        fd = listener.fileno()
+
+        # Directorio multiproceso de Prometheus: limpio en cada arranque
+        metrics_dir = getattr(settings, 'METRICS_SETTINGS', {}).get('MULTIPROC_DIR')
+        if metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+            os.makedirs(metrics_dir, exist_ok=True)
+            os.environ['PROMETHEUS_MULTIPROC_DIR'] = metrics_dir
+
+        hostname = socket.gethostname()
+        self.stopping = False
+        self.children = {}
+
+        def spawn(index):
+            env = dict(os.environ, WORKER_ID=f'{hostname}-{index}')
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'daphne', '--fd', str(fd), options['application']],
+                env=env,
+                pass_fds=(fd,),
+            )
+            self.children[index] = process
+            self.stdout.write(f"Worker {env['WORKER_ID']} iniciado (pid {process.pid})")
+
+        def stop(signum, frame):
+            self.stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        self.stdout.write(f"Escuchando en {options['bind']}:{options['port']} con {workers} procesos Daphne")
+        for index in range(workers):
+            spawn(index)
+
+        try:
+            while not self.stopping:
+                for index, process in list(self.children.items()):
+                    code = process.poll()
+                    if code is not None and not self.stopping:
+                        mark_process_dead(process.pid)
+                        self.stderr.write(f"Worker {hostname}-{index} terminó con código {code}; se relanza")
+                        time.sleep(RESTART_DELAY)
+                        spawn(index)
+                time.sleep(1)
+        finally:
+            for process in self.children.values():
+                if process.poll() is None:
+                    process.terminate()
+            for process in self.children.values():
+                try:
+                    process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            listener.close()
+            self.stdout.write("Workers detenidos")
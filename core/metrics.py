@@ -0,0 +1,167 @@
+# core/metrics.py
+"""
+Métricas Prometheus de las sesiones interactivas (``GET /metrics``).
+
+Con varios procesos Daphne (``manage.py run_workers``) cada proceso escribe
+sus métricas en ficheros de ``PROMETHEUS_MULTIPROC_DIR`` (los crea y limpia
+``run_workers``) y la vista las agrega al responder, así que cualquier
+worker que atienda el scrape devuelve los totales de todos. Con un solo
+proceso se usa el registro en memoria habitual.
+
+Si ``prometheus_client`` no está instalado las métricas no hacen nada y
+``/metrics`` responde 501.
+
+Histogramas (segundos):
+
+- ``dlv_browser_launch_seconds``: lanzamiento de un navegador del pool;
+- ``dlv_context_acquire_seconds``: préstamo de un contexto (incluye lanzar si hace falta);
+- ``dlv_page_goto_seconds``: ``page.goto`` por origen (``initial``, ``navigation``...);
+- ``dlv_screenshot_seconds``: captura y guardado de screenshots por etapa;
+- ``dlv_datalayer_seconds``: comprobación (``evaluate``), validación y guardado de capturas;
+- ``dlv_db_queue_wait_seconds``: espera hasta que un hilo de BD empieza la tarea;
+- ``dlv_action_seconds``: duración de cada acción recibida por WebSocket;
+- ``dlv_command_wait_seconds``: espera en la cola de comandos de la sesión.
+
+Contadores y gauges: mensajes WebSocket por dirección y acción, comandos
+por resultado (agrupados, cancelados...), conexiones abiertas, navegadores y contextos activos, sesiones admitidas y en cola.
+"""
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+try:
+    import prometheus_client
+    from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+    CONTENT_TYPE_LATEST = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Acciones conocidas del cliente: el resto se cuenta como 'unknown' (evita etiquetas sin límite)
+KNOWN_ACTIONS = (
+    'init', 'navigation', 'capture', 'interaction', 'validation', 'session',
+    'report', 'live_view', 'screencast', 'cancel', 'macro', 'resource_policy',
+)
+
+FAST_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90)
+
+
+def is_available():
+    return prometheus_client is not None
+
+
+def is_multiprocess():
+    return bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+
+class _NoopMetric:
+    """Sustituto sin efecto cuando prometheus_client no está instalado"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+
+def _histogram(name, documentation, labels, buckets):
+    if not is_available():
+        return _NoopMetric()
+    return Histogram(name, documentation, labels, buckets=buckets)
+
+
+def _counter(name, documentation, labels):
+    if not is_available():
+        return _NoopMetric()
+    return Counter(name, documentation, labels)
+
+
+def _gauge(name, documentation, labels=()):
+    if not is_available():
+        return _NoopMetric()
+    # 'livesum': suma de los procesos vivos (los ficheros de procesos muertos se ignoran)
+    return Gauge(name, documentation, labels, multiprocess_mode='livesum')
+
+
+BROWSER_LAUNCH_SECONDS = _histogram('dlv_browser_launch_seconds', 'Lanzamiento de navegadores del pool', ['browser_type'], SLOW_BUCKETS)
+CONTEXT_ACQUIRE_SECONDS = _histogram('dlv_context_acquire_seconds', 'Préstamo de un contexto del pool', ['browser_type'], SLOW_BUCKETS)
+PAGE_GOTO_SECONDS = _histogram('dlv_page_goto_seconds', 'Duración de page.goto', ['source'], SLOW_BUCKETS)
+SCREENSHOT_SECONDS = _histogram('dlv_screenshot_seconds', 'Captura y guardado de screenshots', ['stage'], FAST_BUCKETS)
+DATALAYER_SECONDS = _histogram('dlv_datalayer_seconds', 'Comprobación, validación y guardado de capturas de dataLayer', ['stage'], FAST_BUCKETS)
+DB_QUEUE_WAIT_SECONDS = _histogram('dlv_db_queue_wait_seconds', 'Espera hasta que un hilo de BD ejecuta la tarea', ['executor'], FAST_BUCKETS)
+ACTION_SECONDS = _histogram('dlv_action_seconds', 'Duración de las acciones recibidas por WebSocket', ['action'], SLOW_BUCKETS)
+COMMAND_WAIT_SECONDS = _histogram('dlv_command_wait_seconds', 'Espera en la cola de comandos de la sesión', ['action'], FAST_BUCKETS)
+
+WEBSOCKET_MESSAGES = _counter('dlv_websocket_messages', 'Mensajes WebSocket', ['direction', 'kind'])
+COMMANDS = _counter('dlv_commands', 'Comandos de sesión por resultado', ['action', 'outcome'])
+RESOURCE_REQUESTS = _counter('dlv_resource_requests', 'Peticiones interceptadas por la política de recursos', ['policy', 'outcome', 'resource_type'])
+WEBSOCKET_CONNECTIONS = _gauge('dlv_websocket_connections', 'WebSockets de sesión abiertos')
+ACTIVE_BROWSERS = _gauge('dlv_active_browsers', 'Navegadores lanzados en el pool', ['pool', 'browser_type', 'mode'])
+ACTIVE_CONTEXTS = _gauge('dlv_active_contexts', 'Contextos de navegador prestados', ['pool', 'browser_type', 'mode'])
+ADMITTED_SESSIONS = _gauge('dlv_admitted_sessions', 'Sesiones con navegador admitidas')
+QUEUED_SESSIONS = _gauge('dlv_queued_sessions', 'Sesiones esperando turno de admisión')
+
+
+def action_label(action):
+    return action if action in KNOWN_ACTIONS else 'unknown'
+
+
+class timer:
+    """``with timer(HISTOGRAM, 'etiqueta'):`` mide también bloques con ``await``"""
+
+    def __init__(self, histogram, *labels):
+        self.metric = histogram.labels(*labels) if labels else histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metric.observe(time.perf_counter() - self.start)
+
+
+def update_pool_gauges(pool_name, stats):
+    """Refleja ``BrowserPool.stats()`` en los gauges de navegadores y contextos"""
+    for values in stats.values():
+        mode = 'headless' if values['headless'] else 'headful'
+        ACTIVE_BROWSERS.labels(pool_name, values['browser_type'], mode).set(values['browsers'])
+        ACTIVE_CONTEXTS.labels(pool_name, values['browser_type'], mode).set(values['active_contexts'])
+
+
+def reset_pool_gauges(pool_name, browser_type, headless):
+    """Pone a cero los gauges de un tipo y modo que ya no tiene navegadores en el pool"""
+    mode = 'headless' if headless else 'headful'
+    ACTIVE_BROWSERS.labels(pool_name, browser_type, mode).set(0)
+    ACTIVE_CONTEXTS.labels(pool_name, browser_type, mode).set(0)
+
+
+def update_admission_gauges(stats):
+    ADMITTED_SESSIONS.set(stats['active'])
+    QUEUED_SESSIONS.set(stats['queued'])
+
+
+def generate_latest():
+    """Texto de exposición de Prometheus (agregado entre procesos si hay directorio multiproceso)"""
+    if is_multiprocess():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return prometheus_client.generate_latest(registry)
+    return prometheus_client.generate_latest()
+
+
+def mark_process_dead(pid):
+    """Lo llama run_workers al terminar un hijo: descarta sus gauges 'live*'"""
+    if is_available() and is_multiprocess():
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.7 on 2026-10-17 12:34
+
+from django.db import migrations, models
+
+
+def compact_cumulative_captures(apps, schema_editor):
+    """
+    Convierte las capturas antiguas (array completo en cada fila) en
+    incrementos: si una fila empieza por el array de la anterior, solo se
+    guarda lo nuevo. Si no (página nueva), se deja completa con offset 0.
+    """
+    DataLayerCapture = apps.get_model('core', 'DataLayerCapture')
+    previous_session, previous_data = None, None
+    pending = []
+    for capture in DataLayerCapture.objects.order_by('session_id', 'created_at').iterator(chunk_size=500):
+        data = capture.data if isinstance(capture.data, list) else None
+        if (capture.session_id == previous_session and data is not None and previous_data
+                and len(data) >= len(previous_data) and data[:len(previous_data)] == previous_data):
+            capture.offset = len(previous_data)
+            capture.data = data[len(previous_data):]
+            pending.append(capture)
+        previous_session, previous_data = capture.session_id, data
+        if len(pending) >= 500:
+            DataLayerCapture.objects.bulk_update(pending, ['offset', 'data'])
+            pending = []
+    if pending:
+        DataLayerCapture.objects.bulk_update(pending, ['offset', 'data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_screenshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datalayercapture',
+            name='offset',
+            field=models.PositiveIntegerField(default=0, verbose_name='Posición'),
+        ),
+        migrations.RunPython(compact_cumulative_captures, migrations.RunPython.noop),
+    ]
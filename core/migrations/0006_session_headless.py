@@ -0,0 +1,19 @@
+# Generated by Django 4.2.7 on 2026-10-17 13:02
+
+import core.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_datalayercapture_offset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='headless',
+            field=models.BooleanField(default=core.models.default_headless, verbose_name='Modo headless'),
+        ),
+    ]
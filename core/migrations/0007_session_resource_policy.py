@@ -0,0 +1,19 @@
+# Generated by Django 4.2.7 on 2026-10-17 13:06
+
+import core.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_session_headless'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='resource_policy',
+            field=models.CharField(choices=[('full', 'Sin bloqueo'), ('visual', 'Fidelidad visual (sin vídeo ni anuncios)'), ('tags', 'Solo etiquetas (sin imágenes, fuentes ni terceros)')], default=core.models.default_resource_policy, max_length=20, verbose_name='Bloqueo de recursos'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 13:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_session_resource_policy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='resource_rules',
+            field=models.JSONField(blank=True, default=dict, verbose_name='Reglas de recursos'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.7 on 2026-10-17 13:30
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def number_captures(apps, schema_editor):
+    """Numera las capturas existentes de cada sesión por (created_at, offset)"""
+    DataLayerCapture = apps.get_model('core', 'DataLayerCapture')
+    previous_session, sequence = None, 0
+    pending = []
+    for capture in DataLayerCapture.objects.order_by('session_id', 'created_at', 'offset').only('id', 'session_id').iterator(chunk_size=500):
+        sequence = sequence + 1 if capture.session_id == previous_session else 1
+        previous_session = capture.session_id
+        capture.sequence = sequence
+        pending.append(capture)
+        if len(pending) >= 500:
+            DataLayerCapture.objects.bulk_update(pending, ['sequence'])
+            pending = []
+    if pending:
+        DataLayerCapture.objects.bulk_update(pending, ['sequence'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_session_resource_rules'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datalayercapture',
+            name='sequence',
+            field=models.PositiveIntegerField(default=0, verbose_name='Secuencia'),
+        ),
+        migrations.AlterField(
+            model_name='datalayercapture',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Fecha de captura'),
+        ),
+        migrations.RunPython(number_captures, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='datalayercapture',
+            index=models.Index(fields=['session', 'sequence'], name='core_capture_session_seq'),
+        ),
+    ]
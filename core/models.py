@@ -1,9 +1,20 @@
 import uuid
+from django.conf import settings
 from django.db import models
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
 
+def default_headless():
+    """Modo por defecto de las sesiones nuevas (``PLAYWRIGHT_SETTINGS['HEADLESS']``)"""
+    return bool(getattr(settings, 'PLAYWRIGHT_SETTINGS', {}).get('HEADLESS', False))
+
+
+def default_resource_policy():
+    """Preset de bloqueo de recursos de las sesiones nuevas (``RESOURCE_POLICY_SETTINGS['DEFAULT']``)"""
+    return getattr(settings, 'RESOURCE_POLICY_SETTINGS', {}).get('DEFAULT', 'full')
+
+
 class Session(models.Model):
     """Sesión de validación de DataLayers"""
 
@@ -15,6 +26,13 @@ class Session(models.Model):
         ('error', _('Error')),
     )
 
+    # Presets de bloqueo de recursos (ver core/resource_policy.py)
+    RESOURCE_POLICY_CHOICES = (
+        ('full', _('Sin bloqueo')),
+        ('visual', _('Fidelidad visual (sin vídeo ni anuncios)')),
+        ('tags', _('Solo etiquetas (sin imágenes, fuentes ni terceros)')),
+    )
+
     # Tipos de navegadores disponibles
     BROWSER_CHOICES = (
         ('chromium', _('Chromium')),
@@ -26,6 +44,10 @@ class Session(models.Model):
     url = models.URLField(_('URL'))
     json_file = models.FileField(_('Archivo JSON'), upload_to='uploads/json/')
     browser_type = models.CharField(_('Tipo de navegador'), max_length=20, choices=BROWSER_CHOICES, default='chromium')
+    headless = models.BooleanField(_('Modo headless'), default=default_headless)
+    resource_policy = models.CharField(_('Bloqueo de recursos'), max_length=20, choices=RESOURCE_POLICY_CHOICES,
+                                       default=default_resource_policy)
+    resource_rules = models.JSONField(_('Reglas de recursos'), default=dict, blank=True) # Reglas propias sobre el preset
     description = models.CharField(_('Descripción'), max_length=255, blank=True)
     status = models.CharField(_('Estado'), max_length=20, choices=STATUS_CHOICES, default='pending')
     created_at = models.DateTimeField(_('Fecha de creación'), auto_now_add=True)
@@ -61,27 +83,78 @@ class Screenshot(models.Model):
         return f"Captura de {self.url} ({self.created_at})"
 
 
+class DataLayerCaptureQuerySet(models.QuerySet):
+    """Consultas sobre capturas de DataLayer almacenadas como incrementos"""
+
+    def in_capture_order(self):
+        """Orden en que llegaron los pushes (la reconstrucción de snapshots depende de él)"""
+        return self.order_by('sequence', 'created_at', 'offset')
+
+    def iter_entries(self, chunk_size=500):
+        """
+        Recorre las entradas en orden sin reconstruir los snapshots:
+        devuelve tuplas (captura, posición en window.dataLayer, entrada).
+        """
+        for capture in self.in_capture_order().iterator(chunk_size=chunk_size):
+            for index, entry in capture.entries():
+                yield capture, index, entry
+
+
 class DataLayerCapture(models.Model):
-    """Captura de DataLayer"""
+    """
+    Captura de DataLayer.
+
+    ``data`` contiene solo las entradas nuevas desde la captura anterior y
+    ``offset`` la posición de la primera de ellas en ``window.dataLayer``.
+    Un ``offset`` 0 indica un documento nuevo (el dataLayer empieza de cero).
+
+    ``sequence`` numera las capturas de la sesión en el orden en que llegaron
+    los pushes y ``created_at`` es la hora del push, no la del guardado (las
+    capturas se insertan por lotes, ver ``core/capture_buffer.py``).
+    """
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     session = models.ForeignKey(Session, on_delete=models.CASCADE, related_name='datalayers')
     url = models.URLField(_('URL'))
     data = models.JSONField(_('Datos'))
+    offset = models.PositiveIntegerField(_('Posición'), default=0)
     is_valid = models.BooleanField(_('Es válido'), null=True, blank=True)
     errors = models.JSONField(_('Errores'), default=list, blank=True)
     validated_data = models.JSONField(_('Datos validados'), null=True, blank=True)
-    created_at = models.DateTimeField(_('Fecha de captura'), auto_now_add=True)
+    sequence = models.PositiveIntegerField(_('Secuencia'), default=0)
+    created_at = models.DateTimeField(_('Fecha de captura'), default=timezone.now, editable=False)
+
+    objects = DataLayerCaptureQuerySet.as_manager()
 
     class Meta:
         verbose_name = _('Captura de DataLayer')
         verbose_name_plural = _('Capturas de DataLayer')
         ordering = ['-created_at']
+        indexes = [models.Index(fields=['session', 'sequence'], name='core_capture_session_seq')]
 
     def __str__(self):
         status = "Válido" if self.is_valid else "Inválido" if self.is_valid is not None else "Sin validar"
         return f"DataLayer de {self.url} - {status}"
 
+    def entries(self):
+        """Entradas de esta captura con su posición en window.dataLayer"""
+        data = self.data if isinstance(self.data, list) else [self.data]
+        return [(self.offset + i, entry) for i, entry in enumerate(data)]
+
+    def snapshot(self):
+        """Reconstruye window.dataLayer tal como estaba en esta captura"""
+        previous = DataLayerCapture.objects.filter(session_id=self.session_id, sequence__lte=self.sequence)
+        # Basta con empezar en el último documento nuevo anterior a esta captura
+        start = previous.filter(offset=0).order_by('-sequence').values_list('sequence', flat=True).first()
+        if start is not None:
+            previous = previous.filter(sequence__gte=start)
+
+        datalayer = []
+        for capture in previous.in_capture_order().iterator():
+            del datalayer[capture.offset:]
+            datalayer.extend(entry for index, entry in capture.entries())
+        return datalayer
+
 
 class Report(models.Model):
     """Reporte de validación"""
@@ -0,0 +1,148 @@
+# core/report_cache.py
+"""
+Caché de artefactos de reporte (HTML, JSON, CSV, PDF).
+
+Los formatos se generan bajo demanda en la primera descarga y se guardan en
+``REPORT_SETTINGS['CACHE_DIR']`` con un nombre derivado del hash del
+contenido del reporte, el formato y la versión del renderizador: dos
+reportes con el mismo contenido comparten artefacto y un cambio en el
+renderizador invalida los anteriores. La misma clave sirve de ETag.
+
+La caché tiene un tamaño máximo (``CACHE_MAX_MB``); al superarlo se borran
+los artefactos usados hace más tiempo (la fecha de modificación se
+actualiza en cada acierto).
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+
+from validator.reporter import ReportGenerator, RENDERER_VERSION
+from .report_stream import iter_artifact
+
+logger = logging.getLogger(__name__)
+
+
+def get_cache_dir():
+    report_settings = getattr(settings, 'REPORT_SETTINGS', {})
+    return Path(report_settings.get('CACHE_DIR') or Path(settings.MEDIA_ROOT) / 'reports' / 'cache')
+
+
+def get_cache_max_bytes():
+    return int(getattr(settings, 'REPORT_SETTINGS', {}).get('CACHE_MAX_MB', 500)) * 1024 * 1024
+
+
+def report_content_hash(report):
+    """Hash del contenido del reporte; se calcula una vez y se guarda en ``Report.data``"""
+    content_hash = (report.data or {}).get('content_hash')
+    if content_hash:
+        return content_hash
+
+    # Reportes anteriores a la generación en streaming: hash del artefacto o de los datos
+    sha256 = hashlib.sha256()
+    if report.json_file:
+        with report.json_file.open('rb') as artifact:
+            for chunk in iter(lambda: artifact.read(64 * 1024), b''):
+                sha256.update(chunk)
+    else:
+        sha256.update(json.dumps(report.data, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    content_hash = sha256.hexdigest()
+
+    report.data = dict(report.data or {}, content_hash=content_hash)
+    report.save(update_fields=['data'])
+    return content_hash
+
+
+def artifact_key(report, format_type):
+    """Clave de caché (y ETag) de un formato del reporte"""
+    return hashlib.sha256(f'{report_content_hash(report)}:{format_type}:{RENDERER_VERSION}'.encode()).hexdigest()
+
+
+def open_report_artifact(report, format_type):
+    """
+    Abre (en binario) el fichero del reporte en el formato pedido,
+    generándolo y cacheándolo si no existe.
+    """
+    # Artefactos ya adjuntos al reporte (el JSON lo escribe siempre la generación)
+    field = getattr(report, f'{format_type}_file', None)
+    if field:
+        try:
+            return field.open('rb')
+        except FileNotFoundError:
+            logger.warning(f"Falta el fichero {field.name} del reporte {report.id}, se regenera")
+
+    path = get_cache_dir() / f'{artifact_key(report, format_type)}.{format_type}'
+    try:
+        artifact = open(path, 'rb')
+        os.utime(path) # Marca de uso para el LRU
+        return artifact
+    except FileNotFoundError:
+        pass
+
+    render_artifact(report, format_type, path)
+    evict(get_cache_max_bytes(), keep=path)
+    return open(path, 'rb')
+
+
+def report_items(report):
+    """(sección, elemento) del reporte, leídos en streaming del artefacto JSON si existe"""
+    if report.json_file:
+        with report.json_file.open('rb') as artifact:
+            yield from iter_artifact(artifact)
+        return
+    data = report.data or {}
+    for section in ('details', 'screenshots'):
+        for item in data.get(section) or []:
+            yield section, item
+
+
+def render_artifact(report, format_type, path):
+    """Renderiza el formato en un temporal y lo mueve a ``path`` de forma atómica"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = report.data or {}
+    generator = ReportGenerator(
+        report.title,
+        data.get('summary'),
+        report_items(report),
+        reference_comparison=data.get('reference_comparison'),
+    )
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            generator.render(format_type, tmp)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    logger.info(f"Reporte {report.id} renderizado en {format_type}: {path.name} ({path.stat().st_size} bytes)")
+
+
+def evict(max_bytes, keep=None):
+    """Borra los artefactos menos usados hasta que la caché quepa en ``max_bytes``"""
+    entries = []
+    total = 0
+    for path in get_cache_dir().glob('*.*'):
+        if path.suffix == '.tmp':
+            continue
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue # Borrado por otro proceso
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+
+    for mtime, size, path in sorted(entries, key=lambda entry: entry[0]):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            path.unlink()
+            total -= size
+            logger.debug(f"Artefacto de reporte expulsado de la caché: {path.name}")
+        except FileNotFoundError:
+            pass
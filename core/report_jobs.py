@@ -0,0 +1,127 @@
+# core/report_jobs.py
+"""
+Generación de reportes en segundo plano.
+
+El consumer de la sesión no construye el reporte: lo encola como un trabajo
+y sigue atendiendo capturas y screenshots. Con ``REPORT_SETTINGS['USE_WORKER']``
+el trabajo se envía al canal ``report-worker`` de la capa de Channels (Redis)
+y lo ejecuta un proceso aparte::
+
+    python manage.py runworker report-worker
+
+Cada proceso worker atiende un reporte a la vez; para generar varios en
+paralelo se levantan varios (p. ej. ``docker compose up --scale report-worker=4``).
+Sin worker el trabajo se ejecuta en un hilo del propio proceso.
+
+El progreso y el resultado se publican en el grupo ``session_{id}`` con
+mensajes ``report.status``, que el consumer reenvía al cliente.
+"""
+import asyncio
+import logging
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.consumer import SyncConsumer
+from channels.db import DatabaseSyncToAsync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Session, Report
+from .report_stream import ReportStream
+
+logger = logging.getLogger(__name__)
+
+REPORT_CHANNEL = 'report-worker' # Canal de la capa de Channels que atienden los workers
+
+_local_jobs = set() # Referencias a las tareas locales en curso (evita que el GC las cancele)
+
+
+def get_report_settings():
+    return getattr(settings, 'REPORT_SETTINGS', {})
+
+
+def new_report_job(session_id, options=None, reference_events_count=0):
+    """Mensaje de trabajo; se envía tal cual por la capa de canales"""
+    return {
+        'type': 'report.generate',
+        'job_id': uuid.uuid4().hex,
+        'session_id': str(session_id),
+        'options': options or {},
+        'reference_events_count': reference_events_count,
+    }
+
+
+async def enqueue_report_job(job):
+    """
+    Encola el trabajo en el worker o, si no hay, lo lanza en un hilo local.
+    Devuelve la tarea local (su resultado es el ``Report``) o None si lo atiende el worker.
+    """
+    if get_report_settings().get('USE_WORKER'):
+        await get_channel_layer().send(REPORT_CHANNEL, job)
+        logger.info(f"Reporte {job['job_id']} encolado en el worker para sesión {job['session_id']}")
+        return None
+    # Sin worker: mismo trabajo en un hilo aparte, sin bloquear el event loop
+    run_in_thread = DatabaseSyncToAsync(run_report_job, thread_sensitive=False)
+    task = asyncio.create_task(run_in_thread(job))
+    _local_jobs.add(task)
+    task.add_done_callback(_local_jobs.discard)
+    logger.info(f"Reporte {job['job_id']} en ejecución local para sesión {job['session_id']}")
+    return task
+
+
+def build_report(session, options=None, reference_events_count=0, on_progress=None):
+    """Genera y guarda el Report de una sesión (síncrono)"""
+    options = options or {}
+    title = options.get('title', f"Validación {session.id} - {timezone.now().strftime('%Y-%m-%d')}")
+    stream = ReportStream(session, options, reference_events_count=reference_events_count, on_progress=on_progress)
+    report = Report(session=session, title=title, data={})
+    stream.save_to(report)
+    # En la BD solo el resumen y el índice; el detalle está en el artefacto JSON
+    report.is_valid = stream.summary['is_valid_overall']
+    report.data = stream.report_data()
+    report.save()
+    return report
+
+
+def run_report_job(job):
+    """Genera el reporte de un trabajo publicando el progreso en el grupo de la sesión"""
+    job_id, session_id = job['job_id'], job['session_id']
+    group_send = async_to_sync(get_channel_layer().group_send)
+
+    def notify(status, **extra):
+        try:
+            group_send(f'session_{session_id}', {'type': 'report.status', 'job_id': job_id, 'status': status, **extra})
+        except Exception as e:
+            logger.warning(f"No se pudo notificar el estado '{status}' del reporte {job_id}: {e}")
+
+    try:
+        session = Session.objects.get(id=session_id)
+        notify('started', message='Generando reporte...')
+        report = build_report(
+            session,
+            job.get('options'),
+            reference_events_count=job.get('reference_events_count', 0),
+            on_progress=lambda done, total: notify('progress', processed=done, total=total),
+        )
+        logger.info(f"Reporte {report.id} generado (trabajo {job_id}) para sesión {session_id}")
+
+        notify(
+            'generated',
+            report_id=str(report.id),
+            report_url=reverse('report', args=[report.id]),
+            message='Reporte generado correctamente.'
+        )
+        return report
+    except Exception as e:
+        logger.exception(f"Error en el trabajo de reporte {job_id} para sesión {session_id}: {e}")
+        notify('error', message=f'Error al generar reporte: {e}')
+        return None
+
+
+class ReportWorkerConsumer(SyncConsumer):
+    """Worker de Channels que genera reportes (canal ``report-worker``)"""
+
+    def report_generate(self, message):
+        run_report_job(message)
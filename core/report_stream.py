@@ -0,0 +1,244 @@
+# core/report_stream.py
+"""
+Generación de reportes en streaming.
+
+Las capturas de la sesión se recorren con ``iterator()`` por bloques y cada
+detalle se escribe directamente en un fichero temporal (el artefacto JSON
+del reporte), así que la memoria usada no depende de la duración de la
+sesión. Los contadores del resumen y un índice compacto se calculan en la
+misma pasada; son lo único que se guarda en ``Report.data``.
+"""
+import hashlib
+import io
+import json
+import logging
+import tempfile
+
+from django.core.files import File
+from django.utils import timezone
+
+from .models import DataLayerCapture, Screenshot
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 500
+MAX_INDEXED_ERRORS = 1000 # Límite de posiciones de detalles inválidos guardadas en el índice
+SPOOL_MAX_SIZE = 1024 * 1024 # Hasta 1 MB en memoria, después a disco
+
+
+def _event_name(data):
+    """Evento del último push de una captura (o 'N/A')"""
+    if isinstance(data, list) and data and isinstance(data[-1], dict):
+        return data[-1].get('event', 'N/A')
+    return 'N/A'
+
+
+class ReportStream:
+    """Escribe el artefacto JSON de un reporte sin cargar las capturas en memoria"""
+
+    def __init__(self, session, options=None, reference_events_count=0, on_progress=None):
+        self.session = session
+        self.options = options or {}
+        self.reference_events_count = reference_events_count
+        self.on_progress = on_progress # Función (procesadas, total) llamada cada CHUNK_SIZE capturas
+        self.summary = None
+        self.index = None
+        self.reference_comparison = None
+        self.content_hash = None # sha256 del artefacto: clave de la caché de formatos
+
+    def write(self, fileobj):
+        """Escribe el JSON completo en ``fileobj`` (binario) y calcula resumen e índice"""
+        include_raw_data = self.options.get('include_raw_data', True)
+        include_screenshots = self.options.get('include_screenshots', True)
+        fileobj = _HashingWriter(fileobj)
+        total = valid_count = invalid_count = 0
+        events = {}
+        invalid_details = []
+
+        fileobj.write(b'{"details": [')
+        captures = DataLayerCapture.objects.filter(session=self.session).in_capture_order()
+        expected = captures.count() if self.on_progress else 0
+        for i, dl in enumerate(captures.iterator(chunk_size=CHUNK_SIZE)):
+            if self.on_progress and i and i % CHUNK_SIZE == 0:
+                self.on_progress(i, expected)
+            event = _event_name(dl.data)
+            stats = events.setdefault(event, {'total': 0, 'valid': 0, 'invalid': 0})
+            stats['total'] += 1
+            if dl.is_valid is True:
+                valid_count += 1
+                stats['valid'] += 1
+            elif dl.is_valid is False:
+                invalid_count += 1
+                stats['invalid'] += 1
+                if len(invalid_details) < MAX_INDEXED_ERRORS:
+                    invalid_details.append(i)
+            total += 1
+
+            self._write_item(fileobj, i, {
+                'index': i,
+                'url': dl.url,
+                'timestamp': dl.created_at.isoformat(),
+                'offset': dl.offset, # Posición en window.dataLayer de la primera entrada de 'data'
+                'data': dl.data if include_raw_data else {'event': event}, # Mostrar solo evento del último push si no raw
+                'is_valid': dl.is_valid,
+                'errors': dl.errors,
+                'validated_data': dl.validated_data # Incluir si existe
+            })
+
+        if self.on_progress:
+            self.on_progress(total, max(total, expected))
+
+        fileobj.write(b'], "screenshots": [')
+        screenshots_count = 0
+        if include_screenshots:
+            screenshots = Screenshot.objects.filter(session=self.session).order_by('created_at')
+            for i, s in enumerate(screenshots.iterator(chunk_size=CHUNK_SIZE)):
+                self._write_item(fileobj, i, {
+                    'url': s.url,
+                    'timestamp': s.created_at.isoformat(),
+                    'image_url': s.image.url if s.image else None # Verificar si la imagen existe
+                })
+                screenshots_count += 1
+
+        total_validated = valid_count + invalid_count # Total de DLs que fueron validados (no necesariamente todos los capturados)
+        success_percent = round((valid_count / total_validated) * 100) if total_validated > 0 else 0
+        self.summary = {
+            'url': self.session.url,
+            'session_id': str(self.session.id),
+            'created_at': self.session.created_at.isoformat(),
+            'report_generated_at': timezone.now().isoformat(),
+            'total_datalayers_captured': total,
+            'valid_count': valid_count,
+            'invalid_count': invalid_count,
+            'success_percent': success_percent,
+            'is_valid_overall': success_percent >= 90 # Ejemplo: considerar válido si 90% o más son válidos
+        }
+        self.index = {
+            'details_count': total,
+            'screenshots_count': screenshots_count,
+            'events': events,
+            'invalid_details': invalid_details, # Posiciones en 'details' del artefacto
+            'invalid_details_truncated': invalid_count > len(invalid_details),
+        }
+        self.reference_comparison = {
+            # Esta parte necesita la lógica de comparación real
+            'reference_events_count': self.reference_events_count,
+            'matched_events': 0, # Calcular esto
+            'missing_events': 0, # Calcular esto
+            'extra_events': 0    # Calcular esto
+        }
+        fileobj.write(b'], ')
+        fileobj.write(self._dumps({'summary': self.summary, 'reference_comparison': self.reference_comparison})[1:])
+        self.content_hash = fileobj.hexdigest()
+
+    def report_data(self):
+        """Contenido de ``Report.data``: solo resumen e índice"""
+        return {
+            'summary': self.summary,
+            'index': self.index,
+            'reference_comparison': self.reference_comparison,
+            'content_hash': self.content_hash,
+        }
+
+    def save_to(self, report):
+        """Genera el artefacto y lo adjunta a ``report.json_file`` (sin guardar el reporte)"""
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as tmp:
+            self.write(tmp)
+            tmp.seek(0)
+            report.json_file.save(f"reporte_{report.id}.json", File(tmp), save=False)
+        logger.info(f"Artefacto JSON del reporte {report.id} escrito: {self.index['details_count']} detalles")
+
+    def _write_item(self, fileobj, position, item):
+        if position:
+            fileobj.write(b', ')
+        fileobj.write(self._dumps(item))
+
+    @staticmethod
+    def _dumps(obj):
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+class _HashingWriter:
+    """Envuelve un fichero binario calculando el sha256 de lo escrito"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.fileobj.write(data)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def iter_artifact(fileobj, chunk_size=64 * 1024):
+    """
+    Lee un artefacto JSON escrito por ``ReportStream`` sin cargarlo entero:
+    devuelve (sección, elemento) para 'details' y después 'screenshots'.
+    """
+    decoder = json.JSONDecoder()
+    reader = io.TextIOWrapper(fileobj, encoding='utf-8')
+    buffer, pos, eof = '', 0, False
+
+    def fill():
+        nonlocal buffer, pos, eof
+        chunk = reader.read(chunk_size)
+        eof = not chunk
+        buffer, pos = buffer[pos:] + chunk, 0
+
+    def expect(token):
+        # Avanza hasta el siguiente carácter significativo y comprueba que es ``token``
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            if pos + len(token) <= len(buffer):
+                break
+            if eof:
+                raise ValueError(f"Artefacto JSON incompleto (se esperaba {token!r})")
+            fill()
+        if buffer.startswith(token, pos):
+            pos += len(token)
+            return True
+        return False
+
+    def decode():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+                # Un número al final del búfer podría continuar en el siguiente bloque
+                if end < len(buffer) or eof:
+                    pos = end
+                    return value
+            except ValueError:
+                if eof:
+                    raise
+            fill()
+
+    try:
+        fill()
+        if not expect('{'):
+            raise ValueError("El artefacto JSON no empieza por un objeto")
+        while True:
+            section = decode()
+            expect(':')
+            if section not in ('details', 'screenshots'):
+                return # Resumen y comparación: ya están en Report.data
+            if not expect('['):
+                raise ValueError(f"La sección {section!r} del artefacto no es una lista")
+            if not expect(']'):
+                while True:
+                    yield section, decode()
+                    if expect(']'):
+                        break
+                    if not expect(','):
+                        raise ValueError(f"Separador inválido en la sección {section!r} del artefacto")
+            if not expect(','):
+                return
+    finally:
+        reader.detach() # El fichero lo cierra quien lo abrió
@@ -0,0 +1,310 @@
+# core/resource_policy.py
+"""
+Políticas de bloqueo de recursos durante la validación.
+
+Para validar el dataLayer basta con el documento, sus scripts y el tag
+manager: imágenes, vídeos, fuentes o anuncios de terceros solo gastan red,
+CPU y memoria del navegador. Cada sesión elige un preset:
+
+- ``full``: sin bloqueo (comportamiento clásico, no se intercepta nada).
+- ``visual``: fidelidad visual. Bloquea vídeo/audio y las redes de anuncios;
+  imágenes, estilos y fuentes se cargan, así las capturas siguen siendo
+  fieles.
+- ``tags``: solo etiquetas. Además bloquea imágenes, fuentes y los scripts,
+  iframes y peticiones de terceros que no estén en la lista permitida
+  (tag managers, analítica, píxeles y gestores de consentimiento). Los
+  estilos se mantienen: sin ellos cambian las coordenadas de los clics y los
+  disparadores de visibilidad.
+
+Sobre el preset se pueden añadir reglas propias (``block_types``,
+``block_domains``, ``allow_domains``). Los patrones de dominio admiten
+subdominios (``doubleclick.net`` cubre ``ad.doubleclick.net``) y comodines
+(``*.cdn-*.example``). La lista permitida gana siempre y el documento
+principal nunca se bloquea.
+
+``ResourceTracker`` es el handler de ``context.route``: aplica la política y
+lleva la cuenta por página (cada navegación del documento principal abre una
+página nueva) de peticiones permitidas, bloqueadas y bytes ahorrados.
+Los bytes son una estimación por tipo de recurso: una petición bloqueada
+nunca llega a tener tamaño.
+"""
+import fnmatch
+import logging
+import time
+from collections import Counter, deque
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+from .metrics import RESOURCE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+POLICY_FULL = 'full'
+POLICY_VISUAL = 'visual'
+POLICY_TAGS = 'tags'
+
+# Tipos de Playwright más 'subdocument' (documento de un iframe)
+RESOURCE_TYPES = ('document', 'subdocument', 'stylesheet', 'image', 'media', 'font', 'script', 'texttrack',
+                  'xhr', 'fetch', 'eventsource', 'websocket', 'manifest', 'ping', 'other')
+
+# Etiquetas, analítica, píxeles y gestores de consentimiento: nunca se bloquean
+TAG_DOMAINS = (
+    'googletagmanager.com', 'google-analytics.com', 'analytics.google.com', 'tagmanager.google.com',
+    'stats.g.doubleclick.net', 'fls.doubleclick.net', 'googleadservices.com',
+    'connect.facebook.net', 'www.facebook.com', 'analytics.tiktok.com', 'snap.licdn.com', 'px.ads.linkedin.com',
+    'bat.bing.com', 'clarity.ms', 'hotjar.com', 'cdn.segment.com', 'api.segment.io',
+    'tags.tiqcdn.com', 'assets.adobedtm.com', 'omtrdc.net',
+    'cookiebot.com', 'cookielaw.org', 'onetrust.com', 'didomi.io', 'usercentrics.eu', 'consensu.org', 'trustarc.com',
+)
+
+# Redes de anuncios (no de medición)
+AD_DOMAINS = (
+    'googlesyndication.com', 'securepubads.g.doubleclick.net', 'adservice.google.com',
+    'amazon-adsystem.com', 'adnxs.com', 'criteo.com', 'criteo.net', 'taboola.com', 'outbrain.com',
+    'pubmatic.com', 'rubiconproject.com', 'casalemedia.com', 'openx.net', 'moatads.com', 'adsrvr.org',
+)
+
+PRESETS = {
+    POLICY_FULL: {},
+    POLICY_VISUAL: {
+        'block_types': ('media',),
+        'block_domains': AD_DOMAINS,
+    },
+    POLICY_TAGS: {
+        'block_types': ('image', 'media', 'font', 'texttrack', 'manifest'),
+        'block_domains': AD_DOMAINS,
+        'block_third_party': ('script', 'subdocument', 'xhr', 'fetch', 'eventsource', 'websocket', 'other'),
+    },
+}
+
+# Tamaño típico por tipo (mediana aproximada de HTTP Archive) para estimar lo ahorrado
+TYPICAL_BYTES = {
+    'image': 25000,
+    'media': 400000,
+    'font': 35000,
+    'script': 20000,
+    'subdocument': 30000,
+    'stylesheet': 15000,
+    'xhr': 3000,
+    'fetch': 3000,
+}
+DEFAULT_TYPICAL_BYTES = 2000
+
+# Sufijos públicos de dos niveles más habituales (subconjunto de publicsuffix.org).
+# Fuera de esta lista, el sitio son las dos últimas etiquetas: www.bmw.de -> bmw.de
+MULTI_LABEL_SUFFIXES = frozenset((
+    'co.uk', 'org.uk', 'ac.uk', 'gov.uk', 'me.uk', 'ltd.uk', 'plc.uk', 'net.uk', 'sch.uk',
+    'com.au', 'net.au', 'org.au', 'edu.au', 'gov.au', 'co.nz', 'net.nz', 'org.nz', 'govt.nz',
+    'co.jp', 'ne.jp', 'or.jp', 'ac.jp', 'go.jp', 'co.kr', 'or.kr', 'com.cn', 'net.cn', 'org.cn', 'gov.cn',
+    'com.hk', 'com.tw', 'com.sg', 'com.my', 'co.id', 'co.th', 'in.th', 'com.vn', 'com.ph', 'com.pk',
+    'co.in', 'net.in', 'org.in', 'firm.in', 'gen.in', 'ind.in', 'co.il', 'org.il', 'com.tr', 'gen.tr',
+    'com.sa', 'com.eg', 'co.za', 'org.za', 'com.ng', 'co.ke', 'com.ua', 'com.ru', 'com.pl',
+    'com.es', 'org.es', 'nom.es', 'gob.es', 'edu.es', 'com.pt',
+    'com.mx', 'org.mx', 'gob.mx', 'com.br', 'net.br', 'org.br', 'gov.br', 'com.ar', 'org.ar', 'gob.ar',
+    'com.co', 'net.co', 'org.co', 'gov.co', 'com.pe', 'org.pe', 'gob.pe', 'com.ec', 'gob.ec',
+    'com.ve', 'com.uy', 'com.py', 'com.bo', 'com.gt', 'com.do', 'com.pa', 'co.cr',
+    # Alojamientos donde cada subdominio es de un cliente distinto
+    'github.io', 'herokuapp.com', 'netlify.app', 'vercel.app', 'pages.dev', 'web.app', 'firebaseapp.com',
+    'appspot.com', 'azurewebsites.net', 'cloudfront.net', 'blogspot.com', 'myshopify.com',
+))
+
+
+class ResourcePolicyError(ValueError):
+    """Preset o reglas de bloqueo no válidos"""
+
+
+def get_resource_policy_settings():
+    return getattr(settings, 'RESOURCE_POLICY_SETTINGS', {})
+
+
+def domain_matches(host, pattern):
+    """``host`` es el dominio del patrón, un subdominio suyo o encaja con el comodín"""
+    pattern = pattern.lower().strip().lstrip('.')
+    if '*' in pattern or '?' in pattern:
+        return fnmatch.fnmatchcase(host, pattern)
+    return host == pattern or host.endswith('.' + pattern)
+
+
+def site_of(host):
+    """Dominio registrable (``tienda.example.co.uk`` -> ``example.co.uk``) según ``MULTI_LABEL_SUFFIXES``"""
+    host = host.lower().rstrip('.')
+    labels = host.split('.')
+    if labels[-1].isdigit() or ':' in host:
+        return host # Dirección IP
+    if len(labels) > 2 and '.'.join(labels[-2:]) in MULTI_LABEL_SUFFIXES:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+class ResourcePolicy:
+    """Preset más reglas propias; decide si una petición se bloquea"""
+
+    def __init__(self, preset=POLICY_FULL, block_types=(), block_domains=(), allow_domains=(), block_third_party=()):
+        if preset not in PRESETS:
+            raise ResourcePolicyError(f"Preset de recursos desconocido {preset!r} (válidos: {', '.join(PRESETS)})")
+        for resource_type in (*block_types, *block_third_party):
+            if resource_type not in RESOURCE_TYPES or resource_type == 'document':
+                raise ResourcePolicyError(f"Tipo de recurso no bloqueable {resource_type!r}")
+        base = PRESETS[preset]
+        policy_settings = get_resource_policy_settings()
+        blocks = preset != POLICY_FULL
+        self.preset = preset
+        self.block_types = frozenset((*base.get('block_types', ()), *block_types))
+        self.block_third_party = frozenset((*base.get('block_third_party', ()), *block_third_party))
+        self.block_domains = tuple((*base.get('block_domains', ()),
+                                    *(policy_settings.get('BLOCK_DOMAINS', ()) if blocks else ()), *block_domains))
+        self.allow_domains = tuple((*TAG_DOMAINS, *policy_settings.get('ALLOW_DOMAINS', ()), *allow_domains))
+        # Solo las reglas propias (sin las del preset ni las de ajustes): lo que se guarda en la sesión
+        self.rules = {
+            key: list(value)
+            for key, value in (('block_types', block_types), ('block_domains', block_domains),
+                               ('allow_domains', allow_domains), ('block_third_party', block_third_party))
+            if value
+        }
+
+    @classmethod
+    def from_rules(cls, preset=None, rules=None):
+        """Política a partir de un preset (por defecto el de ajustes) y un dict de reglas opcional"""
+        rules = rules or {}
+        if not isinstance(rules, dict):
+            raise ResourcePolicyError("Las reglas de recursos deben ser un objeto")
+        preset = preset or rules.get('preset') or get_resource_policy_settings().get('DEFAULT', POLICY_FULL)
+        lists = {}
+        for key in ('block_types', 'block_domains', 'allow_domains', 'block_third_party'):
+            value = rules.get(key) or ()
+            if not isinstance(value, (list, tuple)) or not all(isinstance(item, str) for item in value):
+                raise ResourcePolicyError(f"'{key}' debe ser una lista de cadenas")
+            lists[key] = tuple(value)
+        return cls(preset, **lists)
+
+    @property
+    def blocks_anything(self):
+        """False si no hace falta interceptar (preset ``full`` sin reglas propias)"""
+        return bool(self.block_types or self.block_third_party or self.block_domains)
+
+    def describe(self):
+        return {
+            'preset': self.preset,
+            'block_types': sorted(self.block_types),
+            'block_third_party': sorted(self.block_third_party),
+            'block_domains': list(self.block_domains),
+            'allow_domains': list(self.allow_domains),
+            'rules': self.rules,
+        }
+
+    def decide(self, resource_type, url, page_host=None):
+        """Devuelve el motivo del bloqueo (``type``, ``domain``, ``third_party``) o None si se permite"""
+        host = (urlsplit(url).hostname or '').lower()
+        if not host:
+            return None # data:, blob:...
+        if any(domain_matches(host, pattern) for pattern in self.allow_domains):
+            return None
+        if any(domain_matches(host, pattern) for pattern in self.block_domains):
+            return 'domain'
+        if resource_type in self.block_types:
+            return 'type'
+        if resource_type in self.block_third_party and page_host and site_of(host) != site_of(page_host):
+            return 'third_party'
+        return None
+
+
+class PageResourceStats:
+    """Peticiones permitidas y bloqueadas de una página (una navegación del documento principal)"""
+
+    def __init__(self, url):
+        self.url = url
+        self.host = (urlsplit(url).hostname or '').lower()
+        self.started_at = time.time()
+        self.allowed = 0
+        self.blocked = 0
+        self.bytes_saved = 0
+        self.blocked_by_type = Counter()
+        self.blocked_by_reason = Counter()
+        self.blocked_hosts = Counter()
+
+    def record(self, resource_type, host, reason):
+        if reason is None:
+            self.allowed += 1
+            return
+        self.blocked += 1
+        self.bytes_saved += TYPICAL_BYTES.get(resource_type, DEFAULT_TYPICAL_BYTES)
+        self.blocked_by_type[resource_type] += 1
+        self.blocked_by_reason[reason] += 1
+        self.blocked_hosts[host] += 1
+
+    def as_dict(self):
+        return {
+            'url': self.url,
+            'allowed': self.allowed,
+            'blocked': self.blocked,
+            'bytes_saved_estimate': self.bytes_saved,
+            'blocked_by_type': dict(self.blocked_by_type),
+            'blocked_by_reason': dict(self.blocked_by_reason),
+            'top_blocked_hosts': dict(self.blocked_hosts.most_common(5)),
+        }
+
+
+class ResourceTracker:
+    """Handler de ``context.route`` que aplica una política y cuenta por página"""
+
+    def __init__(self, policy, history=20):
+        self.policy = policy
+        self.pages = deque(maxlen=history) # Páginas anteriores, la más reciente al final
+        self.current = None
+        self.changed = False # Hay cifras nuevas desde el último report()
+        self.totals = Counter() # Acumulado de la sesión (no se pierde al rotar ``pages``)
+
+    async def handle_route(self, route, request):
+        resource_type = request.resource_type
+        main_document = False
+        if resource_type == 'document':
+            try:
+                main_document = request.frame.parent_frame is None
+            except Exception:
+                main_document = False # Peticiones de service workers no tienen frame
+            if not main_document:
+                resource_type = 'subdocument'
+        if main_document and request.is_navigation_request():
+            self.start_page(request.url)
+
+        reason = None if main_document else self.policy.decide(
+            resource_type, request.url, self.current.host if self.current else None)
+        if self.current is None:
+            self.start_page(request.url)
+        self.current.record(resource_type, (urlsplit(request.url).hostname or '').lower(), reason)
+        self.totals['blocked' if reason else 'allowed'] += 1
+        if reason:
+            self.totals['bytes_saved_estimate'] += TYPICAL_BYTES.get(resource_type, DEFAULT_TYPICAL_BYTES)
+        self.changed = True
+        RESOURCE_REQUESTS.labels(self.policy.preset, 'blocked' if reason else 'allowed', resource_type).inc()
+
+        try:
+            if reason:
+                await route.abort('blockedbyclient')
+            else:
+                await route.fallback()
+        except Exception as e:
+            # Página cerrada o petición ya resuelta mientras se decidía
+            logger.debug(f"No se pudo resolver la petición {request.url[:100]}: {e}")
+
+    def start_page(self, url):
+        if self.current is not None:
+            if self.current.blocked:
+                logger.info(f"Recursos en {self.current.url[:100]}: {self.current.allowed} permitidos, "
+                            f"{self.current.blocked} bloqueados (~{self.current.bytes_saved // 1024} KB) con '{self.policy.preset}'")
+            self.pages.append(self.current)
+        self.current = PageResourceStats(url)
+        self.totals['pages'] += 1
+
+    def report(self):
+        """Cifras de la página actual y acumuladas de la sesión; marca la página como comunicada"""
+        self.changed = False
+        return {
+            'policy': self.policy.preset,
+            'page': self.current.as_dict() if self.current else None,
+            'totals': {key: self.totals[key] for key in ('pages', 'allowed', 'blocked', 'bytes_saved_estimate')},
+        }
+
+    def history(self):
+        return [page.as_dict() for page in (*self.pages, *([self.current] if self.current else []))]
@@ -0,0 +1,113 @@
+# core/screencast.py
+"""
+Vista en vivo continua basada en el screencast de DevTools (solo Chromium).
+
+Sustituye las capturas puntuales tras cada interacción: el navegador emite
+frames JPEG por ``Page.screencastFrame`` y cada frame se confirma con
+``Page.screencastFrameAck`` solo después de haberlo enviado al cliente y de
+respetar el intervalo de FPS objetivo. Así el navegador nunca produce más
+frames de los que el WebSocket puede entregar.
+"""
+import asyncio
+import base64
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Screencast:
+    """Screencast CDP de una página con control de FPS, calidad y tamaño"""
+
+    def __init__(self, page, on_frame, fps=5, quality=60, max_width=1280, max_height=720):
+        self.page = page
+        self.on_frame = on_frame # Corrutina (jpeg_bytes) llamada por cada frame
+        self.cdp = None
+        self.running = False
+        self.frames_sent = 0
+        self._last_frame_at = 0.0
+        self.configure(fps=fps, quality=quality, max_width=max_width, max_height=max_height)
+
+    @staticmethod
+    def is_supported(browser):
+        """El screencast usa el protocolo DevTools, disponible solo en Chromium"""
+        try:
+            return browser.browser_type.name == 'chromium'
+        except Exception:
+            return False
+
+    def configure(self, fps=None, quality=None, max_width=None, max_height=None):
+        """Actualiza los parámetros; se aplican al (re)iniciar el screencast"""
+        if fps is not None:
+            self.fps = min(max(float(fps), 0.2), 30.0)
+        if quality is not None:
+            self.quality = min(max(int(quality), 10), 100)
+        if max_width is not None:
+            self.max_width = max(int(max_width), 64)
+        if max_height is not None:
+            self.max_height = max(int(max_height), 64)
+
+    def options(self):
+        return {
+            'fps': self.fps,
+            'quality': self.quality,
+            'max_width': self.max_width,
+            'max_height': self.max_height,
+        }
+
+    async def start(self):
+        if self.running:
+            return
+        if self.cdp is None:
+            self.cdp = await self.page.context.new_cdp_session(self.page)
+            self.cdp.on('Page.screencastFrame', lambda params: asyncio.create_task(self._handle_frame(params)))
+        await self.cdp.send('Page.startScreencast', {
+            'format': 'jpeg',
+            'quality': self.quality,
+            'maxWidth': self.max_width,
+            'maxHeight': self.max_height,
+            'everyNthFrame': 1,
+        })
+        self.running = True
+        logger.info(f"Screencast iniciado: {self.options()}")
+
+    async def stop(self):
+        if not self.running and self.cdp is None:
+            return
+        self.running = False
+        if self.cdp is not None:
+            try:
+                await self.cdp.send('Page.stopScreencast')
+                await self.cdp.detach()
+            except Exception as e:
+                # La página puede estar ya cerrada
+                logger.debug(f"Error al detener screencast (ignorado): {e}")
+            self.cdp = None
+        logger.info(f"Screencast detenido tras {self.frames_sent} frames")
+
+    async def restart(self):
+        await self.stop()
+        await self.start()
+
+    async def _handle_frame(self, params):
+        session_id = params.get('sessionId')
+        try:
+            if not self.running:
+                return
+            await self.on_frame(base64.b64decode(params['data']))
+            self.frames_sent += 1
+
+            # Retrasar el ack hasta cumplir el intervalo: limita los FPS en origen
+            interval = 1.0 / self.fps
+            wait = self._last_frame_at + interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._last_frame_at = time.monotonic()
+        except Exception as e:
+            logger.warning(f"Error enviando frame de screencast: {e}")
+        finally:
+            if self.running and self.cdp is not None:
+                try:
+                    await self.cdp.send('Page.screencastFrameAck', {'sessionId': session_id})
+                except Exception as e:
+                    logger.debug(f"Error en ack de frame de screencast: {e}")
@@ -0,0 +1,71 @@
+# core/screenshot_pipeline.py
+"""
+Escritura de capturas de pantalla en segundo plano.
+
+El consumer envía cada captura al cliente en cuanto la obtiene y delega el
+guardado en disco y la inserción en BD a una cola acotada por sesión. Si la
+cola se llena se descarta el frame más antiguo pendiente (el más nuevo
+siempre sustituye al que nadie ha guardado todavía).
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ScreenshotWriter:
+    """Cola acotada con una tarea de escritura por sesión"""
+
+    def __init__(self, session_id, save_func, max_queue=4):
+        self.session_id = session_id
+        self.save_func = save_func # Corrutina (image_bytes, url) -> Screenshot | None
+        self.queue = asyncio.Queue(maxsize=max(1, max_queue))
+        self.task = None
+        self.saved_count = 0
+        self.dropped_count = 0
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    def submit(self, image_bytes, url):
+        """Encola una captura sin bloquear; descarta la más antigua si no hay hueco"""
+        self.start()
+        if self.queue.full():
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped_count += 1
+                logger.debug(f"Cola de screenshots llena en sesión {self.session_id}, frame antiguo descartado")
+            except asyncio.QueueEmpty:
+                pass
+        self.queue.put_nowait((image_bytes, url))
+
+    async def stop(self, flush=True, timeout=10):
+        """Detiene la tarea de escritura, esperando a vaciar la cola si ``flush``"""
+        if self.task is None:
+            return
+        if flush:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Timeout vaciando cola de screenshots de sesión {self.session_id} ({self.queue.qsize()} pendientes)")
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        logger.info(f"Escritor de screenshots detenido para sesión {self.session_id}: {self.saved_count} guardados, {self.dropped_count} descartados")
+
+    async def _run(self):
+        while True:
+            image_bytes, url = await self.queue.get()
+            try:
+                screenshot_obj = await self.save_func(image_bytes, url)
+                if screenshot_obj:
+                    self.saved_count += 1
+            except Exception as e:
+                logger.exception(f"Error guardando screenshot en segundo plano para sesión {self.session_id}: {e}")
+            finally:
+                self.queue.task_done()
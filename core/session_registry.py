@@ -0,0 +1,77 @@
+# core/session_registry.py
+"""
+Sesiones con navegador vivas en este proceso y su periodo de gracia.
+
+El consumer que lanza el navegador de una sesión es su *holder*. Cuando su
+WebSocket se cae no cierra el navegador: queda *desacoplado* durante
+``SESSION_SETTINGS['RECONNECT_GRACE']`` segundos, sigue capturando y
+validando los pushes del dataLayer y guarda los mensajes que no pudo enviar
+(hasta ``CATCH_UP_MAX``). El socket que reconecta se acopla al holder como
+relay (ver ``core/workers.py``), recibe esos mensajes de recuperación y
+sigue usando la misma página, sin relanzar el navegador ni recargar la URL.
+
+Si pasa el periodo de gracia sin ningún cliente acoplado, el holder libera
+el navegador como hacía antes la desconexión.
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def get_session_settings():
+    return getattr(settings, 'SESSION_SETTINGS', {})
+
+
+class SessionRegistry:
+    """Holders de este proceso por nombre de canal y temporizadores de gracia"""
+
+    def __init__(self, grace_seconds=None):
+        self.grace_seconds = grace_seconds if grace_seconds is not None else get_session_settings().get('RECONNECT_GRACE', 120)
+        self.holders = {} # channel_name -> consumer
+        self._timers = {} # channel_name -> tarea de expiración
+
+    def register(self, consumer):
+        self.holders[consumer.channel_name] = consumer
+
+    def unregister(self, consumer):
+        self.holders.pop(consumer.channel_name, None)
+        self.cancel_grace(consumer)
+
+    def get(self, channel_name):
+        return self.holders.get(channel_name)
+
+    def start_grace(self, consumer):
+        """Cuenta el periodo de gracia de un holder sin clientes; al vencer, ``consumer.end_detached()``"""
+        self.cancel_grace(consumer)
+        self._timers[consumer.channel_name] = asyncio.create_task(self._expire(consumer))
+        logger.info(f"Sesión {consumer.session_id} desacoplada: el navegador se mantiene {self.grace_seconds} s")
+
+    def cancel_grace(self, consumer):
+        timer = self._timers.pop(consumer.channel_name, None)
+        if timer and not timer.done() and timer is not asyncio.current_task():
+            timer.cancel()
+
+    def stats(self):
+        detached = [consumer for consumer in self.holders.values() if consumer.detached]
+        return {
+            'holders': len(self.holders),
+            'detached': len(detached),
+            'waiting_reconnect': len(self._timers),
+        }
+
+    async def _expire(self, consumer):
+        await asyncio.sleep(self.grace_seconds)
+        logger.info(f"Periodo de gracia vencido para sesión {consumer.session_id}: se libera el navegador")
+        try:
+            await consumer.end_detached()
+        except Exception as e:
+            logger.exception(f"Error al liberar la sesión desacoplada {consumer.session_id}: {e}")
+        finally:
+            self._timers.pop(consumer.channel_name, None)
+
+
+# Registro del proceso (uno por worker Daphne)
+session_registry = SessionRegistry()
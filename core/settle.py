@@ -0,0 +1,130 @@
+# core/settle.py
+"""
+Detección de página estable tras una interacción.
+
+Sustituye las esperas fijas (``asyncio.sleep``) por tres señales:
+
+- red: sin peticiones en curso (ignorando las de larga duración, como
+  long-polling o streaming) durante la ventana de silencio;
+- DOM: ningún cambio observado por un ``MutationObserver`` durante la ventana;
+- dataLayer: ningún push recibido durante la ventana.
+
+La espera termina en cuanto las tres se cumplen o al alcanzar el límite.
+"""
+import asyncio
+import logging
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+
+SettleResult = namedtuple('SettleResult', ['settled', 'duration_ms', 'busy'])
+
+# Se inyecta con add_init_script para que exista en cada documento
+SETTLE_MONITOR_SCRIPT = """(() => {
+    if (window.__settleInstalled) return;
+    window.__settleInstalled = true;
+    window.__settleLastMutation = performance.now();
+    new MutationObserver(() => {
+        window.__settleLastMutation = performance.now();
+    }).observe(document, { subtree: true, childList: true, attributes: true, characterData: true });
+})();"""
+
+# Resuelve true cuando el DOM lleva quietMs sin cambios, false si se agota maxMs
+DOM_QUIET_SCRIPT = """([quietMs, maxMs]) => new Promise(resolve => {
+    const start = performance.now();
+    const check = () => {
+        const now = performance.now();
+        const last = window.__settleLastMutation || 0;
+        if (now - last >= quietMs) return resolve(true);
+        if (now - start >= maxMs) return resolve(false);
+        setTimeout(check, Math.max(5, Math.min(quietMs - (now - last), maxMs - (now - start))));
+    };
+    check();
+})"""
+
+
+class SettleDetector:
+    """Sigue la actividad de red y de dataLayer de una página y espera a que se calme"""
+
+    def __init__(self, page, quiet_ms=300, timeout_ms=3000, long_request_ms=5000):
+        self.page = page
+        self.quiet = quiet_ms / 1000
+        self.timeout_ms = timeout_ms
+        self.long_request = long_request_ms / 1000
+        self.inflight = {} # request -> instante de inicio
+        self.last_network_activity = time.monotonic()
+        self.last_push = 0.0
+
+        page.on('request', self._on_request)
+        page.on('requestfinished', self._on_request_done)
+        page.on('requestfailed', self._on_request_done)
+
+    def notify_push(self):
+        """Registrar un push del dataLayer (lo llama el consumer)"""
+        self.last_push = time.monotonic()
+
+    def _on_request(self, request):
+        now = time.monotonic()
+        self.inflight[request] = now
+        self.last_network_activity = now
+
+    def _on_request_done(self, request):
+        self.inflight.pop(request, None)
+        self.last_network_activity = time.monotonic()
+
+    def _network_quiet_for(self, now, since):
+        # Olvidar peticiones que nunca notificaron su fin (p. ej. tras navegar)
+        for request in [r for r, started in self.inflight.items() if now - started > 60]:
+            del self.inflight[request]
+        # Las peticiones que llevan mucho abiertas no bloquean (long-polling, streams)
+        for started in self.inflight.values():
+            if now - started < self.long_request:
+                return 0.0
+        return now - max(self.last_network_activity, since)
+
+    def _busy_signal(self, now, since):
+        # El silencio se cuenta desde el inicio de la espera: la propia acción es actividad
+        if self._network_quiet_for(now, since) < self.quiet:
+            return 'network'
+        if now - max(self.last_push, since) < self.quiet:
+            return 'datalayer'
+        return None
+
+    async def wait(self, timeout_ms=None):
+        """Espera a que la página esté estable; nunca más de ``timeout_ms``"""
+        timeout = (timeout_ms or self.timeout_ms) / 1000
+        start = time.monotonic()
+        deadline = start + timeout
+        busy = None
+
+        while True:
+            now = time.monotonic()
+            remaining = deadline - now
+            if remaining <= 0:
+                return SettleResult(False, round((now - start) * 1000), busy)
+
+            busy = self._busy_signal(now, start)
+            if busy:
+                await asyncio.sleep(min(0.05, remaining))
+                continue
+
+            try:
+                dom_quiet = await self.page.evaluate(DOM_QUIET_SCRIPT, [self.quiet * 1000, remaining * 1000])
+            except Exception as e:
+                # Contexto destruido por una navegación en curso: seguir esperando
+                logger.debug(f"Evaluación de DOM interrumpida durante la espera: {e}")
+                busy = 'navigation'
+                await asyncio.sleep(min(0.05, max(remaining, 0)))
+                continue
+
+            if not dom_quiet:
+                busy = 'dom'
+                continue
+
+            # Red y dataLayer pueden haberse movido mientras se esperaba al DOM
+            now = time.monotonic()
+            busy = self._busy_signal(now, start)
+            if not busy:
+                return SettleResult(True, round((now - start) * 1000), None)
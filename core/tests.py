@@ -1,3 +1,1299 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.asgi import get_asgi_application
+from django.core.files.base import ContentFile
+from django.conf import settings
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from .admission import AdmissionController
+from .batch import BatchError, BatchRunner, parse_jobs
+from .browser_pool import BrowserPool, PooledBrowser
+from .capture_buffer import CaptureBuffer
+from .command_queue import CommandQueue, coalesce_key
+from .consumers import SessionConsumer
+from .exports import export_stream, filter_captures, flatten
+from .interaction import is_navigation_error
+from .report_cache import artifact_key, evict, get_cache_dir, open_report_artifact
+from .report_jobs import enqueue_report_job, new_report_job
+from .macros import _MISSING, MacroError, get_path, parse_macro, push_matches
+from .models import DataLayerCapture, Report, Session
+from .report_stream import ReportStream, iter_artifact
+from .resource_policy import ResourcePolicy, ResourcePolicyError, domain_matches, site_of
+from .session_registry import session_registry
+from .workers import RELAY_CLOSE_CODE, WorkerRegistry, worker_registry
+from validator.validator import ReferenceIndex, ReferenceSpec
+
+
+class CommandQueueTests(SimpleTestCase):
+    """Orden, agrupación, cancelación y errores de la cola de comandos"""
+
+    def run_queue(self, scenario):
+        async def runner():
+            executed, statuses = [], []
+            gate = asyncio.Event()
+
+            async def execute(action, data):
+                if data.get('block'):
+                    await gate.wait()
+                if data.get('fail'):
+                    raise RuntimeError('fallo')
+                executed.append((action, data.get('id')))
+
+            async def notify(message):
+                statuses.append((message['id'], message['status']))
+
+            queue = CommandQueue(execute, notify, max_depth=10)
+            try:
+                await scenario(queue, gate)
+                for _ in range(50):
+                    await asyncio.sleep(0)
+            finally:
+                await queue.stop()
+            return executed, statuses
+        return asyncio.run(runner())
+
+    def test_priority_then_arrival_order(self):
+        async def scenario(queue, gate):
+            await queue.submit('capture', {'id': 'cap', 'command': 'datalayer', 'block': True})
+            await asyncio.sleep(0) # La captura empieza y se queda bloqueada
+            await queue.submit('interaction', {'id': 'i1', 'command': 'scroll'})
+            await queue.submit('navigation', {'id': 'n1', 'command': 'back'})
+            await queue.submit('interaction', {'id': 'i2', 'command': 'scroll'})
+            gate.set()
+
+        executed, _ = self.run_queue(scenario)
+        self.assertEqual([item[1] for item in executed], ['cap', 'n1', 'i1', 'i2'])
+
+    def test_pending_click_is_coalesced(self):
+        async def scenario(queue, gate):
+            await queue.submit('capture', {'id': 'cap', 'command': 'datalayer', 'block': True})
+            await asyncio.sleep(0)
+            await queue.submit('interaction', {'id': 'c1', 'command': 'click'})
+            await queue.submit('interaction', {'id': 'c2', 'command': 'click'})
+            gate.set()
+
+        executed, statuses = self.run_queue(scenario)
+        self.assertEqual([item[1] for item in executed], ['cap', 'c2'])
+        self.assertIn(('c2', 'coalesced'), statuses)
+
+    def test_cancel_all_drops_pending_and_current(self):
+        async def scenario(queue, gate):
+            await queue.submit('capture', {'id': 'cap', 'command': 'datalayer', 'block': True})
+            await asyncio.sleep(0)
+            await queue.submit('navigation', {'id': 'n1', 'command': 'back'})
+            self.assertEqual(await queue.cancel(all_pending=True), 2)
+
+        executed, statuses = self.run_queue(scenario)
+        self.assertEqual(executed, [])
+        self.assertIn(('cap', 'cancelled'), statuses)
+        self.assertIn(('n1', 'cancelled'), statuses)
+
+    def test_failing_command_is_reported_as_failed(self):
+        async def scenario(queue, gate):
+            await queue.submit('capture', {'id': 'bad', 'command': 'datalayer', 'fail': True})
+            await queue.submit('capture', {'id': 'ok', 'command': 'screenshot'})
+
+        executed, statuses = self.run_queue(scenario)
+        self.assertIn(('bad', 'failed'), statuses)
+        self.assertIn(('ok', 'done'), statuses)
+        self.assertEqual(executed, [('capture', 'ok')])
+
+    def test_coalesce_keys(self):
+        self.assertEqual(coalesce_key('interaction', {'command': 'type', 'selector': '#a'}), 'interaction:type:#a')
+        self.assertEqual(coalesce_key('navigation', {'command': 'goto'}), 'navigation:goto')
+        self.assertIsNone(coalesce_key('navigation', {'command': 'back'}))
+
+
+class CaptureBufferTests(SimpleTestCase):
+    """Vaciado del buffer de capturas por tamaño, por tiempo y al cerrar"""
+
+    def make_buffer(self, fail_times=0, **kwargs):
+        saved, lost = [], []
+        failures = {'left': fail_times}
+
+        async def flush_func(batch):
+            await asyncio.sleep(0)
+            if failures['left']:
+                failures['left'] -= 1
+                raise RuntimeError('BD caída')
+            saved.append(list(batch))
+
+        async def on_lost(batch, error):
+            lost.append((list(batch), str(error)))
+
+        kwargs.setdefault('retry_delay_ms', 0)
+        return CaptureBuffer('s1', flush_func, on_lost=on_lost, **kwargs), saved, lost
+
+    def test_flush_by_size_keeps_task_reference(self):
+        async def scenario():
+            buffer, saved, lost = self.make_buffer(max_batch=2, max_delay_ms=60000)
+            buffer.add('a')
+            buffer.add('b')
+            task = buffer._flush_task
+            await asyncio.sleep(0) # El vaciado empieza a guardar ['a', 'b']
+            for capture in 'cde':
+                buffer.add(capture)
+            self.assertIs(buffer._flush_task, task)
+            self.assertIsNone(buffer._timer) # Lleno el lote, no hace falta temporizador
+            await buffer._flush_task
+            return buffer, saved
+
+        buffer, saved = asyncio.run(scenario())
+        # El vaciado en curso recoge también lo que llegó mientras guardaba
+        self.assertEqual(saved, [['a', 'b'], ['c', 'd', 'e']])
+        self.assertEqual((buffer.flushed_count, len(buffer)), (5, 0))
+
+    def test_flush_by_time(self):
+        async def scenario():
+            buffer, saved, lost = self.make_buffer(max_batch=50, max_delay_ms=10)
+            buffer.add('a')
+            buffer.add('b')
+            self.assertEqual(saved, [])
+            await asyncio.sleep(0.05)
+            self.assertIsNone(buffer._timer)
+            return saved
+
+        self.assertEqual(asyncio.run(scenario()), [['a', 'b']])
+
+    def test_close_flushes_and_cancels_timer(self):
+        async def scenario():
+            buffer, saved, lost = self.make_buffer(max_batch=50, max_delay_ms=60000)
+            buffer.add('a')
+            timer = buffer._timer
+            await buffer.close()
+            await asyncio.sleep(0)
+            return timer, saved
+
+        timer, saved = asyncio.run(scenario())
+        self.assertTrue(timer.cancelled())
+        self.assertEqual(saved, [['a']])
+
+    def test_failed_batch_is_retried(self):
+        async def scenario():
+            buffer, saved, lost = self.make_buffer(fail_times=2, max_retries=2)
+            buffer.add('a')
+            await buffer.close()
+            return buffer, saved, lost
+
+        buffer, saved, lost = asyncio.run(scenario())
+        self.assertEqual((saved, lost, buffer.lost_count), ([['a']], [], 0))
+
+    def test_lost_batch_is_reported(self):
+        async def scenario():
+            buffer, saved, lost = self.make_buffer(fail_times=3, max_retries=1)
+            buffer.add('a')
+            buffer.add('b')
+            await buffer.close()
+            return buffer, saved, lost
+
+        buffer, saved, lost = asyncio.run(scenario())
+        self.assertEqual(saved, [])
+        self.assertEqual(lost, [(['a', 'b'], 'BD caída')])
+        self.assertEqual((buffer.flushed_count, buffer.lost_count), (0, 2))
+
+    def test_consumer_reports_lost_captures_to_client(self):
+        consumer = SessionConsumer()
+        consumer.counts = {'screenshots': 0, 'datalayers': 2, 'valid': 1, 'invalid': 1}
+        consumer.send = mock.AsyncMock()
+        captures = [DataLayerCapture(url='https://tienda.example/', data=[], is_valid=valid) for valid in (True, None)]
+        asyncio.run(consumer.report_lost_datalayers(captures, RuntimeError('BD caída')))
+
+        message = json.loads(consumer.send.await_args.kwargs['text_data'])
+        self.assertEqual(message['action'], 'datalayer_lost')
+        self.assertEqual(message['ids'], [str(capture.id) for capture in captures])
+        self.assertEqual(consumer.counts, {'screenshots': 0, 'datalayers': 0, 'valid': 0, 'invalid': 1})
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class SessionConsumerTests(TransactionTestCase):
+    """El consumer acepta la conexión y enruta acciones inmediatas y encoladas"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        for patcher in (
+            mock.patch.object(worker_registry, 'enabled', False),
+            mock.patch('core.consumers.browser_pool.warm_up', new=mock.AsyncMock()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.session = Session(url='https://tienda.example/')
+        self.session.json_file.save('referencia.json', ContentFile(json.dumps([{'event': 'page_view'}])), save=False)
+        self.session.save()
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(SessionConsumer.as_asgi(), f'/ws/session/{self.session.id}/')
+        communicator.scope['url_route'] = {'kwargs': {'session_id': str(self.session.id)}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        status = await communicator.receive_json_from(timeout=5)
+        self.assertEqual(status['action'], 'status')
+        return communicator
+
+    async def receive_until(self, communicator, predicate):
+        while True:
+            message = await communicator.receive_json_from(timeout=5)
+            if predicate(message):
+                return message
+
+    def test_immediate_and_queued_actions(self):
+        async def scenario():
+            communicator = await self.connect()
+            try:
+                # Inmediata: no pasa por la cola
+                await communicator.send_json_to({'action': 'live_view', 'command': 'enable'})
+                message = await communicator.receive_json_from(timeout=5)
+                self.assertEqual(message['action'], 'live_view')
+                self.assertTrue(message['enabled'])
+
+                # Encolada: la cola informa de su estado ('screencast' no necesita admisión previa)
+                with mock.patch.object(SessionConsumer, 'handle_screencast', new=mock.AsyncMock()) as handler:
+                    await communicator.send_json_to({'action': 'screencast', 'command': 'stop', 'id': 'sc1'})
+                    done = await self.receive_until(communicator, lambda m: m['action'] == 'command' and m['status'] not in ('queued', 'started'))
+                self.assertEqual((done['id'], done['status']), ('sc1', 'done'))
+                handler.assert_awaited_once()
+
+                # Un handler que falla llega a la cola como 'failed'
+                with mock.patch.object(SessionConsumer, 'handle_screencast', new=mock.AsyncMock(side_effect=RuntimeError('roto'))):
+                    await communicator.send_json_to({'action': 'screencast', 'command': 'stop', 'id': 'sc2'})
+                    failed = await self.receive_until(communicator, lambda m: m['action'] == 'command' and m['status'] not in ('queued', 'started'))
+                self.assertEqual((failed['id'], failed['status']), ('sc2', 'failed'))
+            finally:
+                await communicator.disconnect()
+
+        asyncio.run(scenario())
+
+    def test_resource_rules_survive_reconnect(self):
+        rules = {'block_domains': ['*.cdn-*.example'], 'allow_domains': ['images.tienda.example']}
+
+        async def scenario():
+            communicator = await self.connect()
+            try:
+                await communicator.send_json_to({'action': 'resource_policy', 'command': 'set', 'preset': 'visual', 'rules': rules})
+                reply = await self.receive_until(communicator, lambda m: m['action'] == 'resource_policy')
+            finally:
+                await communicator.disconnect()
+            self.assertEqual((reply['preset'], reply['rules']), ('visual', rules))
+
+            # Otra conexión (reconexión o nuevo init) reconstruye la política desde la sesión guardada
+            communicator = await self.connect()
+            try:
+                await communicator.send_json_to({'action': 'resource_policy', 'command': 'get'})
+                return await self.receive_until(communicator, lambda m: m['action'] == 'resource_policy')
+            finally:
+                await communicator.disconnect()
+
+        reply = asyncio.run(scenario())
+        self.assertEqual((reply['preset'], reply['rules']), ('visual', rules))
+        self.assertIn('*.cdn-*.example', reply['block_domains'])
+        self.session.refresh_from_db()
+        self.assertEqual((self.session.resource_policy, self.session.resource_rules), ('visual', rules))
+
+    def test_relays_to_remote_owner(self):
+        async def scenario():
+            layer = get_channel_layer()
+            owner_channel = await layer.new_channel()
+            owner = {'worker': 'w2', 'channel': owner_channel}
+            with mock.patch.object(worker_registry, 'claim_session', new=mock.AsyncMock(return_value=owner)):
+                communicator = await self.connect()
+            try:
+                attach = await asyncio.wait_for(layer.receive(owner_channel), timeout=5)
+                self.assertEqual(attach['type'], 'relay.attach')
+
+                # Lo que envía el cliente va al dueño; lo que envía el dueño llega al cliente
+                await communicator.send_json_to({'action': 'navigate', 'url': 'https://tienda.example/'})
+                forwarded = await asyncio.wait_for(layer.receive(owner_channel), timeout=5)
+                self.assertEqual((forwarded['type'], json.loads(forwarded['text'])['action']), ('relay.input', 'navigate'))
+                await layer.send(attach['channel'], {'type': 'relay.output', 'text': json.dumps({'action': 'url_changed'}), 'bytes': None})
+                self.assertEqual((await communicator.receive_json_from(timeout=5))['action'], 'url_changed')
+
+                # El dueño libera la sesión: el relay cierra para que el cliente reconecte
+                await layer.group_send(f'session_{self.session.id}', {'type': 'session.released', 'channel': owner_channel})
+                closed = await communicator.receive_output(timeout=5)
+                self.assertEqual((closed['type'], closed.get('code')), ('websocket.close', RELAY_CLOSE_CODE))
+            finally:
+                await communicator.disconnect()
+            self.assertNotIn(str(self.session.id), worker_registry.owned)
+
+        asyncio.run(scenario())
+
+    def test_reconnect_within_grace_and_release_after_it(self):
+        async def scenario():
+            communicator = await self.connect()
+            holder = next(consumer for consumer in session_registry.holders.values() if consumer.session_id == str(self.session.id))
+            holder.browser = mock.Mock() # Navegador "vivo" sin lanzar Playwright
+            with mock.patch.object(session_registry, 'grace_seconds', 0.2), \
+                    mock.patch.object(SessionConsumer, 'close_browser', new=mock.AsyncMock()) as close_browser:
+                await communicator.disconnect()
+                self.assertTrue(holder.detached)
+                await holder.send(text_data=json.dumps({'action': 'datalayer', 'event': 'purchase'})) # Sin cliente: se guarda
+
+                # Reconexión dentro del periodo de gracia: se acopla al holder y recupera lo perdido
+                communicator = await self.connect()
+                catch_up = await communicator.receive_json_from(timeout=5)
+                self.assertEqual((catch_up['action'], catch_up['count']), ('catch_up', 1))
+                self.assertEqual((await communicator.receive_json_from(timeout=5))['event'], 'purchase')
+                await asyncio.sleep(0.3)
+                close_browser.assert_not_awaited()
+                self.assertIn(holder.channel_name, session_registry.holders)
+
+                # Sin clientes otra vez: al vencer la gracia se libera el navegador y la sesión
+                await communicator.disconnect()
+                self.assertEqual(session_registry.stats()['waiting_reconnect'], 1)
+                await asyncio.sleep(0.3)
+                close_browser.assert_awaited_once()
+            self.assertNotIn(holder.channel_name, session_registry.holders)
+            self.assertNotIn(str(self.session.id), worker_registry.owned)
+
+        asyncio.run(scenario())
+
+    def test_cancelled_init_releases_browser(self):
+        async def scenario():
+            communicator = await self.connect()
+            holder = next(consumer for consumer in session_registry.holders.values() if consumer.session_id == str(self.session.id))
+            page_requested = asyncio.Event()
+
+            async def new_page():
+                page_requested.set()
+                await asyncio.Event().wait() # Playwright aún creando la página
+
+            lease = mock.Mock()
+            lease.browser.is_connected.return_value = True
+            lease.context.expose_binding = mock.AsyncMock()
+            lease.context.add_init_script = mock.AsyncMock()
+            lease.context.new_page = new_page
+            holder.admission_budget = mock.Mock()
+            try:
+                with mock.patch('core.consumers.browser_pool.acquire', new=mock.AsyncMock(return_value=lease)), \
+                        mock.patch('core.consumers.browser_pool.release', new=mock.AsyncMock()) as release, \
+                        mock.patch.object(holder, 'apply_resource_policy', new=mock.AsyncMock()):
+                    task = asyncio.create_task(holder.initialize_browser())
+                    await asyncio.wait_for(page_requested.wait(), timeout=5)
+                    task.cancel()
+                    with self.assertRaises(asyncio.CancelledError):
+                        await task
+                release.assert_awaited_once_with(lease)
+                self.assertEqual((holder.browser, holder.browser_lease, holder.context, holder.page), (None, None, None, None))
+            finally:
+                holder.admission_budget = None
+                await communicator.disconnect()
+
+        asyncio.run(scenario())
+
+
+class FakeRedis:
+    """Lo justo de redis.asyncio para el registro de workers (sin TTL)"""
+
+    def __init__(self):
+        self.data = {}
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def delete(self, key):
+        return int(self.data.pop(key, None) is not None)
+
+    async def exists(self, key):
+        return int(key in self.data)
+
+    async def expire(self, key, seconds):
+        return int(key in self.data)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def set(self, *args, **kwargs):
+        self.commands.append(self.redis.set(*args, **kwargs))
+
+    def expire(self, *args, **kwargs):
+        self.commands.append(self.redis.expire(*args, **kwargs))
+
+    async def execute(self):
+        return [await command for command in self.commands]
+
+
+class WorkerRegistryTests(SimpleTestCase):
+    """Propiedad de sesiones entre workers con un Redis compartido"""
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch.object(WorkerRegistry, '_ensure_heartbeat') # Sin tarea de latido en los tests
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_registry(self, worker_id):
+        registry = WorkerRegistry(worker_id=worker_id, capacity=2, heartbeat_interval=5)
+        registry.enabled = True
+        registry._redis = self.redis
+        return registry
+
+    def test_claim_and_release(self):
+        w1, w2 = self.make_registry('w1'), self.make_registry('w2')
+
+        async def scenario():
+            self.assertIsNone(await w1.claim_session('s1', 'canal-1'))
+            self.assertIn('dlv:worker:w1', self.redis.data) # Al reclamar publica su capacidad
+            # Otro worker (u otra pestaña en el mismo) recibe al dueño para hacer de relay
+            self.assertEqual(await w2.claim_session('s1', 'canal-2'), {'worker': 'w1', 'channel': 'canal-1'})
+            self.assertEqual(await w1.claim_session('s1', 'canal-3'), {'worker': 'w1', 'channel': 'canal-1'})
+
+            await w1.release_session('s1', 'canal-3') # Solo el dueño libera
+            self.assertIn('dlv:session:s1', self.redis.data)
+            await w1.release_session('s1', 'canal-1')
+            self.assertNotIn('dlv:session:s1', self.redis.data)
+            self.assertIsNone(await w2.claim_session('s1', 'canal-2'))
+            return json.loads(self.redis.data['dlv:session:s1'])
+
+        self.assertEqual(asyncio.run(scenario()), {'worker': 'w2', 'channel': 'canal-2'})
+        self.assertEqual((w1.owned, w2.owned), ({}, {'s1': 'canal-2'}))
+
+    def test_stale_owner_is_taken_over(self):
+        w1, w2 = self.make_registry('w1'), self.make_registry('w2')
+
+        async def scenario():
+            await w1.claim_session('s1', 'canal-1')
+            del self.redis.data['dlv:worker:w1'] # El worker w1 dejó de latir
+            self.assertIsNone(await w2.claim_session('s1', 'canal-2'))
+
+            # Clave de este mismo worker de un consumer que ya no existe (p. ej. tras reiniciar)
+            await self.redis.set('dlv:session:s2', json.dumps({'worker': 'w2', 'channel': 'canal-viejo'}))
+            self.assertIsNone(await w2.claim_session('s2', 'canal-3'))
+
+        asyncio.run(scenario())
+        self.assertEqual(json.loads(self.redis.data['dlv:session:s1']), {'worker': 'w2', 'channel': 'canal-2'})
+        self.assertEqual(json.loads(self.redis.data['dlv:session:s2']), {'worker': 'w2', 'channel': 'canal-3'})
+
+    def test_redis_errors_fall_back_to_local_ownership(self):
+        registry = self.make_registry('w1')
+        registry._redis = mock.Mock(set=mock.AsyncMock(side_effect=ConnectionError('sin Redis')))
+        self.assertIsNone(asyncio.run(registry.claim_session('s1', 'canal-1')))
+        self.assertEqual(registry.owned, {'s1': 'canal-1'})
+
+
+class ResourcePolicyTests(SimpleTestCase):
+    """Sitio registrable, patrones de dominio y decisiones de bloqueo"""
+
+    def test_site_of(self):
+        self.assertEqual(site_of('www.bmw.de'), 'bmw.de')
+        self.assertEqual(site_of('static.bmw.de'), 'bmw.de')
+        self.assertEqual(site_of('cdn.ing.es'), 'ing.es')
+        self.assertEqual(site_of('tienda.example.co.uk'), 'example.co.uk')
+        self.assertEqual(site_of('www.exito.com.co'), 'exito.com.co')
+        self.assertEqual(site_of('example.com'), 'example.com')
+        self.assertEqual(site_of('tienda.myshopify.com'), 'tienda.myshopify.com')
+        self.assertEqual(site_of('192.168.1.10'), '192.168.1.10')
+
+    def test_domain_matches(self):
+        self.assertTrue(domain_matches('ad.doubleclick.net', 'doubleclick.net'))
+        self.assertTrue(domain_matches('doubleclick.net', '.doubleclick.net'))
+        self.assertFalse(domain_matches('notdoubleclick.net', 'doubleclick.net'))
+        self.assertTrue(domain_matches('a.cdn-1.example', '*.cdn-*.example'))
+        self.assertFalse(domain_matches('cdn-1.example', '*.cdn-*.example'))
+
+    def test_tags_keeps_first_party_on_short_cctld_domains(self):
+        policy = ResourcePolicy('tags')
+        self.assertIsNone(policy.decide('script', 'https://static.bmw.de/a.js', 'www.bmw.de'))
+        self.assertIsNone(policy.decide('xhr', 'https://api.ing.es/x', 'www.ing.es'))
+        self.assertEqual(policy.decide('script', 'https://widgets.other.de/a.js', 'www.bmw.de'), 'third_party')
+
+    def test_decide_reasons(self):
+        policy = ResourcePolicy('tags')
+        self.assertEqual(policy.decide('image', 'https://www.bmw.de/logo.png', 'www.bmw.de'), 'type')
+        self.assertEqual(policy.decide('script', 'https://securepubads.g.doubleclick.net/tag.js', 'www.bmw.de'), 'domain')
+        # La lista permitida gana al tipo y a terceros
+        self.assertIsNone(policy.decide('script', 'https://www.googletagmanager.com/gtm.js', 'www.bmw.de'))
+        self.assertIsNone(policy.decide('image', 'data:image/png;base64,AAAA', 'www.bmw.de'))
+        self.assertIsNone(ResourcePolicy('full').decide('image', 'https://www.bmw.de/logo.png', 'www.bmw.de'))
+        self.assertIsNone(ResourcePolicy('visual').decide('image', 'https://www.bmw.de/logo.png', 'www.bmw.de'))
+
+    def test_custom_rules(self):
+        policy = ResourcePolicy.from_rules('full', {'block_domains': ['*.cdn-*.example'], 'allow_domains': ['images.bmw.de'],
+                                                    'block_types': ['image']})
+        self.assertTrue(policy.blocks_anything)
+        self.assertEqual(policy.decide('script', 'https://a.cdn-1.example/x.js'), 'domain')
+        self.assertIsNone(policy.decide('image', 'https://images.bmw.de/x.png'))
+        self.assertFalse(ResourcePolicy('full').blocks_anything)
+        self.assertEqual(policy.rules, {'block_domains': ['*.cdn-*.example'], 'allow_domains': ['images.bmw.de'],
+                                        'block_types': ['image']})
+        self.assertEqual(ResourcePolicy('tags').rules, {}) # Lo del preset no son reglas propias
+        with self.assertRaises(ResourcePolicyError):
+            ResourcePolicy.from_rules('ninguno')
+        with self.assertRaises(ResourcePolicyError):
+            ResourcePolicy.from_rules('tags', {'block_types': ['document']})
+
+
+class BatchApiAuthTests(TestCase):
+    """La API de lotes exige un token configurado"""
+
+    def batch_settings(self, token):
+        return override_settings(BATCH_SETTINGS={**settings.BATCH_SETTINGS, 'API_TOKEN': token})
+
+    def test_disabled_without_token(self):
+        with self.batch_settings(''):
+            response = self.client.post('/api/batch/', data='{}', content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_rejects_wrong_token(self):
+        with self.batch_settings('secreto'):
+            response = self.client.post('/api/batch/', data='{}', content_type='application/json',
+                                        HTTP_AUTHORIZATION='Bearer otro')
+            status = self.client.get('/api/batch/abc/')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(status.status_code, 401)
+
+    def test_accepts_configured_token(self):
+        with self.batch_settings('secreto'):
+            response = self.client.post('/api/batch/', data='{"jobs": []}', content_type='application/json',
+                                        HTTP_AUTHORIZATION='Bearer secreto')
+        self.assertEqual(response.status_code, 400) # Autorizado; falla la validación del lote
+
+
+class MetricsAuthTests(TestCase):
+    """El endpoint de métricas exige el token si está configurado"""
+
+    def test_token(self):
+        with override_settings(METRICS_SETTINGS={**getattr(settings, 'METRICS_SETTINGS', {}), 'TOKEN': 'secreto'}):
+            self.assertEqual(self.client.get('/metrics').status_code, 401)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer otro').status_code, 401)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secreto')
+        self.assertEqual(response.status_code, 200)
+
+
+class BatchLimitsTests(SimpleTestCase):
+    """Topes de trabajos y de concurrencia de los lotes"""
+
+    @override_settings(BATCH_SETTINGS={'MAX_JOBS': 2, 'MAX_CONCURRENCY': 3, 'CONCURRENCY': 2})
+    def test_limits(self):
+        self.assertEqual(len(parse_jobs(['https://a.example/', {'url': 'https://b.example/'}])), 2)
+        with self.assertRaises(BatchError):
+            parse_jobs(['https://a.example/'] * 3)
+        self.assertEqual(BatchRunner([], concurrency=50, pool=mock.Mock()).concurrency, 3)
+        self.assertEqual(BatchRunner([], pool=mock.Mock()).concurrency, 2)
+        with self.assertRaises(BatchError):
+            BatchRunner([], concurrency=[4], pool=mock.Mock())
+
+
+class BrowserPoolLaunchTests(SimpleTestCase):
+    """Los lanzamientos no bloquean el pool mientras arranca el navegador"""
+
+    def make_browser(self, browser_type='chromium', headless=True):
+        browser = mock.Mock(is_connected=mock.Mock(return_value=True), close=mock.AsyncMock(),
+                            new_context=mock.AsyncMock(side_effect=lambda **options: mock.Mock(close=mock.AsyncMock())))
+        return PooledBrowser(browser, browser_type, headless)
+
+    def make_pool(self, max_size):
+        pool = BrowserPool(min_size=0, max_size=max_size, headless=True, name='test')
+        pool._playwright = mock.Mock()
+        pool._maintenance_task = mock.Mock(done=mock.Mock(return_value=False))
+        return pool
+
+    def test_launch_does_not_hold_the_lock(self):
+        pool = self.make_pool(max_size=2)
+        busy, idle = self.make_browser(), self.make_browser('firefox')
+        busy.active_contexts = 1
+        pool._browsers = {('chromium', True): [busy], ('firefox', True): [idle]}
+        gate = asyncio.Event()
+        launched = self.make_browser()
+
+        async def slow_launch(browser_type, headless):
+            await gate.wait()
+            return launched
+
+        async def scenario():
+            with mock.patch.object(pool, '_launch', new=slow_launch):
+                launching = asyncio.create_task(pool.acquire('chromium'))
+                await asyncio.sleep(0)
+                self.assertEqual(pool._pending[('chromium', True)], 1)
+                # Mientras arranca Chromium, otro tipo con un navegador libre y las devoluciones no esperan
+                lease = await asyncio.wait_for(pool.acquire('firefox'), 1)
+                await asyncio.wait_for(pool.release(lease), 1)
+                self.assertFalse(launching.done())
+                gate.set()
+                lease = await asyncio.wait_for(launching, 1)
+            self.assertIs(lease.pooled_browser, launched)
+            self.assertEqual(launched.active_contexts, 1)
+            self.assertEqual(pool._browsers[('chromium', True)], [busy, launched])
+            self.assertEqual(pool._pending[('chromium', True)], 0)
+
+        asyncio.run(scenario())
+
+    def test_waits_for_pending_launch_instead_of_overshooting(self):
+        pool = self.make_pool(max_size=1)
+        gate = asyncio.Event()
+        launched = self.make_browser()
+        launch = mock.Mock()
+
+        async def slow_launch(browser_type, headless):
+            launch(browser_type, headless)
+            await gate.wait()
+            return launched
+
+        async def scenario():
+            with mock.patch.object(pool, '_launch', new=slow_launch):
+                first = asyncio.create_task(pool.acquire('chromium'))
+                second = asyncio.create_task(pool.acquire('chromium'))
+                await asyncio.sleep(0)
+                self.assertFalse(second.done())
+                gate.set()
+                leases = await asyncio.wait_for(asyncio.gather(first, second), 1)
+            self.assertEqual(launch.call_count, 1) # El segundo comparte el navegador recién lanzado
+            self.assertEqual([lease.pooled_browser for lease in leases], [launched, launched])
+            self.assertEqual(launched.active_contexts, 2)
+
+        asyncio.run(scenario())
+
+    def test_failed_launch_frees_the_slot(self):
+        pool = self.make_pool(max_size=1)
+
+        async def scenario():
+            with mock.patch.object(pool, '_launch', new=mock.AsyncMock(side_effect=RuntimeError('sin navegador'))):
+                with self.assertRaises(RuntimeError):
+                    await pool.acquire('chromium')
+            self.assertEqual(pool._pending[('chromium', True)], 0)
+            with mock.patch.object(pool, '_launch', new=mock.AsyncMock(return_value=self.make_browser())):
+                lease = await asyncio.wait_for(pool.acquire('chromium'), 1)
+            self.assertEqual(lease.pooled_browser.active_contexts, 1)
+
+        asyncio.run(scenario())
+
+
+@override_settings(ADMISSION_SETTINGS={'INTERACTIVE_RESERVED': 1, 'MAX_QUEUE': 10, 'QUEUE_TIMEOUT': 5})
+class AdmissionBackgroundTests(SimpleTestCase):
+    """Los trabajos de lote ceden el paso a las sesiones interactivas"""
+
+    def test_background_jobs_leave_room_for_interactive_sessions(self):
+        async def scenario():
+            controller = AdmissionController(max_sessions=3)
+            controller._ensure_monitor = lambda: None
+            reclaim = mock.AsyncMock()
+            first = await controller.acquire('lote-1', reclaim, background=True)
+            second = await controller.acquire('lote-2', reclaim, background=True)
+            # El tercer trabajo espera: el último hueco está reservado
+            third = asyncio.create_task(controller.acquire('lote-3', reclaim, background=True))
+            await asyncio.sleep(0)
+            self.assertFalse(third.done())
+            interactive = await controller.acquire('sesion-1', reclaim)
+            self.assertEqual(controller.stats()['background'], 2)
+
+            # Con una sesión interactiva esperando, el hueco liberado es para ella
+            waiting = asyncio.create_task(controller.acquire('sesion-2', reclaim))
+            await asyncio.sleep(0)
+            controller.release(first)
+            self.assertEqual((await waiting).session_id, 'sesion-2')
+            self.assertFalse(third.done())
+
+            controller.release(interactive)
+            await asyncio.sleep(0)
+            self.assertEqual((await third).session_id, 'lote-3')
+            self.assertTrue(third.result().background)
+            self.assertEqual(controller.stats()['background_queued'], 0)
+            for budget in (second, third.result()):
+                controller.release(budget)
+
+        asyncio.run(scenario())
+
+
+class BatchFinishJobTests(TransactionTestCase):
+    """Cerrar un trabajo guarda capturas y estado; el reporte va a la cola de reportes"""
+
+    def test_report_is_enqueued_not_built(self):
+        runner = BatchRunner([{'event': 'page_view'}], pool=mock.Mock(), batch_id='abc')
+        session = Session.objects.create(url='https://tienda.example/', json_file='uploads/json/lote_abc.json',
+                                         description='Lote abc · portada', status='active')
+        capture = runner.build_capture(session, {'data': {'event': 'page_view'}, 'index': 0}, session.url)
+
+        async def scenario():
+            with mock.patch('core.batch.enqueue_report_job', new=mock.AsyncMock(return_value=None)) as enqueue:
+                await runner.finish_job(session, [capture], None)
+                job_id = await runner.enqueue_report(session)
+            return enqueue, job_id
+
+        enqueue, job_id = asyncio.run(scenario())
+        session.refresh_from_db()
+        self.assertEqual(session.status, 'completed')
+        self.assertEqual(DataLayerCapture.objects.filter(session=session, is_valid=True).count(), 1)
+        self.assertFalse(Report.objects.filter(session=session).exists())
+        job = enqueue.await_args.args[0]
+        self.assertEqual((job['job_id'], job['session_id']), (job_id, str(session.id)))
+        self.assertEqual(job['options']['title'], 'Lote abc · portada')
+        self.assertEqual(job['reference_events_count'], 1)
+
+
+@override_settings(PLAYWRIGHT_SETTINGS={**settings.PLAYWRIGHT_SETTINGS, 'DEFAULT_BROWSER': 'chromium'})
+class BrowserPoolMaintenanceTests(SimpleTestCase):
+    """El mantenimiento solo repone el mínimo del navegador por defecto"""
+
+    def make_browser(self, browser_type, headless, idle_for=0):
+        browser = mock.Mock(is_connected=mock.Mock(return_value=True), close=mock.AsyncMock())
+        pooled = PooledBrowser(browser, browser_type, headless)
+        pooled.last_used -= idle_for
+        return pooled
+
+    def test_idle_headful_browsers_age_out_and_release_the_display(self):
+        pool = BrowserPool(min_size=1, max_size=2, idle_timeout=60, headless=True, name='test')
+        headful = self.make_browser('chromium', False, idle_for=120)
+        firefox = self.make_browser('firefox', True, idle_for=120)
+        default = self.make_browser('chromium', True, idle_for=120)
+        pool._browsers = {('chromium', False): [headful], ('firefox', True): [firefox], ('chromium', True): [default]}
+        pool._uses_display = True
+
+        async def scenario():
+            with mock.patch('core.browser_pool.virtual_display.stop', new=mock.AsyncMock()) as stop_display, \
+                    mock.patch('core.browser_pool.reset_pool_gauges') as reset_gauges, \
+                    mock.patch.object(pool, '_launch', new=mock.AsyncMock()) as launch:
+                await pool._maintain()
+            return stop_display, reset_gauges, launch
+
+        stop_display, reset_gauges, launch = asyncio.run(scenario())
+        # El navegador por defecto se conserva aunque esté inactivo; el resto se cierra y su clave desaparece
+        self.assertEqual(pool._browsers, {('chromium', True): [default]})
+        headful.browser.close.assert_awaited_once()
+        firefox.browser.close.assert_awaited_once()
+        default.browser.close.assert_not_awaited()
+        launch.assert_not_awaited()
+        reset_gauges.assert_has_calls([mock.call('test', 'chromium', False), mock.call('test', 'firefox', True)], any_order=True)
+        stop_display.assert_awaited_once()
+
+    def test_refills_only_the_default_key(self):
+        pool = BrowserPool(min_size=1, max_size=2, idle_timeout=60, headless=True, name='test')
+        busy = self.make_browser('chromium', False)
+        busy.active_contexts = 1
+        pool._browsers = {('chromium', False): [busy], ('chromium', True): []}
+        pool._playwright = mock.Mock()
+        launched = self.make_browser('chromium', True)
+
+        async def scenario():
+            with mock.patch.object(pool, '_launch', new=mock.AsyncMock(return_value=launched)) as launch:
+                await pool._maintain()
+            return launch
+
+        launch = asyncio.run(scenario())
+        launch.assert_awaited_once_with('chromium', True)
+        self.assertEqual(pool._browsers, {('chromium', False): [busy], ('chromium', True): [launched]})
+
+
+class NavigationErrorTests(SimpleTestCase):
+    """Solo los errores de documento descargado cuentan como navegación"""
+
+    def test_is_navigation_error(self):
+        self.assertTrue(is_navigation_error(Exception('page.evaluate: Execution context was destroyed, most likely because of a navigation')))
+        self.assertTrue(is_navigation_error(Exception('page.evaluate: Target page, context or browser has been closed')))
+        self.assertTrue(is_navigation_error(Exception('frame.evaluate: Frame was detached')))
+        self.assertFalse(is_navigation_error(Exception("page.evaluate: TypeError: Cannot read properties of undefined (reading 'navigation')")))
+        self.assertFalse(is_navigation_error(Exception('page.evaluate: Timeout 30000ms exceeded while waiting for navigation')))
+
+
+class MacroTests(SimpleTestCase):
+    """Validación de macros y comprobación de pushes"""
+
+    def test_parse_macro_validates_steps(self):
+        with self.assertRaises(MacroError):
+            parse_macro([])
+        with self.assertRaises(MacroError):
+            parse_macro([{'action': 'wait'}] * 3, max_steps=2)
+        with self.assertRaises(MacroError):
+            parse_macro([{'action': 'scroll'}])
+        with self.assertRaises(MacroError):
+            parse_macro([{'action': 'click', 'x': 0.5}])
+        with self.assertRaises(MacroError):
+            parse_macro([{'action': 'assert_datalayer', 'match': ['ecommerce']}])
+        with self.assertRaises(MacroError):
+            parse_macro([{'action': 'wait', 'ms': '500'}])
+        with self.assertRaises(MacroError):
+            parse_macro([{'action': 'wait', 'ms': -1}])
+
+    def test_parse_macro_clamps_waits_and_timeouts(self):
+        steps = [
+            {'action': 'wait', 'ms': 10 ** 9},
+            {'action': 'click', 'selector': '#comprar', 'timeout': 10 ** 9},
+            {'action': 'wait_for_event', 'event': 'purchase', 'timeout': 5000},
+        ]
+        parsed = parse_macro(steps, max_wait_ms=1000, max_timeout_ms=20000)
+        self.assertEqual(parsed[0]['ms'], 1000)
+        self.assertEqual(parsed[1]['timeout'], 20000)
+        self.assertEqual(parsed[2]['timeout'], 5000)
+        self.assertEqual(steps[0]['ms'], 10 ** 9) # No modifica el mensaje original
+
+    def test_get_path(self):
+        entry = {'ecommerce': {'items': [{'id': 'SKU1'}], 'currency': 'EUR'}}
+        self.assertEqual(get_path(entry, 'ecommerce.currency'), 'EUR')
+        self.assertEqual(get_path(entry, 'ecommerce.items.0.id'), 'SKU1')
+        self.assertIs(get_path(entry, 'ecommerce.items.1.id'), _MISSING) # Ausente no es lo mismo que None
+        self.assertIs(get_path(entry, 'ecommerce.currency.code'), _MISSING)
+        self.assertEqual(get_path({'a': None}, 'a'), None)
+
+    def test_push_matches(self):
+        push = {'data': {'event': 'purchase', 'ecommerce': {'currency': 'EUR', 'value': None}}, 'valid': True}
+        self.assertTrue(push_matches(push, {'event': 'purchase'}))
+        self.assertTrue(push_matches(push, {'match': {'ecommerce.currency': 'EUR'}, 'valid': True}))
+        self.assertTrue(push_matches(push, {'match': {'ecommerce.value': None}}))
+        self.assertFalse(push_matches(push, {'match': {'ecommerce.tax': None}}))
+        self.assertFalse(push_matches(push, {'event': 'add_to_cart'}))
+        self.assertFalse(push_matches(push, {'event': 'purchase', 'valid': False}))
+        self.assertFalse(push_matches({'data': ['no', 'es', 'un', 'objeto'], 'valid': None}, {'event': 'purchase'}))
+
+
+class ReferenceIndexTests(SimpleTestCase):
+    """Compilación de la referencia y validación de pushes contra ella"""
+
+    REFERENCE = [
+        {'event': 'GAEvent', 'event_category': 'cta', 'event_action': 'click', 'event_label': '{{label}}', 'user_type': None},
+        {'event': 'GAEvent', 'event_category': 'menu', 'event_action': 'open', 'event_label': ''},
+        {'event': 'purchase', 'value': 10},
+        'no es un evento',
+        {'event': ['nombre', 'no', 'valido']},
+    ]
+
+    def test_spec_separates_constants_and_placeholders(self):
+        spec = ReferenceSpec(self.REFERENCE[0])
+        self.assertEqual(spec.event, 'GAEvent')
+        self.assertEqual(spec.required_keys, ['event_category', 'event_action', 'event_label'])
+        self.assertEqual(spec.constants, {'event_category': 'cta', 'event_action': 'click'})
+        self.assertEqual(spec.placeholders, {'event_label'})
+
+    def test_spec_mismatches(self):
+        spec = ReferenceSpec(self.REFERENCE[0])
+        self.assertEqual(spec.mismatches({'event_category': 'cta', 'event_action': 'click', 'event_label': 'Comprar'}, 'GAEvent'), [])
+        errors = spec.mismatches({'event_category': 'cta', 'event_action': 'hover'}, 'GAEvent')
+        self.assertEqual(len(errors), 2)
+        self.assertIn("'event_action' no coincide", errors[0])
+        self.assertIn("'event_label' falta", errors[1])
+        # Las constantes se comparan como texto
+        self.assertEqual(ReferenceSpec({'event': 'purchase', 'value': 10}).mismatches({'value': '10'}, 'purchase'), [])
+
+    def test_index_skips_invalid_entries(self):
+        index = ReferenceIndex(self.REFERENCE)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.event_names(), ['GAEvent', 'purchase'])
+        self.assertEqual(len(index.candidates('GAEvent')), 2)
+        self.assertEqual(index.candidates(['no', 'hashable']), [])
+        self.assertFalse(ReferenceIndex([]))
+
+    def test_match_tries_every_candidate(self):
+        index = ReferenceIndex(self.REFERENCE)
+        found, reference, errors = index.match({'event': 'GAEvent', 'event_category': 'menu', 'event_action': 'open'})
+        self.assertTrue(found)
+        self.assertIs(reference, self.REFERENCE[1])
+        self.assertEqual(errors, [])
+        found, reference, errors = index.match({'event': 'GAEvent', 'event_category': 'footer', 'event_action': 'open'})
+        self.assertEqual((found, reference), (True, None))
+        self.assertEqual(len(errors), 4) # Errores de los dos candidatos
+        self.assertEqual(index.match({'event': 'desconocido'}), (False, None, []))
+
+    def test_validate_uses_last_explicit_event(self):
+        index = ReferenceIndex(self.REFERENCE)
+        self.assertEqual(index.validate([{'event': 'purchase', 'value': 10}, {'ecommerce': {}}]), {'valid': True, 'errors': []})
+        self.assertFalse(index.validate([{'event': 'purchase', 'value': 11}])['valid'])
+        unknown = index.validate([{'event': 'add_to_cart'}])
+        self.assertFalse(unknown['valid'])
+        self.assertIn("'add_to_cart'", unknown['errors'][0])
+        self.assertIsNone(index.validate([{'ecommerce': {}}])['valid'])
+        self.assertFalse(index.validate([])['valid'])
+
+
+class CaptureOrderTests(TestCase):
+    """Orden de las capturas por secuencia y reconstrucción de snapshots"""
+
+    def setUp(self):
+        self.session = Session.objects.create(url='https://tienda.example/', json_file='uploads/json/referencia.json')
+        now = timezone.now()
+        # created_at desordenado a propósito: el orden lo marca sequence
+        rows = [
+            (1, 0, [{'event': 'page_view'}, {'event': 'view_item'}], now),
+            (2, 2, [{'event': 'add_to_cart'}], now - timedelta(seconds=5)),
+            (3, 0, [{'event': 'page_view'}], now - timedelta(seconds=10)),
+            (4, 1, [{'event': 'purchase'}], now - timedelta(seconds=10)),
+        ]
+        self.captures = [
+            DataLayerCapture.objects.create(session=self.session, url='https://tienda.example/', sequence=sequence,
+                                            offset=offset, data=data, created_at=created_at)
+            for sequence, offset, data, created_at in rows
+        ]
+
+    def test_snapshot_resets_after_navigation(self):
+        def events(capture):
+            return [entry['event'] for entry in capture.snapshot()]
+
+        self.assertEqual(events(self.captures[1]), ['page_view', 'view_item', 'add_to_cart'])
+        self.assertEqual(events(self.captures[2]), ['page_view'])
+        self.assertEqual(events(self.captures[3]), ['page_view', 'purchase'])
+
+    def test_iter_entries_follows_sequence(self):
+        entries = [(capture.sequence, index, entry['event'])
+                   for capture, index, entry in self.session.datalayers.all().iter_entries()]
+        self.assertEqual(entries, [(1, 0, 'page_view'), (1, 1, 'view_item'), (2, 2, 'add_to_cart'),
+                                   (3, 0, 'page_view'), (4, 1, 'purchase')])
+
+    def test_same_created_at_falls_back_to_offset(self):
+        session = Session.objects.create(url='https://tienda.example/', json_file='uploads/json/referencia.json')
+        now = timezone.now()
+        for offset in (3, 0, 1):
+            DataLayerCapture.objects.create(session=session, url='https://tienda.example/', offset=offset,
+                                            data=[{'event': f'e{offset}'}], created_at=now)
+        self.assertEqual([capture.offset for capture in session.datalayers.in_capture_order()], [0, 1, 3])
+
+
+class CaptureMigrationTests(TransactionTestCase):
+    """Migraciones de datos de las capturas (compactación 0005 y secuencia 0009)"""
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([('core', target)])
+        return executor.loader.project_state([('core', target)]).apps
+
+    def tearDown(self):
+        self.migrate('0009_datalayercapture_sequence')
+
+    def create_session(self, apps):
+        return apps.get_model('core', 'Session').objects.create(url='https://tienda.example/', json_file='uploads/json/referencia.json')
+
+    def test_0005_compacts_cumulative_captures(self):
+        apps = self.migrate('0004_screenshot')
+        Capture = apps.get_model('core', 'DataLayerCapture')
+        session = self.create_session(apps)
+        now = timezone.now()
+        for seconds, data in enumerate([[{'a': 1}], [{'a': 1}, {'b': 2}], [{'c': 3}], [{'c': 3}, {'d': 4}]]):
+            capture = Capture.objects.create(session=session, url='https://tienda.example/', data=data)
+            Capture.objects.filter(pk=capture.pk).update(created_at=now + timedelta(seconds=seconds))
+
+        apps = self.migrate('0005_datalayercapture_offset')
+        Capture = apps.get_model('core', 'DataLayerCapture')
+        rows = list(Capture.objects.order_by('created_at').values_list('offset', 'data'))
+        self.assertEqual(rows, [(0, [{'a': 1}]), (1, [{'b': 2}]), (0, [{'c': 3}]), (1, [{'d': 4}])])
+
+    def test_0009_numbers_existing_captures(self):
+        apps = self.migrate('0008_session_resource_rules')
+        Capture = apps.get_model('core', 'DataLayerCapture')
+        sessions = [self.create_session(apps), self.create_session(apps)]
+        now = timezone.now()
+        for session in sessions:
+            for seconds, offset in ((1, 1), (0, 0), (1, 0)):
+                capture = Capture.objects.create(session=session, url='https://tienda.example/', offset=offset, data=[])
+                Capture.objects.filter(pk=capture.pk).update(created_at=now + timedelta(seconds=seconds))
+
+        apps = self.migrate('0009_datalayercapture_sequence')
+        Capture = apps.get_model('core', 'DataLayerCapture')
+        for session in sessions:
+            rows = list(Capture.objects.filter(session_id=session.pk).order_by('sequence').values_list('sequence', 'offset'))
+            self.assertEqual(rows, [(1, 0), (2, 0), (3, 1)])
+
+
+class ReportStreamTests(TestCase):
+    """Artefacto JSON del reporte: contenido, hash y lectura incremental"""
+
+    def setUp(self):
+        self.session = Session.objects.create(url='https://tienda.example/', json_file='uploads/json/referencia.json')
+        for sequence, (is_valid, data) in enumerate([(True, [{'event': 'page_view'}]), (False, [{'event': 'purchase', 'value': 1.5}]),
+                                                     (None, [{'event': 'ñandú', 'items': []}])], start=1):
+            DataLayerCapture.objects.create(session=self.session, url='https://tienda.example/', sequence=sequence,
+                                            offset=sequence - 1, is_valid=is_valid, errors=[] if is_valid else ['error'], data=data)
+
+    def write(self, **options):
+        stream = ReportStream(self.session, options)
+        buffer = io.BytesIO()
+        stream.write(buffer)
+        return stream, buffer.getvalue()
+
+    def test_artifact_is_valid_json_with_summary_and_index(self):
+        stream, content = self.write(include_screenshots=False)
+        artifact = json.loads(content.decode('utf-8'))
+        self.assertEqual([detail['data'][0]['event'] for detail in artifact['details']], ['page_view', 'purchase', 'ñandú'])
+        self.assertEqual(artifact['screenshots'], [])
+        self.assertEqual(artifact['summary'], stream.summary)
+        self.assertEqual((stream.summary['valid_count'], stream.summary['invalid_count']), (1, 1))
+        self.assertEqual(stream.index['invalid_details'], [1])
+        self.assertEqual(stream.index['events']['purchase'], {'total': 1, 'valid': 0, 'invalid': 1})
+
+    def test_content_hash_is_sha256_of_artifact(self):
+        stream, content = self.write()
+        self.assertEqual(stream.content_hash, hashlib.sha256(content).hexdigest())
+        self.assertEqual(stream.report_data()['content_hash'], stream.content_hash)
+
+    def test_iter_artifact_round_trip(self):
+        stream, content = self.write()
+        expected = [('details', detail) for detail in json.loads(content.decode('utf-8'))['details']]
+        # Bloques pequeños para partir cadenas, números y caracteres multibyte entre lecturas
+        for chunk_size in (1, 7, 64 * 1024):
+            self.assertEqual(list(iter_artifact(io.BytesIO(content), chunk_size=chunk_size)), expected)
+
+    def test_iter_artifact_rejects_truncated_file(self):
+        stream, content = self.write()
+        with self.assertRaises(ValueError):
+            list(iter_artifact(io.BytesIO(content[:len(content) // 2])))
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ReportJobTests(TransactionTestCase):
+    """Trabajo de reporte en un hilo local: mensajes de progreso y resultado"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root, REPORT_SETTINGS={**settings.REPORT_SETTINGS, 'USE_WORKER': False})
+        media.enable()
+        self.addCleanup(media.disable)
+        self.session = Session.objects.create(url='https://tienda.example/', json_file='uploads/json/referencia.json')
+        for sequence in range(1, 4):
+            DataLayerCapture.objects.create(session=self.session, url='https://tienda.example/', sequence=sequence,
+                                            offset=sequence - 1, is_valid=True, data=[{'event': f'e{sequence}'}])
+
+    def run_job(self, session_id):
+        async def scenario():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add(f'session_{session_id}', channel)
+            task = await enqueue_report_job(new_report_job(session_id, {'title': 'Reporte de prueba'}))
+            messages = []
+            while not messages or messages[-1]['status'] not in ('generated', 'error'):
+                messages.append(await asyncio.wait_for(layer.receive(channel), timeout=5))
+            return await task, messages
+
+        return asyncio.run(scenario())
+
+    def test_local_job_reports_progress_and_result(self):
+        with mock.patch('core.report_stream.CHUNK_SIZE', 1):
+            report, messages = self.run_job(self.session.id)
+        statuses = [message['status'] for message in messages]
+        self.assertEqual(statuses[0], 'started')
+        self.assertEqual(statuses[-1], 'generated')
+        self.assertEqual([(m['processed'], m['total']) for m in messages if m['status'] == 'progress'], [(1, 3), (2, 3), (3, 3)])
+        self.assertEqual(len({message['job_id'] for message in messages}), 1)
+
+        self.assertEqual(messages[-1]['report_id'], str(report.id))
+        report.refresh_from_db()
+        self.assertEqual(messages[-1]['report_url'], f'/report/{report.id}/')
+        self.assertEqual((report.title, report.is_valid), ('Reporte de prueba', True))
+        self.assertEqual(report.data['summary']['total_datalayers_captured'], 3)
+        with report.json_file.open('rb') as fileobj:
+            self.assertEqual(hashlib.sha256(fileobj.read()).hexdigest(), report.data['content_hash'])
+
+    def test_local_job_reports_errors(self):
+        report, messages = self.run_job(uuid.uuid4())
+        self.assertIsNone(report)
+        self.assertEqual([message['status'] for message in messages], ['error'])
+        self.assertFalse(Report.objects.exists())
+
+
+class ExportTests(TestCase):
+    """Aplanado de eventos y exportación CSV/NDJSON de las capturas"""
+
+    def setUp(self):
+        self.session = Session.objects.create(url='https://tienda.example/', json_file='uploads/json/referencia.json')
+        DataLayerCapture.objects.create(session=self.session, url='https://tienda.example/', offset=0, is_valid=True,
+                                        data=[{'event': 'page_view'}, {'event': 'purchase', 'ecommerce': {'value': 10, 'items': [{'id': 'A'}]}}])
+        DataLayerCapture.objects.create(session=self.session, url='https://tienda.example/gracias', offset=2, is_valid=False,
+                                        errors=['falta currency'], data=[{'event': 'purchase', 'ecommerce': {'currency': 'EUR'}}])
+
+    def read_csv(self, format_type, **filters):
+        content = b''.join(export_stream(filter_captures(self.session, **filters), format_type))
+        if format_type.endswith('.gz'):
+            content = gzip.decompress(content)
+        return list(csv.DictReader(io.StringIO(content.decode('utf-8'))))
+
+    def test_flatten(self):
+        self.assertEqual(flatten({'event': 'purchase', 'ecommerce': {'value': 10, 'items': [{'id': 'A'}], 'tax': {}}}),
+                         {'event': 'purchase', 'ecommerce.value': 10, 'ecommerce.items': [{'id': 'A'}]})
+        self.assertEqual(flatten('texto'), {'value': 'texto'})
+
+    def test_csv_has_one_row_per_entry_with_flattened_columns(self):
+        rows = self.read_csv('csv')
+        self.assertEqual(list(rows[0])[6:], ['event', 'ecommerce.currency', 'ecommerce.items', 'ecommerce.value'])
+        self.assertEqual([(row['index'], row['event']) for row in rows], [('0', 'page_view'), ('1', 'purchase'), ('2', 'purchase')])
+        self.assertEqual(rows[1]['ecommerce.value'], '10')
+        self.assertEqual(json.loads(rows[1]['ecommerce.items']), [{'id': 'A'}])
+        self.assertEqual((rows[2]['ecommerce.currency'], rows[2]['is_valid'], rows[2]['errors']), ('EUR', 'False', 'falta currency'))
+        self.assertEqual(rows[0]['ecommerce.value'], '')
+
+    def test_filters_and_gzip(self):
+        rows = self.read_csv('csv.gz', is_valid='false')
+        self.assertEqual([row['url'] for row in rows], ['https://tienda.example/gracias'])
+        lines = b''.join(export_stream(filter_captures(self.session), 'ndjson', event='page_view')).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['data'][0], {'event': 'page_view'})
+
+
+class ExportAsgiTests(TransactionTestCase):
+    """Bajo ASGI la exportación se envía por bloques mientras se genera"""
+
+    def setUp(self):
+        self.session = Session.objects.create(url='https://tienda.example/', json_file='uploads/json/referencia.json')
+
+    def request(self, path, on_body=None):
+        """GET por la aplicación ASGI de Django; devuelve los mensajes enviados"""
+        async def scenario():
+            messages = []
+            request_sent = False
+
+            async def receive():
+                nonlocal request_sent
+                if not request_sent:
+                    request_sent = True
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+                await asyncio.Event().wait() # El cliente nunca se desconecta
+
+            async def send(message):
+                messages.append(message)
+                if message['type'] == 'http.response.body' and message.get('body') and on_body:
+                    on_body(message)
+
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+                'headers': [(b'host', b'testserver')], 'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+            }
+            await asyncio.wait_for(get_asgi_application()(scope, receive, send), 10)
+            return messages
+        return asyncio.run(scenario())
+
+    def test_first_chunk_is_sent_before_the_export_finishes(self):
+        gate = threading.Event()
+        resumed = []
+
+        def slow_export(captures, format_type, event=None):
+            yield b'primero\n'
+            resumed.append(gate.wait(5)) # Solo se abre cuando el cliente ha recibido el primer bloque
+            yield b'segundo\n'
+
+        with mock.patch('core.views.export_stream', new=slow_export):
+            messages = self.request(f'/session/{self.session.id}/export/csv/', on_body=lambda message: gate.set())
+        self.assertEqual(resumed, [True])
+        bodies = [m['body'] for m in messages if m['type'] == 'http.response.body' and m.get('body')]
+        self.assertEqual(bodies, [b'primero\n', b'segundo\n'])
+
+    def test_csv_export_over_asgi(self):
+        for offset in range(3):
+            DataLayerCapture.objects.create(session=self.session, url='https://tienda.example/', offset=offset,
+                                            data=[{'event': f'evento_{offset}'}])
+        with mock.patch('core.exports.FLUSH_BYTES', 1): # Un bloque por fila
+            messages = self.request(f'/session/{self.session.id}/export/csv/')
+        self.assertEqual(messages[0]['status'], 200)
+        bodies = [m['body'] for m in messages if m['type'] == 'http.response.body' and m.get('body')]
+        self.assertEqual(len(bodies), 4)
+        rows = list(csv.DictReader(io.StringIO(b''.join(bodies).decode('utf-8'))))
+        self.assertEqual([row['event'] for row in rows], ['evento_0', 'evento_1', 'evento_2'])
+
+
+class ReportDownloadTests(TestCase):
+    """Formatos de descarga, caché por hash de contenido y respuestas 304"""
+
+    DATA = {
+        'summary': {'url': 'https://tienda.example/', 'is_valid_overall': False, 'total_captures': 1},
+        'details': [{'index': 0, 'timestamp': '2024-01-01T00:00:00', 'url': 'https://tienda.example/', 'is_valid': False,
+                     'errors': ["Propiedad 'value' no coincide"], 'offset': 0, 'data': [{'event': 'purchase', 'value': 11}]}],
+        'screenshots': [],
+    }
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root, REPORT_SETTINGS={**settings.REPORT_SETTINGS, 'CACHE_DIR': ''})
+        media.enable()
+        self.addCleanup(media.disable)
+        self.session = Session.objects.create(url='https://tienda.example/', json_file='uploads/json/referencia.json')
+        self.report = Report.objects.create(session=self.session, title='Reporte de prueba', data=json.loads(json.dumps(self.DATA)))
+
+    def download(self, format_type, **headers):
+        return self.client.get(f'/report/{self.report.id}/download/{format_type}/', **headers)
+
+    def test_formats(self):
+        html = self.download('html')
+        self.assertEqual(html['Content-Type'], 'text/html; charset=utf-8')
+        self.assertIn('Reporte de prueba', b''.join(html.streaming_content).decode('utf-8'))
+        data = json.loads(b''.join(self.download('json').streaming_content))
+        self.assertEqual(data['details'], self.DATA['details'])
+        self.assertEqual(data['summary'], self.DATA['summary'])
+        rows = list(csv.DictReader(io.StringIO(b''.join(self.download('csv').streaming_content).decode('utf-8'))))
+        self.assertEqual([(row['event'], row['is_valid']) for row in rows], [('purchase', 'False')])
+        pdf = self.download('pdf')
+        try:
+            import matplotlib # noqa: F401
+        except ImportError:
+            self.assertEqual(pdf.status_code, 501)
+        else:
+            self.assertTrue(b''.join(pdf.streaming_content).startswith(b'%PDF'))
+        self.assertEqual(self.download('docx').status_code, 404)
+
+    def test_cache_key_follows_content(self):
+        twin = Report.objects.create(session=self.session, title='Otro título', data=json.loads(json.dumps(self.DATA)))
+        other = Report.objects.create(session=self.session, title='Distinto', data=dict(self.DATA, details=[]))
+        self.assertEqual(artifact_key(self.report, 'html'), artifact_key(twin, 'html'))
+        self.assertNotEqual(artifact_key(self.report, 'html'), artifact_key(other, 'html'))
+        self.assertNotEqual(artifact_key(self.report, 'html'), artifact_key(self.report, 'csv'))
+        self.report.refresh_from_db()
+        self.assertIn('content_hash', self.report.data) # Se calcula una vez y se guarda
+        key = artifact_key(self.report, 'html')
+        with mock.patch('core.report_cache.RENDERER_VERSION', 99): # Un renderizador nuevo invalida lo cacheado
+            self.assertNotEqual(artifact_key(self.report, 'html'), key)
+
+    def test_conditional_requests(self):
+        first = self.download('csv')
+        self.assertEqual(first.status_code, 200)
+        etag, last_modified = first['ETag'], first['Last-Modified']
+        self.assertEqual(self.download('csv', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.download('csv', HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertEqual(self.download('csv', HTTP_IF_MODIFIED_SINCE='Mon, 01 Jan 2001 00:00:00 GMT').status_code, 200)
+        self.assertEqual(self.download('csv', HTTP_IF_NONE_MATCH='"otro"').status_code, 200)
+
+    def test_rendered_artifact_is_reused(self):
+        with open_report_artifact(self.report, 'html') as artifact:
+            path = artifact.name
+        os.utime(path, (1, 1))
+        with mock.patch('core.report_cache.render_artifact') as render:
+            with open_report_artifact(self.report, 'html') as artifact:
+                self.assertEqual(artifact.name, path)
+        render.assert_not_called()
+        self.assertGreater(os.stat(path).st_mtime, 1) # El acierto renueva la marca del LRU
+
+    def test_lru_eviction(self):
+        cache_dir = get_cache_dir()
+        cache_dir.mkdir(parents=True)
+        paths = []
+        for age, name in enumerate(['nuevo.html', 'medio.csv', 'viejo.pdf']):
+            path = cache_dir / name
+            path.write_bytes(b'x' * 100)
+            os.utime(path, (1000 - age * 100, 1000 - age * 100))
+            paths.append(path)
+        (cache_dir / 'a_medias.tmp').write_bytes(b'x' * 1000) # Renderizado en curso: no cuenta ni se borra
+        evict(200, keep=paths[2])
+        self.assertEqual(sorted(path.name for path in cache_dir.iterdir()), ['a_medias.tmp', 'nuevo.html', 'viejo.pdf'])
+        evict(0)
+        self.assertEqual([path.name for path in cache_dir.iterdir()], ['a_medias.tmp'])
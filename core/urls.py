@@ -14,9 +14,18 @@ urlpatterns = [
     # Acciones
     path('report/<uuid:report_id>/download/<str:format_type>/',
          views.download_report, name='download_report'),
+    path('session/<uuid:session_id>/export/<str:format_type>/',
+         views.export_session, name='export_session'),
     path('report/<uuid:report_id>/share/',
          views.share_report, name='share_report'),
 
+    # API de validación por lotes (headless)
+    path('api/batch/', views.batch_create, name='batch_create'),
+    path('api/batch/<str:batch_id>/', views.batch_status, name='batch_status'),
+
+    # Métricas Prometheus
+    path('metrics', views.metrics, name='metrics'),
+
     # Utilidades
     path('placeholder-image/', views.placeholder_image, name='placeholder_image'),
 ]
@@ -1,10 +1,15 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, JsonResponse, FileResponse, Http404
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse, FileResponse, StreamingHttpResponse, Http404
 from django.contrib import messages
 from django.core.paginator import Paginator
 from django.views.decorators.http import require_POST
+from django.urls import reverse
 from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 
+import hmac
 import os
 import json
 import uuid
@@ -12,6 +17,11 @@ from datetime import datetime
 
 from .models import Session, Screenshot, DataLayerCapture, Report
 from .forms import SessionForm
+from .report_cache import artifact_key, open_report_artifact
+from .exports import EXPORT_FORMATS, aiter_chunks, filter_captures, export_stream, export_content_type
+from .batch import BatchRunner, parse_jobs, start_batch, get_batch_status, get_batch_settings
+from . import metrics as prometheus_metrics
+from validator.reporter import FORMATS as REPORT_FORMATS, CONTENT_TYPES as REPORT_CONTENT_TYPES, ReportRenderError
 
 
 def home(request):
@@ -122,27 +132,126 @@ def reports_list(request):
 
 
 def download_report(request, report_id, format_type):
-    """Descarga un reporte en el formato especificado"""
+    """Descarga un reporte en el formato especificado (generado y cacheado en la primera descarga)"""
     report = get_object_or_404(Report, id=report_id)
-
-    if format_type == 'html' and report.html_file:
-        return FileResponse(report.html_file, as_attachment=True, filename=f"reporte_{report_id}.html")
-    elif format_type == 'pdf' and report.pdf_file:
-        return FileResponse(report.pdf_file, as_attachment=True, filename=f"reporte_{report_id}.pdf")
-    elif format_type == 'json' and report.json_file:
-        return FileResponse(report.json_file, as_attachment=True, filename=f"reporte_{report_id}.json")
-    elif format_type == 'csv' and report.csv_file:
-        return FileResponse(report.csv_file, as_attachment=True, filename=f"reporte_{report_id}.csv")
-    else:
-        # Si el archivo no existe, generarlo al vuelo
-        from validator.reporter.report_generator import ReportGenerator
-
-        # Código para generar reporte al vuelo
-        # En una implementación real, esto se haría de manera más completa
-
-        # Por ahora, devolver un error 404
+    if format_type not in REPORT_FORMATS:
         raise Http404(f"Reporte en formato {format_type} no disponible")
 
+    # El contenido de un reporte no cambia: ETag por contenido y formato
+    etag = f'"{artifact_key(report, format_type)}"'
+    last_modified = int(report.created_at.timestamp()) # Segundos enteros, como la cabecera If-Modified-Since
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return response
+
+    try:
+        artifact = open_report_artifact(report, format_type)
+    except ReportRenderError as e:
+        return HttpResponse(str(e), status=501, content_type='text/plain; charset=utf-8')
+
+    response = FileResponse(
+        artifact,
+        as_attachment=True,
+        filename=f"reporte_{report_id}.{format_type}",
+        content_type=REPORT_CONTENT_TYPES[format_type]
+    )
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'private, no-cache' # Revalidar siempre: la respuesta 304 no cuesta nada
+    return response
+
+
+def export_session(request, session_id, format_type):
+    """
+    Exporta en streaming las capturas de DataLayer de una sesión.
+    Filtros opcionales: ?is_valid=true|false|none, ?event=<nombre>, ?url=<texto>
+    """
+    session = get_object_or_404(Session, id=session_id)
+    if format_type not in EXPORT_FORMATS:
+        raise Http404(f"Formato de exportación {format_type} no disponible")
+
+    captures = filter_captures(session, is_valid=request.GET.get('is_valid'), url=request.GET.get('url'))
+    chunks = export_stream(captures, format_type, event=request.GET.get('event') or None)
+    if isinstance(request, ASGIRequest):
+        # Con un iterador síncrono Django ASGI generaría todo el fichero en memoria antes de enviarlo
+        chunks = aiter_chunks(chunks)
+    response = StreamingHttpResponse(chunks, content_type=export_content_type(format_type))
+    response['Content-Disposition'] = f'attachment; filename="capturas_{session_id}.{format_type}"'
+    return response
+
+
+def _batch_api_error(request):
+    """
+    Respuesta de error si la petición no puede usar la API de lotes, o None.
+    Sin ``BATCH_API_TOKEN`` la API queda desactivada: lanza navegadores en el
+    proceso web y no lleva CSRF, así que nunca se abre sin token.
+    """
+    token = get_batch_settings().get('API_TOKEN')
+    if not token:
+        return JsonResponse({'error': 'API de lotes desactivada: define BATCH_API_TOKEN'}, status=403)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return JsonResponse({'error': 'No autorizado'}, status=401)
+    return None
+
+
+async def batch_create(request):
+    """
+    Lanza un lote de validación headless. Cuerpo JSON:
+    {"reference": [...], "jobs": ["https://...", {"url": ..., "steps": [...]}],
+     "browser_type": "chromium", "concurrency": 4, "report": true,
+     "resource_policy": "tags", "resource_rules": {"allow_domains": [...], "block_domains": [...]}}
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    error = _batch_api_error(request)
+    if error:
+        return error
+    try:
+        payload = json.loads(request.body)
+        jobs = parse_jobs(payload.get('jobs'))
+        runner = BatchRunner(
+            payload.get('reference'),
+            browser_type=payload.get('browser_type'),
+            concurrency=payload.get('concurrency'),
+            generate_reports=payload.get('report', True),
+            resource_policy=payload.get('resource_policy'),
+            resource_rules=payload.get('resource_rules'),
+        )
+    except (ValueError, AttributeError) as e: # JSON inválido, BatchError
+        return JsonResponse({'error': str(e)}, status=400)
+
+    reference_bytes = json.dumps(runner.reference, ensure_ascii=False, indent=2).encode('utf-8')
+    sessions, task = await start_batch(runner, jobs, reference_bytes)
+    return JsonResponse({
+        'batch_id': runner.batch_id,
+        'status_url': reverse('batch_status', args=[runner.batch_id]),
+        'sessions': [{'session_id': str(session.id), 'url': session.url} for session in sessions],
+    }, status=202)
+
+# API para scripts: sin CSRF (en Django 4.2 csrf_exempt no admite vistas async)
+batch_create.csrf_exempt = True
+
+
+async def batch_status(request, batch_id):
+    """Estado de un lote lanzado con batch_create"""
+    error = _batch_api_error(request)
+    if error:
+        return error
+    status = await get_batch_status(batch_id)
+    if not status['total']:
+        raise Http404(f"Lote {batch_id} no encontrado")
+    return JsonResponse(status)
+
+
+def metrics(request):
+    """Métricas en formato de exposición de Prometheus (agregadas entre workers)"""
+    if not prometheus_metrics.is_available():
+        return HttpResponse('prometheus_client no está instalado', status=501, content_type='text/plain')
+    token = getattr(settings, 'METRICS_SETTINGS', {}).get('TOKEN')
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse('No autorizado', status=401, content_type='text/plain')
+    return HttpResponse(prometheus_metrics.generate_latest(), content_type=prometheus_metrics.CONTENT_TYPE_LATEST)
+
 
 def share_report(request, report_id):
     """Genera un enlace compartible para el reporte"""
@@ -0,0 +1,215 @@
+# core/workers.py
+"""
+Registro de workers y de propiedad de sesiones en Redis.
+
+En el modo multi-proceso (``manage.py run_workers --workers N``) varios
+procesos Daphne comparten el mismo socket y el kernel reparte las
+conexiones entre ellos, así que un WebSocket puede llegar a un proceso que
+no tiene el navegador de su sesión. Para evitarlo cada sesión tiene un
+dueño, el consumer que lanzó su navegador::
+
+    dlv:session:<id>  -> {"worker": "<worker_id>", "channel": "<channel_name>"}
+
+Un consumer que llega a otro proceso (o una segunda pestaña de la misma
+sesión) no lanza otro navegador: hace de *relay* y reenvía los mensajes del
+cliente al canal del dueño por la capa de Channels; el dueño le devuelve
+todo lo que envía a su propio cliente. El dueño sigue siéndolo aunque su
+socket se caiga, mientras dure el periodo de gracia de
+``core/session_registry.py``. Cuando libera el navegador avisa al grupo
+``session_{id}`` y los relays cierran con ``RELAY_CLOSE_CODE`` para que el
+cliente reconecte y alguien reclame la sesión.
+
+Cada proceso publica además su capacidad (``dlv:worker:<id>``, con TTL y
+renovada cada ``HEARTBEAT_INTERVAL``): sesiones propias, máximo admitido,
+estado de la cola de admisión (``core/admission.py``) y del pool de
+navegadores. Si el worker de un dueño deja de latir, su sesión se puede
+reclamar de nuevo.
+
+Sin Redis (p. ej. ``InMemoryChannelLayer``) el registro queda desactivado y
+cada consumer es dueño de su sesión, como en el modo de un solo proceso.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+
+from django.conf import settings
+
+from .admission import admission
+from .browser_pool import browser_pool
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'dlv'
+RELAY_CLOSE_CODE = 4001 # El dueño de la sesión se fue: el cliente debe reconectar
+
+
+def get_worker_settings():
+    return getattr(settings, 'WORKER_SETTINGS', {})
+
+
+def get_worker_id():
+    """Identificador del proceso: WORKER_ID (lo fija run_workers) o host-pid"""
+    return os.environ.get('WORKER_ID') or f'{socket.gethostname()}-{os.getpid()}'
+
+
+def _session_key(session_id):
+    return f'{KEY_PREFIX}:session:{session_id}'
+
+
+def _worker_key(worker_id):
+    return f'{KEY_PREFIX}:worker:{worker_id}'
+
+
+class WorkerRegistry:
+    """Propiedad de sesiones y capacidad anunciada del proceso actual"""
+
+    def __init__(self, worker_id=None, capacity=None, heartbeat_interval=None):
+        worker_settings = get_worker_settings()
+        self.worker_id = worker_id or get_worker_id()
+        self.capacity = capacity or admission.max_sessions
+        self.heartbeat_interval = heartbeat_interval or worker_settings.get('HEARTBEAT_INTERVAL', 5)
+        self.ttl = self.heartbeat_interval * 3
+        self.owned = {} # session_id -> channel_name de las sesiones propias
+        self._redis = None
+        self._heartbeat_task = None
+        self.enabled = self._redis_configured()
+
+    # --------------------- PROPIEDAD DE SESIONES ---------------------
+
+    async def claim_session(self, session_id, channel_name):
+        """
+        Intenta ser dueño de la sesión. Devuelve ``None`` si el llamador pasa
+        a ser el dueño o el dict ``{'worker', 'channel'}`` del dueño actual.
+        """
+        session_id = str(session_id)
+        # Dueño en este mismo proceso (p. ej. un holder esperando reconexión)
+        local_channel = self.owned.get(session_id)
+        if local_channel and local_channel != channel_name:
+            return {'worker': self.worker_id, 'channel': local_channel}
+        if not self.enabled:
+            self.owned[session_id] = channel_name
+            return None
+
+        owner_value = json.dumps({'worker': self.worker_id, 'channel': channel_name})
+        try:
+            redis = self._get_redis()
+            self._ensure_heartbeat()
+            for _ in range(2):
+                if await redis.set(_session_key(session_id), owner_value, nx=True, ex=self.ttl):
+                    self.owned[session_id] = channel_name
+                    await self.publish()
+                    logger.info(f"Worker {self.worker_id} es dueño de la sesión {session_id}")
+                    return None
+
+                current = await redis.get(_session_key(session_id))
+                if current is None:
+                    continue # Caducó entre el SET y el GET
+                owner = json.loads(current)
+                if owner['worker'] == self.worker_id and owner['channel'] not in self.owned.values():
+                    # Clave de un consumer de este proceso que ya no existe
+                    await redis.delete(_session_key(session_id))
+                    continue
+                if owner['worker'] != self.worker_id and not await redis.exists(_worker_key(owner['worker'])):
+                    logger.warning(f"Worker {owner['worker']} sin latido: se reclama la sesión {session_id}")
+                    await redis.delete(_session_key(session_id))
+                    continue
+                return owner
+        except Exception as e:
+            logger.error(f"Registro de workers no disponible ({e}); la sesión {session_id} se atiende localmente")
+        self.owned[session_id] = channel_name
+        return None
+
+    async def release_session(self, session_id, channel_name):
+        """Libera la sesión si el consumer ``channel_name`` es su dueño"""
+        session_id = str(session_id)
+        if self.owned.get(session_id) != channel_name:
+            return
+        del self.owned[session_id]
+        if not self.enabled:
+            return
+        try:
+            redis = self._get_redis()
+            current = await redis.get(_session_key(session_id))
+            if current and json.loads(current).get('channel') == channel_name:
+                await redis.delete(_session_key(session_id))
+            await self.publish()
+        except Exception as e:
+            logger.error(f"No se pudo liberar la sesión {session_id} en el registro: {e}")
+
+    # --------------------- CAPACIDAD ---------------------
+
+    def load(self):
+        """Capacidad que anuncia este proceso"""
+        return {
+            'worker_id': self.worker_id,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'sessions': len(self.owned),
+            'capacity': self.capacity,
+            'free': max(0, self.capacity - len(admission.active)), # Huecos con navegador libres
+            'admission': admission.stats(),
+            'pool': browser_pool.stats(),
+            'updated_at': time.time(),
+        }
+
+    async def publish(self):
+        """Publica la capacidad y renueva el TTL de las sesiones propias"""
+        redis = self._get_redis()
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.set(_worker_key(self.worker_id), json.dumps(self.load()), ex=self.ttl)
+            for session_id in self.owned:
+                pipe.expire(_session_key(session_id), self.ttl)
+            await pipe.execute()
+
+    async def list_workers(self):
+        """Capacidad anunciada por los workers vivos"""
+        if not self.enabled:
+            return [self.load()]
+        redis = self._get_redis()
+        keys = [key async for key in redis.scan_iter(match=_worker_key('*'))]
+        values = await redis.mget(keys) if keys else []
+        return sorted((json.loads(value) for value in values if value), key=lambda worker: worker['worker_id'])
+
+    async def cluster_capacity(self):
+        """Totales de todos los workers: sesiones, capacidad y huecos libres"""
+        workers = await self.list_workers()
+        return {
+            'workers': len(workers),
+            'sessions': sum(worker['sessions'] for worker in workers),
+            'capacity': sum(worker['capacity'] for worker in workers),
+            'free': sum(worker['free'] for worker in workers),
+        }
+
+    # --------------------- FUNCIONES INTERNAS ---------------------
+
+    @staticmethod
+    def _redis_configured():
+        backend = settings.CHANNEL_LAYERS.get('default', {}).get('BACKEND', '')
+        return 'channels_redis' in backend and get_worker_settings().get('REGISTRY', True)
+
+    def _get_redis(self):
+        if self._redis is None:
+            from redis.asyncio import Redis
+            host, port = settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0]
+            self._redis = Redis(host=host, port=port, decode_responses=True)
+        return self._redis
+
+    def _ensure_heartbeat(self):
+        # La tarea se crea dentro del event loop de Daphne
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def _heartbeat_loop(self):
+        while True:
+            try:
+                await self.publish()
+            except Exception as e:
+                logger.warning(f"Latido del worker {self.worker_id} fallido: {e}")
+            await asyncio.sleep(self.heartbeat_interval)
+
+
+# Registro del proceso (uno por worker Daphne)
+worker_registry = WorkerRegistry()
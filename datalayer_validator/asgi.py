@@ -11,7 +11,7 @@ import os
 import django
 
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ProtocolTypeRouter, URLRouter, ChannelNameRouter
 from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
 
@@ -20,6 +20,7 @@ django.setup()
 
 # Importar las rutas de WebSocket después de configurar Django
 import core.routing
+from core.report_jobs import REPORT_CHANNEL, ReportWorkerConsumer
 
 # Aplicación ASGI con soporte para HTTP y WebSocket
 application = ProtocolTypeRouter({
@@ -31,4 +32,8 @@ application = ProtocolTypeRouter({
             )
         )
     ),
+    # Trabajos en segundo plano (`python manage.py runworker report-worker`)
+    "channel": ChannelNameRouter({
+        REPORT_CHANNEL: ReportWorkerConsumer.as_asgi(),
+    }),
 })
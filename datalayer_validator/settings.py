@@ -86,12 +86,47 @@ ASGI_APPLICATION = 'datalayer_validator.asgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
-# Usando SQLite por defecto para desarrollo
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# PostgreSQL si se define POSTGRES_HOST (o DATABASE_ENGINE=postgresql); SQLite por defecto para desarrollo
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'postgresql' if os.environ.get('POSTGRES_HOST') else 'sqlite')
+
+if DATABASE_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'datalayer_validator'),
+            'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            # Apuntar a PgBouncer (servicio 'pgbouncer') para agrupar conexiones entre workers
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Conexiones persistentes: cada hilo reutiliza la suya en lugar de abrir una por consulta
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'connect_timeout': 5,
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+            'OPTIONS': {
+                'timeout': 20,  # Esperar al bloqueo de escritura en lugar de fallar con 'database is locked'
+            },
+        }
     }
+
+# Escrituras frecuentes del consumer (ver core/db.py): hilos dedicados y acotados.
+# SQLite solo admite un escritor a la vez, así que por defecto usa un único hilo.
+DB_ASYNC_SETTINGS = {
+    'WRITE_WORKERS': int(os.environ.get('DB_WRITE_WORKERS', 4 if DATABASE_ENGINE == 'postgresql' else 1)),
+    # Capturas de DataLayer: bulk_create cada N capturas o cada T ms, lo que ocurra antes
+    'CAPTURE_BATCH_SIZE': int(os.environ.get('CAPTURE_BATCH_SIZE', 50)),
+    'CAPTURE_FLUSH_MS': int(os.environ.get('CAPTURE_FLUSH_MS', 500)),
+    'CAPTURE_FLUSH_RETRIES': int(os.environ.get('CAPTURE_FLUSH_RETRIES', 2)), # Reintentos de un lote antes de darlo por perdido
 }
 
 
@@ -158,16 +193,126 @@ CHANNEL_LAYERS = {
     },
 }
 
-# Configuración de Playwright (headless siempre False)
+# Configuración de Playwright
 PLAYWRIGHT_SETTINGS = {
     'DEFAULT_BROWSER': 'chromium',  # 'chromium', 'firefox' o 'webkit'
-    'HEADLESS': False, # <- CAMBIADO A False
+    # Modo por defecto de las sesiones nuevas (cada sesión puede elegir el suyo)
+    'HEADLESS': os.environ.get('PLAYWRIGHT_HEADLESS', 'False').lower() in ('true', '1', 'yes'),
+    # Todas las sesiones headless aunque pidan ventana (despliegues sin Xvfb)
+    'FORCE_HEADLESS': os.environ.get('PLAYWRIGHT_FORCE_HEADLESS', 'False').lower() in ('true', '1', 'yes'),
+    # Xvfb que se arranca bajo demanda para los navegadores con ventana si no hay DISPLAY
+    'XVFB_SCREEN': os.environ.get('XVFB_SCREEN', '1980x1020x24'),
     'VIEWPORT_SIZE': {
         'width': 1280,
         'height': 720
     },
     'SCREENSHOT_QUALITY': 80,  # Solo para JPEG
     'SCREENSHOT_TYPE': 'jpeg',  # 'png' o 'jpeg'
+    'SCREENSHOT_QUEUE_SIZE': 4,  # Capturas pendientes de guardar por sesión antes de descartar
+    # Vista en vivo (frames binarios): qué capturas se guardan como Screenshot
+    'SCREENSHOT_PERSIST': os.environ.get('SCREENSHOT_PERSIST', 'events'),  # 'all', 'sampled', 'events' o 'none'
+    'SCREENSHOT_SAMPLE_EVERY': int(os.environ.get('SCREENSHOT_SAMPLE_EVERY', 10)),  # Para 'sampled'
+    # Valores por defecto del screencast de DevTools (el cliente puede cambiarlos)
+    'SCREENCAST': {
+        'FPS': 5,
+        'QUALITY': 60,
+        'MAX_WIDTH': 1280,
+        'MAX_HEIGHT': 720,
+    },
+}
+
+# Pool de navegadores compartido (cada sesión recibe un contexto nuevo)
+BROWSER_POOL_SETTINGS = {
+    'MIN_SIZE': int(os.environ.get('BROWSER_POOL_MIN_SIZE', 1)),  # Navegadores pre-lanzados por tipo
+    'MAX_SIZE': int(os.environ.get('BROWSER_POOL_MAX_SIZE', 2)),  # Máximo de navegadores por tipo
+    'IDLE_TIMEOUT': int(os.environ.get('BROWSER_POOL_IDLE_TIMEOUT', 300)),  # Segundos sin uso antes de desalojar
+    'RECYCLE_AFTER': int(os.environ.get('BROWSER_POOL_RECYCLE_AFTER', 50)),  # Contextos servidos antes de reciclar
+    'MAINTENANCE_INTERVAL': 30,  # Segundos entre rondas de mantenimiento
+    'LAUNCH_TIMEOUT': 90000,  # ms
+}
+
+# Detección de página estable tras cada acción (sustituye las pausas fijas)
+SETTLE_SETTINGS = {
+    'QUIET_WINDOW_MS': int(os.environ.get('SETTLE_QUIET_WINDOW_MS', 300)),  # Silencio de red/DOM/dataLayer requerido
+    'TIMEOUT_MS': int(os.environ.get('SETTLE_TIMEOUT_MS', 3000)),  # Límite tras clics y escritura
+    'NAVIGATION_TIMEOUT_MS': int(os.environ.get('SETTLE_NAVIGATION_TIMEOUT_MS', 5000)),  # Límite tras navegar
+    'LONG_REQUEST_MS': 5000,  # Peticiones abiertas más tiempo no bloquean (long-polling, streams)
+}
+
+# Clic de un solo viaje (interaction/click con mode='runtime', ver core/interaction.py) y macros
+INTERACTION_SETTINGS = {
+    'CLICK_QUIET_MS': int(os.environ.get('CLICK_QUIET_MS', 150)),  # Silencio del dataLayer que da por terminado el clic
+    'CLICK_MAX_WAIT_MS': int(os.environ.get('CLICK_MAX_WAIT_MS', 1500)),  # Espera máxima de pushes tras el clic
+    # Macros (action 'macro', ver core/macros.py)
+    'MACRO_MAX_STEPS': int(os.environ.get('MACRO_MAX_STEPS', 100)),  # Pasos por macro
+    'MACRO_EVENT_TIMEOUT_MS': 10000,  # Espera por defecto de wait_for_event
+    'MACRO_MAX_WAIT_MS': int(os.environ.get('MACRO_MAX_WAIT_MS', 30000)),  # Tope de los 'ms' de un paso 'wait'
+    'MACRO_MAX_TIMEOUT_MS': int(os.environ.get('MACRO_MAX_TIMEOUT_MS', 60000)),  # Tope del 'timeout' de cada paso
+}
+
+# Bloqueo de recursos al cargar páginas (ver core/resource_policy.py)
+RESOURCE_POLICY_SETTINGS = {
+    'DEFAULT': os.environ.get('RESOURCE_POLICY', 'full'),  # Preset de las sesiones nuevas: 'full', 'visual' o 'tags'
+    'BATCH_DEFAULT': os.environ.get('BATCH_RESOURCE_POLICY', 'tags'),  # Los lotes no muestran la página: solo etiquetas
+    # Dominios extra separados por comas (admiten subdominios y comodines)
+    'ALLOW_DOMAINS': [d for d in os.environ.get('RESOURCE_ALLOW_DOMAINS', '').split(',') if d.strip()],  # Nunca se bloquean
+    'BLOCK_DOMAINS': [d for d in os.environ.get('RESOURCE_BLOCK_DOMAINS', '').split(',') if d.strip()],  # Se bloquean salvo con 'full'
+}
+
+# Validación por lotes headless (manage.py run_batch y POST /api/batch/)
+BATCH_SETTINGS = {
+    'CONCURRENCY': int(os.environ.get('BATCH_CONCURRENCY', 4)),  # Contextos abiertos a la vez
+    'MAX_CONCURRENCY': int(os.environ.get('BATCH_MAX_CONCURRENCY', 8)),  # Tope de la concurrencia pedida por lote
+    'MAX_JOBS': int(os.environ.get('BATCH_MAX_JOBS', 500)),  # Trabajos por lote como máximo
+    'BROWSERS': int(os.environ.get('BATCH_BROWSERS', 2)),  # Navegadores headless del lote (comparten contextos)
+    'RECYCLE_AFTER': 100,  # Contextos por navegador antes de reciclarlo
+    'API_TOKEN': os.environ.get('BATCH_API_TOKEN', ''),  # Obligatorio para la API: "Authorization: Bearer <token>" (vacío = API desactivada)
+}
+
+# Despliegue multi-proceso (manage.py run_workers, ver core/workers.py)
+WORKER_SETTINGS = {
+    'PROCESSES': int(os.environ.get('WEB_WORKERS', 1)),  # Procesos Daphne que comparten el puerto
+    'MAX_SESSIONS': int(os.environ.get('WORKER_MAX_SESSIONS', 4)),  # Sesiones con navegador que anuncia cada proceso
+    'HEARTBEAT_INTERVAL': 5,  # Segundos entre latidos (las claves caducan a los 3 latidos)
+    'REGISTRY': os.environ.get('WORKER_REGISTRY', 'True').lower() in ('true', '1', 'yes'),  # Propiedad de sesiones en Redis
+}
+
+# Reconexión: el navegador de una sesión sobrevive a su WebSocket (ver core/session_registry.py)
+SESSION_SETTINGS = {
+    'RECONNECT_GRACE': int(os.environ.get('SESSION_RECONNECT_GRACE', 120)),  # Segundos; 0 = cerrar al desconectar
+    'CATCH_UP_MAX': 1000,  # Mensajes guardados para el cliente que reconecta
+    'COMMAND_QUEUE_MAX': 50,  # Comandos del navegador pendientes por sesión (ver core/command_queue.py)
+}
+
+# Control de admisión y límites por sesión (ver core/admission.py). El número de
+# sesiones con navegador por proceso es WORKER_SETTINGS['MAX_SESSIONS']; 0 = sin límite
+ADMISSION_SETTINGS = {
+    'MAX_QUEUE': int(os.environ.get('ADMISSION_MAX_QUEUE', 20)),  # Sesiones esperando turno antes de rechazar
+    'QUEUE_TIMEOUT': int(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 600)),  # Segundos máximos en la cola
+    'MAX_DURATION': int(os.environ.get('SESSION_MAX_DURATION', 4 * 3600)),  # Segundos de vida de una sesión
+    'IDLE_TIMEOUT': int(os.environ.get('SESSION_IDLE_TIMEOUT', 900)),  # Segundos sin mensajes del cliente
+    'MAX_PAGES': int(os.environ.get('SESSION_MAX_PAGES', 5)),  # Páginas (pestañas/popups) por sesión
+    'MAX_SESSION_MEMORY_MB': int(os.environ.get('SESSION_MAX_MEMORY_MB', 512)),  # Heap JS de las páginas (Chromium)
+    'MAX_RSS_MB': int(os.environ.get('WORKER_MAX_RSS_MB', 1800)),  # RSS del proceso y sus navegadores
+    'SAMPLE_INTERVAL': 15,  # Segundos entre muestreos
+    'INTERACTIVE_RESERVED': int(os.environ.get('ADMISSION_INTERACTIVE_RESERVED', 1)),  # Huecos que los lotes no pueden ocupar
+}
+
+# Métricas Prometheus en /metrics (ver core/metrics.py)
+METRICS_SETTINGS = {
+    'TOKEN': os.environ.get('METRICS_TOKEN', ''),  # Si se define, el scrape exige "Authorization: Bearer <token>"
+    # Ficheros compartidos entre los procesos de run_workers (se vacía al arrancar)
+    'MULTIPROC_DIR': os.environ.get('PROMETHEUS_MULTIPROC_DIR', '/tmp/dlv-metrics'),
+}
+
+# Generación de reportes en segundo plano (ver core/report_jobs.py)
+REPORT_SETTINGS = {
+    # True: enviar los trabajos al canal 'report-worker' (`manage.py runworker report-worker`).
+    # False: generarlos en un hilo del propio proceso web.
+    'USE_WORKER': os.environ.get('REPORT_WORKER', 'False').lower() in ('true', '1', 'yes'),
+    # Formatos generados bajo demanda (HTML, CSV, PDF...) cacheados por hash de contenido
+    'CACHE_DIR': os.environ.get('REPORT_CACHE_DIR', ''),  # Vacío = MEDIA_ROOT/reports/cache
+    'CACHE_MAX_MB': int(os.environ.get('REPORT_CACHE_MAX_MB', 500)),  # Al superarlo se borran los menos usados
 }
 
 # Configuración de logging (Asegura que la ruta logs/ exista o tenga permisos)
@@ -32,17 +32,18 @@ if [ -n "$REDIS_HOST" ] && [ -n "$REDIS_PORT" ]; then
     wait_for "$REDIS_HOST" "$REDIS_PORT"
 fi
 
-# Aplicar migraciones
-echo "Aplicando migraciones..."
-python manage.py migrate --noinput
+# Aplicar migraciones y recopilar estáticos (los workers lo omiten con SKIP_SETUP)
+if [ -z "$SKIP_SETUP" ]; then
+    echo "Aplicando migraciones..."
+    python manage.py migrate --noinput
 
-# Recopilar archivos estáticos
-echo "Recopilando archivos estáticos..."
-python manage.py collectstatic --noinput --clear
+    echo "Recopilando archivos estáticos..."
+    python manage.py collectstatic --noinput --clear
+fi
 
 # Crear superusuario si no existe
 # (Usamos DJANGO_SUPERUSER_PASSWORD como check principal)
-if [ -n "$DJANGO_SUPERUSER_PASSWORD" ]; then
+if [ -z "$SKIP_SETUP" ] && [ -n "$DJANGO_SUPERUSER_PASSWORD" ]; then
     echo "Intentando crear superusuario (ignorará si ya existe)..."
     python manage.py createsuperuser --noinput --username "${DJANGO_SUPERUSER_USERNAME:-admin}" --email "${DJANGO_SUPERUSER_EMAIL:-admin@example.com}" || true
 fi
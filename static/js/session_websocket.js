@@ -19,6 +19,13 @@ class SessionWebSocket {
         this.maxReconnectAttempts = 5; // Intentos máximos de reconexión
         this.reconnectInterval = 3000; // Intervalo en ms (3 segundos)
         this.observers = {}; // Para posible patrón observador
+        this.liveView = true; // Recibir capturas como frames binarios (vista en vivo)
+        this.screenshotObjectUrl = null; // Blob URL del último frame, para liberarlo
+        this.screencastRunning = false; // Screencast continuo activo en el servidor
+        // 'runtime': clic de un solo viaje con los pushes del clic en la respuesta; 'mouse': ratón de Playwright
+        this.clickMode = 'runtime';
+        this.commandQueue = { depth: 0, running: null, lastWaitMs: 0 }; // Cola de comandos de la sesión en el servidor
+        this.resourceStats = null; // Peticiones permitidas/bloqueadas de la página actual
 
         // --- Obtener referencias a elementos DOM (con verificación) ---
         this.screenshotElement = document.getElementById('browser-screenshot');
@@ -73,6 +80,7 @@ class SessionWebSocket {
 
         try {
             this.socket = new WebSocket(wsUrl);
+            this.socket.binaryType = 'arraybuffer'; // Frames de la vista en vivo
         } catch (error) {
              console.error("SessionWebSocket: Error al crear instancia de WebSocket.", error);
              // Podríamos intentar reconectar aquí o mostrar un error fatal
@@ -105,7 +113,8 @@ class SessionWebSocket {
         // Enviar mensaje 'init' para que el backend inicie Playwright y envíe estado
         this.sendMessage({
             action: 'init',
-            sessionId: this.sessionId
+            sessionId: this.sessionId,
+            live_view: this.liveView
         });
 
         this.notifyObservers('connection', { connected: true });
@@ -124,7 +133,8 @@ class SessionWebSocket {
         this.hideLoading();
 
         // Intentar reconexión solo si el cierre fue inesperado (código 1006 es común para fallos)
-        if (!event.wasClean || event.code === 1006) {
+        // 4001: el worker dueño del navegador cerró la sesión; al reconectar otro la reclama
+        if (!event.wasClean || event.code === 1006 || event.code === 4001) {
              console.log("SessionWebSocket: Cierre inesperado, intentando reconexión...");
             this.attemptReconnect();
         } else {
@@ -163,6 +173,10 @@ class SessionWebSocket {
      * Procesa mensajes JSON recibidos del servidor backend
      */
     handleMessage(event) {
+        if (event.data instanceof ArrayBuffer) {
+            this.handleBinaryFrame(event.data);
+            return;
+        }
         console.debug("SessionWebSocket: Mensaje recibido:", event.data);
         try {
             const data = JSON.parse(event.data);
@@ -172,8 +186,9 @@ class SessionWebSocket {
                 return;
             }
 
-            // Llamar dinámicamente al método manejador (ej. handleScreenshot)
-            const handlerMethodName = `handle${data.action.charAt(0).toUpperCase() + data.action.slice(1)}`;
+            // Llamar dinámicamente al método manejador (ej. handleScreenshot, url_changed -> handleUrlChanged)
+            const actionName = data.action.split('_').map(part => part.charAt(0).toUpperCase() + part.slice(1)).join('');
+            const handlerMethodName = `handle${actionName}`;
             if (typeof this[handlerMethodName] === 'function') {
                 this[handlerMethodName](data);
             } else {
@@ -191,14 +206,44 @@ class SessionWebSocket {
         }
     }
 
+    /**
+     * Procesa un frame binario de la vista en vivo.
+     * Cabecera de 6 bytes: versión (uint8), tipo (uint8), secuencia (uint32 big-endian).
+     */
+    handleBinaryFrame(buffer) {
+        const HEADER_SIZE = 6;
+        const FRAME_TYPE_JPEG = 1;
+        if (buffer.byteLength <= HEADER_SIZE) {
+            console.warn("SessionWebSocket: Frame binario demasiado corto, ignorado.");
+            return;
+        }
+        const view = new DataView(buffer);
+        const frameType = view.getUint8(1);
+        const seq = view.getUint32(2);
+        if (frameType !== FRAME_TYPE_JPEG) {
+            console.warn(`SessionWebSocket: Tipo de frame binario desconocido: ${frameType}`);
+            return;
+        }
+
+        const blob = new Blob([buffer.slice(HEADER_SIZE)], { type: 'image/jpeg' });
+        const objectUrl = URL.createObjectURL(blob);
+        // Liberar el frame anterior para no acumular memoria
+        if (this.screenshotObjectUrl) URL.revokeObjectURL(this.screenshotObjectUrl);
+        this.screenshotObjectUrl = objectUrl;
+
+        this.handleScreenshot({ image_data: objectUrl, seq: seq });
+        this.notifyObservers('screenshot', { image_data: objectUrl, seq: seq });
+    }
+
     // --- MANEJADORES DE MENSAJES ESPECÍFICOS ---
 
     handleScreenshot(data) {
         this.hideLoading(); // Ocultar indicador si estaba visible
-        if (data.image_url && this.screenshotElement && this.modalScreenshotElement) {
-            const timestampedUrl = `${data.image_url}?t=${Date.now()}`; // Evitar caché
-            this.screenshotElement.src = timestampedUrl;
-            this.modalScreenshotElement.src = timestampedUrl; // Actualizar también en el modal
+        // image_data llega lista para usar (data URI o Blob URL); image_url se mantiene por compatibilidad
+        const imageSrc = data.image_data || (data.image_url ? `${data.image_url}?t=${Date.now()}` : null); // Evitar caché
+        if (imageSrc && this.screenshotElement && this.modalScreenshotElement) {
+            this.screenshotElement.src = imageSrc;
+            this.modalScreenshotElement.src = imageSrc; // Actualizar también en el modal
             this.screenshotCount++;
             if(this.screenshotCountElement) this.screenshotCountElement.textContent = this.screenshotCount;
             console.debug("SessionWebSocket: Screenshot actualizado.");
@@ -241,6 +286,7 @@ class SessionWebSocket {
                     statusClass = 'invalid'; badgeText = 'INVÁLIDO'; badgeClass = 'bg-danger'; this.invalidCount++;
                 }
                 datalayerEventDiv.classList.add(statusClass);
+                datalayerEventDiv.dataset.captureId = data.id || ''; // Para marcarla si no llega a guardarse
                 badgeEl.textContent = badgeText;
                 badgeEl.className = `badge validation-badge ${badgeClass}`;
 
@@ -284,6 +330,30 @@ class SessionWebSocket {
         }
     }
 
+    handleDatalayerLost(data) {
+        // Capturas ya mostradas que el servidor no pudo guardar: no estarán en reportes ni exportaciones
+        (data.ids || []).forEach(id => {
+            const eventDiv = this.datalayerContainer && this.datalayerContainer.querySelector(`.datalayer-event[data-capture-id="${id}"]`);
+            if (!eventDiv) return;
+            if (eventDiv.classList.contains('valid')) this.validCount--;
+            else if (eventDiv.classList.contains('invalid')) this.invalidCount--;
+            this.datalayerCount--;
+            eventDiv.classList.remove('valid', 'invalid');
+            eventDiv.classList.add('warning');
+            const badgeEl = eventDiv.querySelector('.validation-badge');
+            if (badgeEl) {
+                badgeEl.textContent = 'NO GUARDADO';
+                badgeEl.className = 'badge validation-badge bg-dark';
+            }
+        });
+        if(this.datalayerCountElement) this.datalayerCountElement.textContent = this.datalayerCount;
+        if(this.datalayerBadgeElement) this.datalayerBadgeElement.textContent = this.datalayerCount;
+        this.updateValidationStats();
+        if (window.dataLayerValidator && window.dataLayerValidator.showNotification) {
+            window.dataLayerValidator.showNotification(data.message, 'danger');
+        }
+    }
+
     handleUrlChanged(data) {
         if (data.url) {
             const newUrl = data.url;
@@ -315,6 +385,10 @@ class SessionWebSocket {
             this.datalayerCountElement.textContent = this.datalayerCount;
             this.datalayerBadgeElement.textContent = this.datalayerCount;
         }
+        // Resultado de la comprobación manual del dataLayer (los pushes llegan por streaming)
+        if (data.datalayer_length !== undefined && data.message && window.dataLayerValidator) {
+            window.dataLayerValidator.showNotification(data.message, 'info');
+        }
         // Actualizar URL
         if (data.current_url) {
             this.handleUrlChanged(data);
@@ -368,7 +442,13 @@ class SessionWebSocket {
 
      handleReport(data) {
           console.debug("SessionWebSocket: Mensaje de reporte ('report') recibido:", data);
-          if(data.status === 'generated' && data.report_url) {
+          if (data.status === 'queued') {
+              if (window.dataLayerValidator && window.dataLayerValidator.showNotification) {
+                 window.dataLayerValidator.showNotification(data.message || 'Reporte en cola.', 'info');
+              }
+          } else if (data.status === 'progress') {
+              console.debug(`SessionWebSocket: Reporte ${data.job_id}: ${data.processed}/${data.total} capturas procesadas`);
+          } else if(data.status === 'generated' && data.report_url) {
               if (window.dataLayerValidator && window.dataLayerValidator.showNotification) {
                  window.dataLayerValidator.showNotification(data.message || 'Reporte generado.', 'success');
               }
@@ -380,6 +460,107 @@ class SessionWebSocket {
           }
      }
 
+    handleCatchUp(data) {
+        // Reconexión a un navegador que siguió vivo: a continuación llegan los mensajes perdidos
+        console.log(`SessionWebSocket: Recuperando ${data.count} mensajes (${data.dropped} descartados).`);
+        if (data.current_url) this.handleUrlChanged({ url: data.current_url });
+        if (window.dataLayerValidator && window.dataLayerValidator.showNotification) {
+            window.dataLayerValidator.showNotification(data.message || 'Reconectado a la sesión.', 'info');
+        }
+    }
+
+    handleQueue(data) {
+        // Control de admisión: posición en la cola hasta que haya un navegador libre
+        console.debug("SessionWebSocket: Cola de admisión:", data);
+        if (data.status === 'waiting') {
+            this.showLoading();
+            if (window.dataLayerValidator && window.dataLayerValidator.showNotification) {
+                window.dataLayerValidator.showNotification(data.message || `Posición en la cola: ${data.position}`, 'info');
+            }
+        } else if (data.status === 'admitted') {
+            console.log("SessionWebSocket: Sesión admitida, iniciando navegador...");
+        } else if (data.status === 'rejected') {
+            this.handleErrorMessage(data);
+        }
+    }
+
+    handleSettled(data) {
+        // Tiempo que tardó la página en estabilizarse tras la acción
+        console.debug(`SessionWebSocket: Página estable tras '${data.source}' en ${data.duration_ms} ms (estable: ${data.settled}${data.busy ? ', ocupado: ' + data.busy : ''})`);
+        this.lastSettle = data;
+        this.hideLoading();
+    }
+
+    handleCommand(data) {
+        // Estado de la cola de comandos del navegador: queued, coalesced, started, done, cancelled, failed
+        console.debug(`SessionWebSocket: Comando ${data.command} (${data.id}) ${data.status}, cola: ${data.depth}, espera: ${data.wait_ms} ms`);
+        this.commandQueue.depth = data.depth;
+        this.commandQueue.lastWaitMs = data.wait_ms;
+        if (data.status === 'started') {
+            this.commandQueue.running = data.command;
+        } else if (['done', 'cancelled', 'failed'].includes(data.status)) {
+            this.commandQueue.running = null;
+            if (data.status !== 'done' && data.depth === 0) this.hideLoading();
+        }
+        this.notifyObservers('command_queue', this.commandQueue);
+    }
+
+    handleCancel(data) {
+        console.log(`SessionWebSocket: ${data.cancelled} comandos cancelados (pendientes: ${data.depth}).`);
+        this.commandQueue.depth = data.depth;
+        this.hideLoading();
+    }
+
+    handleMacroResult(data) {
+        console.log(`SessionWebSocket: Macro ${data.status} en ${data.duration_ms} ms: ${data.steps_run}/${data.steps_total} pasos, aserciones ${data.assertions.passed} ok / ${data.assertions.failed} fallidas`, data);
+        this.lastMacro = data;
+        if (window.dataLayerValidator && window.dataLayerValidator.showNotification) {
+            const failed = data.failed_steps > 0 || data.status !== 'completed';
+            const message = failed
+                ? `Macro ${data.status === 'completed' ? 'completada con fallos' : data.status}: ${data.failed_steps} pasos con error o aserción fallida.`
+                : `Macro completada: ${data.steps_run} pasos, ${data.pushes.length} pushes.`;
+            window.dataLayerValidator.showNotification(message, failed ? 'warning' : 'success');
+        }
+        this.hideLoading();
+    }
+
+    handleClickResult(data) {
+        // Clic de un solo viaje: elemento pulsado y pushes del dataLayer que provocó
+        // (los pushes también llegan validados uno a uno como 'datalayer')
+        const element = data.element;
+        const target = element ? (element.selector || element.tagName) : 'elemento desconocido';
+        console.debug(`SessionWebSocket: Clic en ${target}: ${data.pushes.length} pushes en ${data.duration_ms} ms (navegó: ${data.navigated})`, data);
+        this.lastClick = data;
+        if (!data.found && window.dataLayerValidator && window.dataLayerValidator.showNotification) {
+            window.dataLayerValidator.showNotification('No hay ningún elemento en ese punto de la página.', 'warning');
+        }
+        this.hideLoading();
+    }
+
+    handleResourceStats(data) {
+        // Llega tras cada navegación o acción que cambió las cifras de la página
+        const page = data.page || { allowed: 0, blocked: 0, bytes_saved_estimate: 0 };
+        console.debug(`SessionWebSocket: Recursos (${data.policy}): ${page.allowed} permitidos, ${page.blocked} bloqueados (~${Math.round(page.bytes_saved_estimate / 1024)} KB ahorrados)`, data);
+        this.resourceStats = data;
+    }
+
+    handleResourcePolicy(data) {
+        console.log(`SessionWebSocket: Bloqueo de recursos '${data.preset}'`, data);
+        this.resourceStats = data.stats;
+        this.resourcePolicy = data;
+    }
+
+    handleLiveView(data) {
+        console.debug("SessionWebSocket: Vista en vivo:", data);
+        this.liveView = !!data.enabled;
+    }
+
+    handleScreencast(data) {
+        console.debug("SessionWebSocket: Estado del screencast:", data);
+        this.screencastRunning = !!data.running;
+        this.hideLoading();
+    }
+
     handleErrorMessage(data) { // Renombrado de handleerror a handleErrorMessage
         const message = data.message || 'Error desconocido del servidor.';
         console.error('SessionWebSocket: Error recibido del servidor:', message);
@@ -560,6 +741,22 @@ typeText(selector, text) {
     captureDataLayer() { this.sendMessage({ action: 'capture', command: 'datalayer' }); }
     takeScreenshot() { this.showLoading(); this.sendMessage({ action: 'capture', command: 'screenshot' }); }
     checkValidation() { this.sendMessage({ action: 'validation', command: 'check' }); }
+    /**
+     * Ejecuta una secuencia de pasos en un solo mensaje (goto, click, type, wait,
+     * wait_for_event, assert_datalayer). Marca con checkpoint: true los pasos tras
+     * los que quieras captura; el resultado llega en un único 'macro_result'.
+     */
+    runMacro(steps, options = {}) {
+        this.showLoading();
+        this.sendMessage({ action: 'macro', steps: steps, ...options });
+    }
+    cancel(all = false) { this.sendMessage({ action: 'cancel', all: all }); }
+    /**
+     * Bloqueo de recursos: preset 'full', 'visual' o 'tags' y reglas opcionales
+     * (block_types, block_domains, allow_domains). Afecta a las cargas siguientes.
+     */
+    setResourcePolicy(preset, rules = {}) { this.sendMessage({ action: 'resource_policy', command: 'set', preset: preset, rules: rules }); }
+    getResourcePolicy() { this.sendMessage({ action: 'resource_policy', command: 'get' }); }
     stopSession() { console.log("Intentando detener sesión..."); this.sendMessage({ action: 'session', command: 'stop' }); }
     generateReport(options = {}) { console.log("Intentando generar reporte:", options); this.sendMessage({ action: 'report', command: 'generate', options: options }); }
    clickAt(xPercent, yPercent) {
@@ -570,9 +767,16 @@ typeText(selector, text) {
     }
     console.log(`Enviando clic en coordenadas relativas: x=${xPercent.toFixed(3)}, y=${yPercent.toFixed(3)}`);
     this.showLoading();
-    this.sendMessage({ action: 'interaction', command: 'click', x: xPercent, y: yPercent });
+    this.sendMessage({ action: 'interaction', command: 'click', x: xPercent, y: yPercent, mode: this.clickMode });
 }
 
+    /**
+     * Screencast continuo (solo Chromium). Opciones: fps, quality, max_width, max_height.
+     */
+    startScreencast(options = {}) { this.sendMessage({ action: 'screencast', command: 'start', ...options }); }
+    configureScreencast(options = {}) { this.sendMessage({ action: 'screencast', command: 'configure', ...options }); }
+    stopScreencast() { this.sendMessage({ action: 'screencast', command: 'stop' }); }
+
     // --- GESTIÓN DE OBSERVADORES (si necesitas desacoplar la UI) ---
     subscribe(eventType, callback) {
          if (!this.observers[eventType]) {
@@ -0,0 +1,223 @@
+# validator/reporter.py
+"""
+Renderizado de reportes de validación en HTML, JSON, CSV y PDF.
+
+``ReportGenerator`` recibe el resumen del reporte y un iterable de
+``(sección, elemento)`` (``'details'`` o ``'screenshots'``) que se consume
+una sola vez y en orden, así que los detalles pueden venir directamente de
+un fichero o de la base de datos sin cargarlos todos en memoria. Cada
+formato escribe bytes en un fichero binario.
+
+El PDF usa matplotlib (importado solo al pedir ese formato).
+"""
+import csv
+import io
+import json
+from html import escape
+
+RENDERER_VERSION = 1 # Incrementar al cambiar la salida: invalida los artefactos cacheados
+
+FORMATS = ('html', 'json', 'csv', 'pdf')
+
+CONTENT_TYPES = {
+    'html': 'text/html; charset=utf-8',
+    'json': 'application/json',
+    'csv': 'text/csv; charset=utf-8',
+    'pdf': 'application/pdf',
+}
+
+CSV_COLUMNS = ['index', 'timestamp', 'url', 'event', 'is_valid', 'errors', 'offset', 'data']
+
+HTML_STYLE = """
+body { font-family: Arial, sans-serif; line-height: 1.6; color: #333; margin: 30px; }
+h1, h2, h3 { color: #2a5885; }
+.summary { background-color: #f5f5f5; padding: 15px; border-radius: 5px; margin-bottom: 30px; }
+.success { color: #4caf50; font-weight: bold; }
+.error { color: #f44336; font-weight: bold; }
+.warning { color: #ff9800; font-weight: bold; }
+.detail-section { border: 1px solid #eee; padding: 15px; margin-bottom: 20px; border-radius: 5px; }
+.error-list { background-color: #ffebee; padding: 10px; border-radius: 5px; margin-top: 10px; }
+pre { background-color: #f5f5f5; padding: 10px; border-radius: 5px; overflow-x: auto; }
+"""
+
+PDF_LINES_PER_PAGE = 64
+PDF_LINE_WIDTH = 110
+
+
+class ReportRenderError(Exception):
+    """No se pudo renderizar el reporte en el formato pedido"""
+
+
+def detail_event(detail):
+    """Nombre del evento de un detalle (último push con 'event')"""
+    data = detail.get('data')
+    if isinstance(data, dict):
+        return data.get('event', 'N/A')
+    if isinstance(data, list):
+        for entry in reversed(data):
+            if isinstance(entry, dict) and 'event' in entry:
+                return entry['event']
+    return 'N/A'
+
+
+def _status_label(is_valid):
+    if is_valid is True:
+        return 'VÁLIDO'
+    if is_valid is False:
+        return 'INVÁLIDO'
+    return 'SIN VALIDAR'
+
+
+class ReportGenerator:
+    """Genera un reporte en cualquiera de los formatos de ``FORMATS``"""
+
+    def __init__(self, title, summary, items, reference_comparison=None):
+        self.title = title
+        self.summary = summary or {}
+        self.items = items # Iterable de (sección, elemento); se consume una vez
+        self.reference_comparison = reference_comparison or {}
+
+    def render(self, format_type, fileobj):
+        if format_type not in FORMATS:
+            raise ReportRenderError(f"Formato de reporte no soportado: {format_type}")
+        getattr(self, f'render_{format_type}')(fileobj)
+
+    # --------------------- FORMATOS ---------------------
+
+    def render_json(self, fileobj):
+        """Mismo esquema que el artefacto JSON del reporte, escrito elemento a elemento"""
+        sections = {'details': 0, 'screenshots': 0}
+        current = None
+        fileobj.write(b'{')
+        for section, item in self.items:
+            if section != current:
+                if current is not None:
+                    fileobj.write(b'], ')
+                fileobj.write(self._dumps(section) + b': [')
+                current = section
+            if sections[section]:
+                fileobj.write(b', ')
+            fileobj.write(self._dumps(item))
+            sections[section] += 1
+        if current is not None:
+            fileobj.write(b'], ')
+        for section, count in sections.items():
+            if not count and section != current:
+                fileobj.write(self._dumps(section) + b': [], ')
+        fileobj.write(self._dumps({'summary': self.summary, 'reference_comparison': self.reference_comparison})[1:])
+
+    def render_csv(self, fileobj):
+        """Una fila por captura de DataLayer"""
+        text = io.TextIOWrapper(fileobj, encoding='utf-8', newline='', write_through=True)
+        try:
+            writer = csv.writer(text)
+            writer.writerow(CSV_COLUMNS)
+            for section, detail in self.items:
+                if section != 'details':
+                    continue
+                writer.writerow([
+                    detail.get('index'),
+                    detail.get('timestamp'),
+                    detail.get('url'),
+                    detail_event(detail),
+                    '' if detail.get('is_valid') is None else detail.get('is_valid'),
+                    ' | '.join(str(error) for error in detail.get('errors') or []),
+                    detail.get('offset', ''),
+                    json.dumps(detail.get('data'), ensure_ascii=False),
+                ])
+        finally:
+            text.detach() # No cerrar el fichero del llamador
+
+    def render_html(self, fileobj):
+        """Documento HTML autocontenido"""
+        write = lambda text: fileobj.write(text.encode('utf-8'))
+        summary = self.summary
+        status_class = 'success' if summary.get('is_valid_overall') else 'error'
+
+        write('<!DOCTYPE html>\n<html lang="es">\n<head>\n<meta charset="utf-8">\n')
+        write(f'<title>{escape(self.title)}</title>\n<style>{HTML_STYLE}</style>\n</head>\n<body>\n')
+        write(f'<h1>{escape(self.title)}</h1>\n<div class="summary">\n')
+        write(f'<p><strong>URL:</strong> {escape(str(summary.get("url", "")))}</p>\n')
+        write(f'<p><strong>Generado:</strong> {escape(str(summary.get("report_generated_at", "")))}</p>\n')
+        write(f'<p><strong>Resultado:</strong> <span class="{status_class}">{"VÁLIDO" if summary.get("is_valid_overall") else "INVÁLIDO"}</span></p>\n')
+        write(
+            f'<p>DataLayers capturados: {summary.get("total_datalayers_captured", 0)} &middot; '
+            f'<span class="success">{summary.get("valid_count", 0)} válidos</span> &middot; '
+            f'<span class="error">{summary.get("invalid_count", 0)} inválidos</span> &middot; '
+            f'{summary.get("success_percent", 0)}% de éxito</p>\n</div>\n'
+        )
+
+        current = None
+        for section, item in self.items:
+            if section != current:
+                write('<h2>Detalle de DataLayers</h2>\n' if section == 'details' else '<h2>Capturas de pantalla</h2>\n')
+                current = section
+            if section == 'details':
+                self._write_html_detail(write, item)
+            else:
+                write(f'<p><a href="{escape(str(item.get("image_url") or ""))}">{escape(str(item.get("url", "")))}</a> '
+                      f'({escape(str(item.get("timestamp", "")))})</p>\n')
+        write('</body>\n</html>\n')
+
+    def _write_html_detail(self, write, detail):
+        is_valid = detail.get('is_valid')
+        status_class = 'success' if is_valid else 'error' if is_valid is False else 'warning'
+        write(f'<div class="detail-section" id="datalayer-{detail.get("index")}">\n')
+        write(f'<h3>DataLayer #{(detail.get("index") or 0) + 1} &mdash; {escape(str(detail_event(detail)))} '
+              f'<span class="{status_class}">{_status_label(is_valid)}</span></h3>\n')
+        write(f'<p>{escape(str(detail.get("url", "")))} ({escape(str(detail.get("timestamp", "")))})</p>\n')
+        errors = detail.get('errors') or []
+        if errors:
+            write('<div class="error-list"><ul>\n')
+            for error in errors:
+                write(f'<li>{escape(str(error))}</li>\n')
+            write('</ul></div>\n')
+        write(f'<pre>{escape(json.dumps(detail.get("data"), indent=2, ensure_ascii=False))}</pre>\n</div>\n')
+
+    def render_pdf(self, fileobj):
+        """PDF de texto paginado (resumen y una entrada por captura)"""
+        try:
+            import matplotlib
+            matplotlib.use('Agg')
+            from matplotlib.backends.backend_pdf import PdfPages
+            import matplotlib.pyplot as plt
+        except ImportError as e:
+            raise ReportRenderError(f"El formato PDF requiere matplotlib: {e}")
+
+        with PdfPages(fileobj) as pdf:
+            page = []
+            for line in self._pdf_lines():
+                page.append(line)
+                if len(page) == PDF_LINES_PER_PAGE:
+                    self._write_pdf_page(pdf, plt, page)
+                    page = []
+            if page:
+                self._write_pdf_page(pdf, plt, page)
+
+    def _pdf_lines(self):
+        summary = self.summary
+        yield self.title
+        yield f"URL: {summary.get('url', '')}"
+        yield f"Generado: {summary.get('report_generated_at', '')}"
+        yield f"Resultado: {'VÁLIDO' if summary.get('is_valid_overall') else 'INVÁLIDO'}"
+        yield (f"DataLayers: {summary.get('total_datalayers_captured', 0)} - válidos {summary.get('valid_count', 0)}, "
+               f"inválidos {summary.get('invalid_count', 0)} ({summary.get('success_percent', 0)}% de éxito)")
+        yield ''
+        for section, detail in self.items:
+            if section != 'details':
+                continue
+            yield f"#{(detail.get('index') or 0) + 1} [{_status_label(detail.get('is_valid'))}] {detail_event(detail)} - {detail.get('url', '')}"
+            for error in detail.get('errors') or []:
+                yield f"    - {error}"
+
+    @staticmethod
+    def _write_pdf_page(pdf, plt, lines):
+        figure = plt.figure(figsize=(8.27, 11.69)) # A4
+        text = '\n'.join(line if len(line) <= PDF_LINE_WIDTH else line[:PDF_LINE_WIDTH - 1] + '…' for line in lines)
+        figure.text(0.05, 0.97, text, family='monospace', fontsize=7, va='top')
+        pdf.savefig(figure)
+        plt.close(figure)
+
+    @staticmethod
+    def _dumps(obj):
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
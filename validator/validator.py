@@ -0,0 +1,160 @@
+# validator/validator.py
+"""
+Índice precompilado de los DataLayers de referencia.
+
+El JSON de referencia se compila una sola vez: los eventos se agrupan por
+nombre y de cada uno se separan de antemano las propiedades requeridas, las
+constantes (ya convertidas a string) y los placeholders ``{{variable}}``.
+Así validar una captura solo recorre los candidatos de su evento.
+"""
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+
+MatchResult = namedtuple('MatchResult', ['found', 'reference', 'errors'])
+
+
+def is_placeholder(value):
+    """Indica si un valor de referencia es una variable tipo {{variable}}"""
+    return isinstance(value, str) and '{{' in value and '}}' in value
+
+
+class ReferenceSpec:
+    """Evento de referencia compilado"""
+
+    __slots__ = ('event', 'reference', 'checks', 'required_keys', 'constants', 'placeholders')
+
+    def __init__(self, reference):
+        self.reference = reference
+        self.event = reference.get('event')
+        # (clave, valor esperado como string o None si es placeholder, valor original)
+        self.checks = []
+        self.required_keys = []
+        self.constants = {}
+        self.placeholders = set()
+
+        for key, ref_value in reference.items():
+            # Ignorar la clave 'event' misma y valores nulos/vacíos (no se validan)
+            if key == 'event' or ref_value is None or ref_value == '':
+                continue
+            self.required_keys.append(key)
+            if is_placeholder(ref_value):
+                self.placeholders.add(key)
+                self.checks.append((key, None, ref_value))
+            else:
+                self.constants[key] = str(ref_value)
+                self.checks.append((key, str(ref_value), ref_value))
+
+    def mismatches(self, captured_event, event_name):
+        """Devuelve la lista de diferencias con el evento capturado (vacía si coincide)"""
+        errors = []
+        for key, expected, ref_value in self.checks:
+            captured_value = captured_event.get(key)
+
+            # Si la clave no existe en el capturado, es un error
+            if captured_value is None:
+                errors.append(f"Propiedad requerida '{key}' falta en evento '{event_name}'.")
+                continue
+
+            # Las variables solo exigen presencia, no valor exacto
+            if expected is None:
+                continue
+
+            if expected != str(captured_value):
+                errors.append(f"Propiedad '{key}' no coincide para evento '{event_name}'. Esperado: '{ref_value}', Capturado: '{captured_value}'")
+        return errors
+
+
+class ReferenceIndex:
+    """Índice nombre de evento -> especificaciones de referencia compiladas"""
+
+    def __init__(self, reference_events=None):
+        self._index = {}
+        self._size = 0
+        for ref_event in reference_events or []:
+            if not isinstance(ref_event, dict):
+                continue
+            spec = ReferenceSpec(ref_event)
+            try:
+                self._index.setdefault(spec.event, []).append(spec)
+            except TypeError:
+                logger.warning(f"Evento de referencia con nombre no válido ignorado: {spec.event!r}")
+                continue
+            self._size += 1
+        logger.debug(f"Índice de referencia compilado: {self._size} eventos, {len(self._index)} nombres distintos")
+
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+    def event_names(self):
+        return list(self._index)
+
+    def candidates(self, event_name):
+        try:
+            return self._index.get(event_name, [])
+        except TypeError: # Nombre no hashable (lista, objeto...)
+            return []
+
+    def match(self, captured_event):
+        """
+        Busca un evento de referencia que coincida con el capturado.
+        Si ninguno coincide, se devuelven los errores de todos los candidatos.
+        """
+        event_name = captured_event.get('event')
+        candidates = self.candidates(event_name)
+        if not candidates:
+            return MatchResult(False, None, [])
+
+        errors = []
+        for spec in candidates:
+            spec_errors = spec.mismatches(captured_event, event_name)
+            if not spec_errors:
+                return MatchResult(True, spec.reference, [])
+            errors.extend(spec_errors)
+        return MatchResult(True, None, errors)
+
+    def validate(self, captured_datalayer_list):
+        """
+        Valida el último evento explícito de una lista de pushes capturados.
+        Devuelve ``{'valid': True|False|None, 'errors': [...]}``; ``None`` si no se pudo validar.
+        """
+        results = {'valid': True, 'errors': []}
+        if not captured_datalayer_list or not isinstance(captured_datalayer_list, list):
+             results['errors'].append("No hay DataLayers capturados válidos para validar.")
+             results['valid'] = False
+             return results
+
+        last_event_captured = None
+        # Buscar el último objeto en la lista que sea un diccionario y tenga 'event'
+        for item in reversed(captured_datalayer_list):
+            if isinstance(item, dict) and 'event' in item:
+                last_event_captured = item
+                break
+
+        if not last_event_captured:
+             # Si no hay evento explícito, no podemos comparar fácilmente. Marcar como no validado.
+             results['errors'].append("No se encontró un evento explícito ('event': '...') en el último push del DataLayer capturado.")
+             results['valid'] = None # Indicar que no se pudo validar vs referencia
+             return results
+
+        event_name = last_event_captured.get('event')
+        logger.debug(f"Validando evento capturado: '{event_name}' contra referencia...")
+
+        # Buscar un evento coincidente solo entre los candidatos con el mismo nombre
+        found_match, matching_ref, validation_errors_for_event = self.match(last_event_captured)
+
+        # Evaluar resultados de la búsqueda
+        if not found_match:
+             results['errors'].append(f"No se encontró ningún evento de referencia con nombre '{event_name}'.")
+             results['valid'] = False
+        elif not matching_ref: # Se encontró el evento pero ninguna referencia coincidió perfectamente
+             results['errors'].extend(validation_errors_for_event) # Añadir los errores del último intento de match
+             results['valid'] = False
+
+        logger.debug(f"Resultado validación para evento '{event_name}': Válido={results['valid']}, Errores={results['errors']}")
+        return results